@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for the database module."""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pw_tokenizer import database
+from pw_tokenizer import elf_reader
+from pw_tokenizer import tokens
+
+TEST_ELF_PATH = os.path.join(os.path.dirname(__file__),
+                             'elf_reader_test_binary.elf')
+
+STRING_SETS = (
+    ('Hello %s!', 'The answer is: %d', 'o000'),
+    ('0Q1Q', 'Jello, world!', 'The answer is: %d'),
+    ('Goodbye', ),
+    ('%llu', '%x%lld%1.2f%s', 'Hello %s!'),
+)
+
+
+class LoadTokenDatabasesTest(unittest.TestCase):
+    """Tests loading many token databases, optionally in parallel."""
+    def setUp(self):
+        super().setUp()
+        self._dir = tempfile.mkdtemp()
+        self.paths = []
+
+        for i, strings in enumerate(STRING_SETS):
+            path = os.path.join(self._dir, f'db_{i}.csv')
+            with open(path, 'wb') as fd:
+                tokens.write_csv(tokens.Database.from_strings(strings), fd)
+
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+        super().tearDown()
+
+    def test_serial(self):
+        databases = database.load_token_databases(self.paths)
+        found = [{e.string for e in db.entries()} for db in databases]
+        self.assertEqual(found, [set(strings) for strings in STRING_SETS])
+
+    def test_parallel_matches_serial(self):
+        serial = database.load_token_databases(self.paths, jobs=1)
+        parallel = database.load_token_databases(self.paths, jobs=3)
+
+        self.assertEqual([str(db) for db in parallel],
+                         [str(db) for db in serial])
+        self.assertEqual(str(tokens.Database.merged(*parallel)),
+                         str(tokens.Database.merged(*serial)))
+
+    def test_all_cpus(self):
+        databases = database.load_token_databases(self.paths, jobs=0)
+        self.assertEqual(len(databases), len(STRING_SETS))
+
+    def test_create_with_jobs(self):
+        output = os.path.join(self._dir, 'output.csv')
+
+        database._handle_create(  # pylint: disable=protected-access
+            self.paths,
+            jobs=2,
+            database=output,
+            force=False,
+            output_type='csv',
+            include=None,
+            exclude=None,
+            string_offsets=False,
+            stream=False,
+            chunk_size=database.DEFAULT_STREAMING_CHUNK_SIZE)
+
+        with open(output) as fd:
+            created = tokens.Database(tokens.parse_csv(fd))
+
+        expected = {string for strings in STRING_SETS for string in strings}
+        self.assertEqual({e.string for e in created.entries()}, expected)
+
+
+class SplitStringsTest(unittest.TestCase):
+    """Tests splitting tokenized string sections into strings."""
+    def _split(self, *sections: bytes):
+        return list(
+            database._split_strings(  # pylint: disable=protected-access
+                [memoryview(section) for section in sections]))
+
+    def test_matches_joined_sections(self):
+        for sections in ((), (b'', ), (b'one\0two\0', ), (b'a\0b', b'c\0'),
+                         (b'x\0', b'', b'\0y\0z'), (b'no null', b'!')):
+            expected = ([s.decode() for s in b''.join(sections).split(b'\0')]
+                        if sections else [])
+            self.assertEqual(self._split(*sections), expected)
+
+    def test_sections_released_after_decode_error(self):
+        # pylint: disable=protected-access
+        sections = [memoryview(b'ok\0\xff\0'), memoryview(b'unread\0')]
+
+        with self.assertRaises(UnicodeDecodeError):
+            list(database._split_strings(sections))
+
+        for section in sections:
+            with self.assertRaises(ValueError):  # released views raise
+                section.tobytes()
+
+    def test_decode_error_in_mapped_elf(self):
+        # pylint: disable=protected-access
+        view_sections = elf_reader.Elf.view_sections
+
+        # Read the test ELF's sections, one of which is not valid UTF-8.
+        def view_test_sections(elf, unused_name):
+            return view_sections(elf, r'\.test_section_\d')
+
+        with mock.patch.object(elf_reader.Elf, 'view_sections',
+                               view_test_sections):
+            with open(TEST_ELF_PATH, 'rb') as elf:
+                with self.assertRaises(UnicodeDecodeError):
+                    list(database._read_strings_from_elf(elf))
+
+
+REMOVED_DATABASE = """\
+00000001,2019-06-10,"Removed in June"
+00000001,          ,"Still present"
+00000002,2019-06-10,"Hello %s!"
+00000003,2020-01-01,"Removed twice"
+"""
+
+REMOVED_LATER_DATABASE = """\
+00000001,2019-07-10,"Removed in June"
+00000003,2019-01-01,"Removed twice"
+00000004,          ,"Hello %s!"
+"""
+
+
+class WriteDatabaseStreamingTest(unittest.TestCase):
+    """Tests creating databases with an external sort."""
+    def setUp(self):
+        super().setUp()
+        self._dir = tempfile.mkdtemp()
+        self.paths = []
+
+        for i, strings in enumerate(STRING_SETS):
+            self.paths.append(
+                self._write(f'db_{i}.csv',
+                            tokens.Database.from_strings(strings)))
+
+        for name, csv_db in (('removed.csv', REMOVED_DATABASE),
+                             ('removed_later.csv', REMOVED_LATER_DATABASE)):
+            self.paths.append(
+                self._write(
+                    name,
+                    tokens.Database(tokens.parse_csv(io.StringIO(csv_db)))))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+        super().tearDown()
+
+    def _write(self, name, db):
+        path = os.path.join(self._dir, name)
+        with open(path, 'wb') as fd:
+            tokens.write_csv(db, fd)
+        return path
+
+    def _expected(self, writer, include=(), exclude=()):
+        db = tokens.Database.merged(*database.load_token_databases(self.paths))
+        db.filter(include, exclude)
+
+        with io.BytesIO() as fd:
+            writer(db, fd)
+            return fd.getvalue()
+
+    def _streamed(self, **kwargs):
+        with io.BytesIO() as fd:
+            count = database.write_database_streaming(self.paths, fd, **kwargs)
+            return count, fd.getvalue()
+
+    def test_csv_matches_in_memory(self):
+        for chunk_size in (1, 2, 5, 1000):
+            count, output = self._streamed(chunk_size=chunk_size)
+            self.assertEqual(output, self._expected(tokens.write_csv))
+            self.assertEqual(count, len(output.splitlines()))
+
+        self.assertIn(b'00000001,2019-07-10,"Removed in June"', output)
+        self.assertIn(b'00000003,2020-01-01,"Removed twice"', output)
+
+    def test_binary_matches_in_memory(self):
+        for chunk_size in (1, 3, 1000):
+            _, output = self._streamed(output_type='binary',
+                                       chunk_size=chunk_size)
+            self.assertEqual(output, self._expected(tokens.write_binary))
+
+    def test_binary_with_string_offsets_matches_in_memory(self):
+        _, output = self._streamed(output_type='binary',
+                                   string_offsets=True,
+                                   chunk_size=2)
+        self.assertEqual(
+            output,
+            self._expected(lambda db, fd: tokens.write_binary(db, fd, True)))
+
+    def test_filter(self):
+        _, output = self._streamed(include=['Hello', 'Removed'],
+                                   exclude=['twice'],
+                                   chunk_size=2)
+        self.assertEqual(
+            output,
+            self._expected(tokens.write_csv, ['Hello', 'Removed'], ['twice']))
+
+    def test_parallel(self):
+        _, output = self._streamed(chunk_size=2, jobs=2)
+        self.assertEqual(output, self._expected(tokens.write_csv))
+
+    def test_empty(self):
+        with io.BytesIO() as fd:
+            self.assertEqual(database.write_database_streaming([], fd), 0)
+            self.assertEqual(fd.getvalue(), b'')
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            self._streamed(output_type='json')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Micro-benchmarks for the decoder module.
+
+The integer benchmarks decode the varints in varint_decoding_test_data.py, which
+cover one- to ten-byte varints. Run this script directly to print the
+throughput of each benchmark:
+
+  python decoder_benchmark.py --repeat 100
+"""
+
+import argparse
+import functools
+import time
+from typing import Callable, List, Optional, Tuple
+
+from pw_tokenizer import decoder
+import varint_decoding_test_data
+
+
+def _original_decode_varint(encoded: bytes,
+                            offset: int) -> Tuple[Optional[int], int]:
+    """The original byte-by-byte varint loop, for comparison."""
+    end = min(len(encoded), offset + 10)
+    result = 0
+    shift = 0
+
+    for index in range(offset, end):
+        byte = encoded[index]
+        result |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return decoder.zigzag_decode(result), index + 1
+
+        shift += 7
+
+    return None, end
+
+
+def _run(name: str,
+         count: int,
+         function: Callable[[], object],
+         repeat: int = 3) -> float:
+    """Runs the function several times and reports the best throughput."""
+    elapsed = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    print(f'{name:40} {count / elapsed:14,.0f} varints/s')
+    return elapsed
+
+
+def varints_by_size(repeat: int) -> List[Tuple[int, List[bytes]]]:
+    """Groups the encoded test data varints by their size in bytes."""
+    sizes: dict = {}
+
+    for *_, encoded in varint_decoding_test_data.TEST_DATA:
+        sizes.setdefault(len(encoded), []).append(encoded)
+
+    return [(size, encoded * repeat)
+            for size, encoded in sorted(sizes.items())]
+
+
+def _decode_all(decode: Callable[[bytes, int], Tuple[Optional[int], int]],
+                varints: List[bytes]) -> list:
+    return [decode(varint, 0) for varint in varints]
+
+
+def benchmark_varints(repeat: int) -> None:
+    """Compares the original loop to decode_varint for each varint size."""
+    for size, varints in varints_by_size(repeat):
+        print(f'{size}-byte varints ({len(varints):,})')
+        _run('  original loop', len(varints),
+             functools.partial(_decode_all, _original_decode_varint, varints))
+        _run('  decode_varint', len(varints),
+             functools.partial(_decode_all, decoder.decode_varint, varints))
+
+
+def benchmark_arguments(repeat: int) -> None:
+    """Measures decoding integer arguments with FormatSpec and FormatString."""
+    test_data = varint_decoding_test_data.TEST_DATA * repeat
+    signed = [(decoder.FormatSpec.from_string(spec), encoded)
+              for spec, _, _, _, encoded in test_data]
+    unsigned = [(decoder.FormatSpec.from_string(spec), encoded)
+                for _, _, spec, _, encoded in test_data]
+
+    _run('FormatSpec.decode (signed)', len(signed),
+         lambda: [spec.decode(encoded) for spec, encoded in signed])
+    _run('FormatSpec.decode (unsigned)', len(unsigned),
+         lambda: [spec.decode(encoded) for spec, encoded in unsigned])
+
+    # Decode the corpus as messages with four 64-bit integer arguments.
+    fmt = decoder.FormatString('%lld %llu %lld %llu')
+    encoded = [item[4] for item in test_data]
+    messages = [b''.join(encoded[i:i + 4]) for i in range(0, len(encoded), 4)]
+
+    _run('FormatString.decode (4 arguments)',
+         len(messages) * 4,
+         lambda: [fmt.decode(message) for message in messages])
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=100,
+        help=('Number of copies of the varint test data to decode '
+              '(default: 100)'))
+    return parser.parse_args()
+
+
+def _main(args: argparse.Namespace) -> None:
+    benchmark_varints(args.repeat)
+    benchmark_arguments(args.repeat)
+
+
+if __name__ == '__main__':
+    _main(_parse_args())
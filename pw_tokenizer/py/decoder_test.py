@@ -14,6 +14,7 @@
 # the License.
 """Tests the tokenized string decoder module."""
 
+import concurrent.futures
 import unittest
 
 import tokenized_string_decoding_test_data as tokenized_string
@@ -85,6 +86,108 @@ class TestIntegerDecoding(unittest.TestCase):
                 decoder.FormatSpec.from_string(unsigned_spec).decode(
                     bytearray(encoded)).value)
 
+    def test_decode_varint_generated_data(self):
+        for _, signed, _, _, encoded in varint_decoding_test_data.TEST_DATA:
+            data = memoryview(b'\xff' + encoded + b'\x00')
+            value, end = decoder.decode_varint(data, 1)
+            self.assertEqual(int(signed), decoder.zigzag_decode(value))
+            self.assertEqual(end, len(encoded) + 1)
+
+    def test_decode_varint_unterminated(self):
+        self.assertEqual(decoder.decode_varint(b'\x80'), (None, 1))
+        self.assertEqual(decoder.decode_varint(b'\x01\xff\xff', 1), (None, 3))
+        self.assertEqual(decoder.decode_varint(b'\xff' * 11), (None, 10))
+        self.assertEqual(decoder.decode_varint(b'\xff' * 9 + b'\x01'),
+                         (2**64 - 1, 10))
+
+    def test_unterminated_integer_args(self):
+        for spec in '%d', '%u', '%llu', '%c':
+            arg = decoder.FormatSpec.from_string(spec).decode(b'\x80\x80')
+            self.assertIsNone(arg.value)
+            self.assertEqual(arg.raw_data, b'\x80\x80')
+            self.assertEqual(arg.status, decoder.DecodedArg.DECODE_ERROR)
+
+
+class TestDecodeAtOffset(unittest.TestCase):
+    """Tests decoding arguments from an offset into a buffer."""
+    def test_decode_at_matches_decode(self):
+        data = b'\xff\xff\x03\x83hi!\x00\x00\x80?\x82\x01'
+
+        for spec, offset, value, size in (
+            ('%d', 2, -2, 1),
+            ('%s', 3, 'hi!', 4),
+            ('%f', 7, 1.0, 4),
+            ('%c', 11, 'A', 2),
+            ('%%', 3, (), 0),
+        ):
+            fmt = decoder.FormatSpec.from_string(spec)
+            arg = fmt.decode_at(memoryview(data), offset)
+            self.assertEqual(arg.value, value)
+            self.assertEqual(arg.raw_data, data[offset:offset + size])
+            self.assertIs(type(arg.raw_data), bytes)
+            self.assertEqual(arg.value, fmt.decode(data[offset:]).value)
+
+    def test_missing_at_end(self):
+        for spec in '%d', '%u', '%s', '%f', '%c':
+            arg = decoder.FormatSpec.from_string(spec).decode_at(b'\1\2', 2)
+            self.assertEqual(arg.status, decoder.DecodedArg.MISSING)
+
+    def test_unterminated_varint_stops_at_ten_bytes(self):
+        arg = decoder.FormatSpec.from_string('%lld').decode_at(
+            b'\0' + b'\xff' * 12, 1)
+        self.assertEqual(arg.status, decoder.DecodedArg.DECODE_ERROR)
+        self.assertEqual(arg.raw_data, b'\xff' * 10)
+
+    def test_format_string_remaining_data(self):
+        fmt = decoder.FormatString('%d %s')
+
+        for data in (b'\x02\x01a\x99\x98', bytearray(b'\x02\x01a\x99\x98')):
+            args, remaining = fmt.decode(data)
+            self.assertEqual([arg.value for arg in args], [1, 'a'])
+            self.assertEqual(remaining, b'\x99\x98')
+            self.assertIs(type(remaining), bytes)
+
+        # The view of a bytearray is released, so it can be resized.
+        data.append(0)
+
+
+class TestFormatStringThreadSafety(unittest.TestCase):
+    """Tests using one FormatString from multiple threads."""
+    def test_format_does_not_modify_format_string(self):
+        # pylint: disable=protected-access
+        fmt = decoder.FormatString('%d and %s')
+        segments = fmt._segments
+
+        self.assertEqual(fmt.format(b'\x02\x01a').value, '1 and a')
+        self.assertEqual(fmt._segments, segments)
+
+    def test_concurrent_format(self):
+        fmt = decoder.FormatString('%d is %s')
+        values = list(range(-500, 500))
+
+        def format_all(value):
+            encoded = varint(value) + b'\x03abc'
+            return [fmt.format(encoded).value for _ in range(20)]
+
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(format_all, values))
+
+        for value, formatted in zip(values, results):
+            self.assertEqual(formatted, [f'{value} is abc'] * 20)
+
+
+def varint(value):
+    """ZigZag encodes a small integer as a varint."""
+    zigzag = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+
+    while zigzag > 0x7f:
+        encoded.append(zigzag & 0x7f | 0x80)
+        zigzag >>= 7
+
+    encoded.append(zigzag)
+    return bytes(encoded)
+
 
 if __name__ == '__main__':
     unittest.main()
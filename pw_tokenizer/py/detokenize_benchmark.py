@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Micro-benchmarks for the detokenize module.
+
+Run this script directly to print the throughput of each benchmark:
+
+  python detokenize_benchmark.py --messages 100000 --workers 1 2 4 8
+"""
+
+import argparse
+import base64
+import binascii
+import functools
+import io
+import random
+import re
+import struct
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from pw_tokenizer import detokenize, tokens
+
+_BASE64_MESSAGE = re.compile(
+    br'\$(?:[A-Za-z0-9+/\-_]{4})*'
+    br'(?:[A-Za-z0-9+/\-_]{3}=|[A-Za-z0-9+/\-_]{2}==)?')
+
+
+def encode_int(value: int) -> bytes:
+    """Encodes an integer as a ZigZag varint, as pw_tokenizer does."""
+    zigzag = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+
+    while True:
+        byte = zigzag & 0x7f
+        zigzag >>= 7
+        if not zigzag:
+            encoded.append(byte)
+            return bytes(encoded)
+        encoded.append(byte | 0x80)
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode()
+    return bytes([len(data)]) + data
+
+
+def _sensor_args(rng: random.Random) -> bytes:
+    status = rng.choice(['OK', 'TIMEOUT', 'UNAVAILABLE'])
+    return (encode_int(rng.randint(0, 16)) +
+            encode_int(rng.randint(-9999, 9999)) + encode_string(status))
+
+
+def _task_args(rng: random.Random) -> bytes:
+    task = rng.choice(['idle', 'radio', 'ui'])
+    return encode_string(task) + encode_int(rng.getrandbits(40))
+
+
+# Format strings and functions that generate encoded arguments for them.
+_FORMAT_STRINGS: Tuple[Tuple[str, Callable[[random.Random], bytes]], ...] = (
+    ('Heartbeat', lambda rng: b''),
+    ('Battery at %d%%', lambda rng: encode_int(rng.randint(0, 100))),
+    ('Sensor %u read %d (status %s)', _sensor_args),
+    ('Temperature: %f C', lambda rng: struct.pack('<f', rng.uniform(-40, 85))),
+    ('Task %s took %llu us', _task_args),
+)
+
+
+def generate_messages(count: int,
+                      seed: int = 65599
+                      ) -> Tuple[tokens.Database, List[bytes]]:
+    """Generates a database and encoded messages that use its strings."""
+    rng = random.Random(seed)
+    db = tokens.Database.from_strings(fmt for fmt, _ in _FORMAT_STRINGS)
+
+    messages = []
+    for _ in range(count):
+        fmt, encode_args = rng.choice(_FORMAT_STRINGS)
+        messages.append(
+            struct.pack('<I', tokens.default_hash(fmt)) + encode_args(rng))
+
+    return db, messages
+
+
+def _run(name: str,
+         count: int,
+         function: Callable[[], object],
+         repeat: int = 3) -> float:
+    """Runs the function several times and reports the best throughput."""
+    elapsed = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    print(f'{name:40} {count / elapsed:14,.0f} messages/s')
+    return elapsed
+
+
+def benchmark_detokenize(db: tokens.Database, messages: List[bytes]) -> None:
+    """Compares detokenizing messages one at a time and in a batch."""
+    detokenizer = detokenize.Detokenizer(db)
+
+    def one_at_a_time(detok: detokenize.Detokenizer) -> List[str]:
+        results = [detok.detokenize(msg) for msg in messages]
+        return [str(result) for result in results]
+
+    def batch() -> List[str]:
+        results = detokenizer.detokenize_many(messages)
+        return [str(result) for result in results]
+
+    _run('detokenize', len(messages),
+         functools.partial(one_at_a_time, detokenizer))
+    _run('detokenize_many', len(messages), batch)
+
+    cached = detokenize.Detokenizer(db, result_cache_size=len(messages))
+    _run('detokenize (result cache)', len(messages),
+         functools.partial(one_at_a_time, cached))
+    print(f'  {cached.result_cache_stats()}')
+
+
+def benchmark_lazy_formatting(db: tokens.Database,
+                              messages: List[bytes]) -> None:
+    """Compares checking results with and without formatting the strings."""
+    detokenizer = detokenize.Detokenizer(db)
+
+    def check(function: Callable[[detokenize.DetokenizedString], object]):
+        results = detokenizer.detokenize_many(messages)
+        return [function(result) for result in results]
+
+    _run('detokenize_many (ok only)', len(messages),
+         functools.partial(check, detokenize.DetokenizedString.ok))
+    _run('detokenize_many (str)', len(messages), functools.partial(check, str))
+    _run('detokenize_many (all matches)', len(messages),
+         functools.partial(check, detokenize.DetokenizedString.matches))
+
+
+def benchmark_concurrent(db: tokens.Database, messages: List[bytes],
+                         workers: Sequence[int]) -> None:
+    """Measures one shared Detokenizer with different thread pool sizes."""
+    detokenizer = detokenize.Detokenizer(db)
+
+    for count in workers:
+        concurrently = functools.partial(detokenizer.detokenize_concurrently,
+                                         messages, count)
+        _run(f'detokenize_concurrently ({count} workers)', len(messages),
+             concurrently)
+
+
+def _hdlc_escape(message: bytes) -> bytes:
+    return message.replace(b'\x7d', b'\x7d\x5d').replace(b'\x7e', b'\x7d\x5e')
+
+
+def benchmark_framing(db: tokens.Database, messages: List[bytes]) -> None:
+    """Compares detokenizing Base64 and framed binary streams."""
+    detokenizer = detokenize.Detokenizer(db)
+
+    encodings: Dict[str, bytes] = {}
+    encodings['Base64'] = b''.join(b'$' + base64.b64encode(msg) + b'\n'
+                                   for msg in messages)
+    encodings['length-prefixed'] = b''.join(
+        bytes([len(msg)]) + msg for msg in messages)
+    encodings['HDLC'] = b'\x7e' + b'\x7e'.join(
+        _hdlc_escape(msg) for msg in messages) + b'\x7e'
+
+    for name, data in encodings.items():
+        print(f'  {name} stream: {len(data):,} bytes')
+
+    def live() -> None:
+        detokenize.detokenize_base64_live(detokenizer,
+                                          io.BytesIO(encodings['Base64']),
+                                          io.BytesIO())
+
+    def to_file() -> None:
+        detokenize.detokenize_base64_to_file(detokenizer, encodings['Base64'],
+                                             io.BytesIO())
+
+    def binary(encoding: str, framing: str) -> None:
+        detokenize.detokenize_binary(detokenizer,
+                                     io.BytesIO(encodings[encoding]),
+                                     io.BytesIO(), framing)
+
+    _run('detokenize_base64_live', len(messages), live)
+    _run('detokenize_base64_to_file', len(messages), to_file)
+    _run('detokenize_binary (length-prefixed)', len(messages),
+         functools.partial(binary, 'length-prefixed', 'length'))
+    _run('detokenize_binary (HDLC)', len(messages),
+         functools.partial(binary, 'HDLC', 'hdlc'))
+
+
+def _recursive_detokenize_base64(detokenizer: detokenize.Detokenizer,
+                                 data: bytes, recursion: int) -> bytes:
+    """The original recursive nested Base64 expansion, for comparison."""
+    def transform(match) -> bytes:
+        original = match.group(0)
+        try:
+            result = detokenizer.detokenize(
+                base64.b64decode(original[1:], validate=True))
+        except binascii.Error:
+            return original
+
+        if not result.matches():
+            return original
+
+        text = str(result).encode()
+        if recursion > 0 and original != text:
+            return _recursive_detokenize_base64(detokenizer, text,
+                                                recursion - 1)
+        return text
+
+    return _BASE64_MESSAGE.sub(transform, data)
+
+
+def generate_nested_messages(depth: int,
+                             copies: int) -> Tuple[tokens.Database, bytes]:
+    """Generates a message with depth levels of nested Base64 messages.
+
+    Each level contains copies of the next level's message, so the fully
+    expanded message contains copies**(depth - 1) innermost strings.
+    """
+    strings = ['Innermost value %d']
+    inner = b'$' + base64.b64encode(
+        struct.pack('<I', tokens.default_hash(strings[-1])) + encode_int(7))
+
+    for level in range(1, depth):
+        strings.append(f'Level {level}: ' +
+                       ', '.join([inner.decode()] * copies))
+        inner = b'$' + base64.b64encode(
+            struct.pack('<I', tokens.default_hash(strings[-1])))
+
+    return tokens.Database.from_strings(strings), b'Log: ' + inner + b'\n'
+
+
+def benchmark_nested_base64(depth: int, copies: int, count: int) -> None:
+    """Compares the recursive and iterative nested Base64 expansions."""
+    db, message = generate_nested_messages(depth, copies)
+    detokenizer = detokenize.Detokenizer(db)
+    data = message * count
+
+    expected = _recursive_detokenize_base64(detokenizer, data, depth)
+    assert detokenize.detokenize_base64(detokenizer, data, recursion=depth) \
+        == expected, 'Nested Base64 results differ!'
+
+    _run(f'recursive nested Base64 ({depth} deep)', count,
+         lambda: _recursive_detokenize_base64(detokenizer, data, depth))
+
+    # Expand each message from scratch to exclude caching between messages.
+    def expand_uncached() -> None:
+        # pylint: disable=protected-access
+        for _ in range(count):
+            expander = detokenize._NestedBase64Expander(detokenizer, b'$')
+            expander.expand(message[5:-1], depth)
+
+    _run(f'iterative nested Base64 ({depth} deep)', count, expand_uncached)
+    detokenize_base64 = functools.partial(detokenize.detokenize_base64,
+                                          detokenizer,
+                                          data,
+                                          recursion=depth)
+    _run(f'detokenize_base64 ({depth} deep)', count, detokenize_base64)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--messages',
+        type=int,
+        default=100000,
+        help='Number of messages to detokenize (default: 100000)')
+    parser.add_argument('--workers',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Thread pool sizes to compare (default: 1 2 4 8)')
+    parser.add_argument(
+        '--nesting',
+        type=int,
+        nargs=2,
+        default=[8, 2],
+        metavar=('DEPTH', 'COPIES'),
+        help=('Depth of nested Base64 messages and the number of nested '
+              'messages in each level (default: 8 2)'))
+    return parser.parse_args()
+
+
+def _main(args: argparse.Namespace) -> None:
+    db, messages = generate_messages(args.messages)
+    benchmark_detokenize(db, messages)
+    benchmark_lazy_formatting(db, messages)
+    benchmark_concurrent(db, messages, args.workers)
+    benchmark_framing(db, messages)
+    benchmark_nested_base64(*args.nesting, max(args.messages // 100, 1))
+
+
+if __name__ == '__main__':
+    _main(_parse_args())
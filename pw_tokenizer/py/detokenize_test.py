@@ -14,16 +14,22 @@
 # the License.
 """Tests for detokenize."""
 
+import asyncio
 import base64
 import datetime as dt
 import io
+import json
 import os
 import struct
+import subprocess
+import sys
 import tempfile
+import time
 import unittest
 from unittest import mock
 
 from pw_tokenizer import database
+from pw_tokenizer import decoder
 from pw_tokenizer import detokenize
 from pw_tokenizer import elf_reader
 from pw_tokenizer import tokens
@@ -309,6 +315,23 @@ class DetokenizeTest(unittest.TestCase):
         self.assertEqual(expected_tokens,
                          frozenset(detok.database.token_to_entries.keys()))
 
+    def test_create_detokenizer_with_mapped_database(self):
+        db = database.load_token_database(
+            io.BytesIO(ELF_WITH_TOKENIZER_SECTIONS))
+
+        with tempfile.NamedTemporaryFile() as binary_file:
+            tokens.write_binary(db, binary_file)
+            binary_file.flush()
+
+            with tokens.MappedDatabase(binary_file.name) as mapped:
+                detok = detokenize.Detokenizer(mapped)
+                self.assertIs(detok.database, mapped)
+                self.assertEqual(
+                    frozenset(db.token_to_entries),
+                    frozenset(detok.database.token_to_entries.keys()))
+                self.assertEqual(str(detok.detokenize(JELLO_WORLD_TOKEN)),
+                                 'Jello, world!')
+
 
 class DetokenizeWithCollisions(unittest.TestCase):
     """Tests collision resolution."""
@@ -382,6 +405,307 @@ class DetokenizeWithCollisions(unittest.TestCase):
         self.assertEqual('#0 -1', str(unambiguous))
         self.assertIn('#0 -1', repr(unambiguous))
 
+    def test_collision_formats_lazily(self):
+        with mock.patch.object(decoder.FormatString,
+                               'format_decoded',
+                               autospec=True,
+                               side_effect=decoder.FormatString.format_decoded
+                               ) as format_decoded:
+            result = self.detok.detokenize(b'\xad\xba\0\0\x01#\x00\x01')
+            self.assertTrue(result.ok())
+            self.assertEqual(result.token, 0xbaad)
+            self.assertEqual(format_decoded.call_count, 0)
+
+            self.assertEqual('#0 -1', str(result))
+            self.assertEqual('#0 -1', str(result))
+            self.assertEqual(format_decoded.call_count, 1)
+
+            self.assertEqual(len(result.matches()), 7)
+            self.assertEqual(format_decoded.call_count, 7)
+
+
+class DetokenizeManyTest(unittest.TestCase):
+    """Tests detokenizing messages in batches."""
+    MESSAGES = (
+        b'\xad\xba\0\0',
+        b'\1\0\0\0\x83hi',
+        b'\xab\xcd\0\0\x02\x03Two\x66',
+        b'\xad\xba\0\0\x02Hi',
+        b'\xab\xcd',
+        b'',
+        b'\x99\x99\0\0',
+        b'\xab\xcd\0\0\x02\x03Two\x66',
+        b'\xab\xcd\0\0\x02\x03',
+        b'\xad\xba\0\0\x01#\x00\x01',
+    )
+
+    def setUp(self):
+        super().setUp()
+        db = tokens.Database([
+            tokens.TokenizedStringEntry(0xbaad, 'REMOVED',
+                                        dt.datetime(9, 1, 1)),
+            tokens.TokenizedStringEntry(0xbaad, 'C: %s'),
+            tokens.TokenizedStringEntry(0xbaad, '%s%u %d'),
+            tokens.TokenizedStringEntry(1, '%s'),
+            tokens.TokenizedStringEntry(1, '%d'),
+            tokens.TokenizedStringEntry(0xcdab, '%02d %s %c%%'),
+        ])
+        self.detok = detokenize.Detokenizer(db, show_errors=True)
+
+    def test_matches_detokenize(self):
+        results = self.detok.detokenize_many(self.MESSAGES)
+        self.assertEqual(len(results), len(self.MESSAGES))
+
+        for message, result in zip(self.MESSAGES, results):
+            expected = self.detok.detokenize(message)
+            self.assertEqual(result.encoded_message, message)
+            self.assertEqual(result.token, expected.token)
+            self.assertEqual(result.ok(), expected.ok())
+            self.assertEqual(str(result), str(expected))
+            self.assertEqual([m.value for m in result.matches()],
+                             [m.value for m in expected.matches()])
+
+    def test_looks_up_each_token_once(self):
+        with mock.patch.object(self.detok, 'lookup',
+                               wraps=self.detok.lookup) as lookup:
+            self.detok.detokenize_many(self.MESSAGES)
+
+        self.assertCountEqual([call[0][0] for call in lookup.call_args_list],
+                              [0xbaad, 1, 0xcdab, 0x9999])
+
+    def test_identical_messages_share_results(self):
+        results = self.detok.detokenize_many(self.MESSAGES)
+        self.assertIs(results[2], results[7])
+        self.assertIsNot(results[2], results[8])
+
+    def test_single_candidate_failure(self):
+        result, = self.detok.detokenize_many([b'\xab\xcd\0\0\x02\x03'])
+        self.assertFalse(result.ok())
+        self.assertEqual(result.successes, [])
+        self.assertEqual(len(result.failures), 1)
+
+    def test_empty(self):
+        self.assertEqual(self.detok.detokenize_many([]), [])
+
+
+class DetokenizeConcurrentlyTest(unittest.TestCase):
+    """Tests sharing a Detokenizer between threads."""
+    def setUp(self):
+        super().setUp()
+        db = tokens.Database([
+            tokens.TokenizedStringEntry(1, 'Number %d'),
+            tokens.TokenizedStringEntry(2, '%s and %u'),
+        ])
+        # Use a small cache so threads evict each other's format strings.
+        self.detok = detokenize.Detokenizer(db, format_cache_size=1)
+        self.messages = [
+            (b'\1\0\0\0' if i % 3 else b'\2\0\0\0\x02hi') + bytes([i % 128])
+            for i in range(5000)
+        ]
+
+    def test_matches_serial(self):
+        expected = [str(self.detok.detokenize(m)) for m in self.messages]
+
+        for workers in 1, 4:
+            for batch_size in 1, 7, 10000:
+                results = self.detok.detokenize_concurrently(
+                    self.messages, workers, batch_size)
+                self.assertEqual([str(r) for r in results], expected)
+
+    def test_generator_input(self):
+        results = self.detok.detokenize_concurrently(
+            (m for m in self.messages[:10]), batch_size=3)
+        self.assertEqual([r.encoded_message for r in results],
+                         self.messages[:10])
+
+    def test_empty(self):
+        self.assertEqual(self.detok.detokenize_concurrently([]), [])
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            self.detok.detokenize_concurrently(self.messages, batch_size=0)
+
+    def test_large_database_without_prebuilt_index(self):
+        # The Database's token index is not built before the Detokenizer is
+        # created, so threads would race to build it if it were built lazily.
+        db = tokens.Database(
+            tokens.TokenizedStringEntry(token, 'String %d')
+            for token in range(1, 300001))
+        detok = detokenize.Detokenizer(db)
+        messages = [(i * 37 % 300000 + 1).to_bytes(4, 'little') + b'\2'
+                    for i in range(8000)]
+
+        results = detok.detokenize_concurrently(messages, 8, batch_size=16)
+        self.assertEqual([str(r) for r in results], ['String 1'] * 8000)
+
+
+class DetokenizerResultCacheTest(unittest.TestCase):
+    """Tests the optional LRU cache of detokenized messages."""
+    DATABASE = tokens.Database([
+        tokens.TokenizedStringEntry(1, 'One %d'),
+        tokens.TokenizedStringEntry(2, 'Two'),
+        tokens.TokenizedStringEntry(3, 'Three %s'),
+    ])
+
+    def test_disabled_by_default(self):
+        detok = detokenize.Detokenizer(self.DATABASE)
+        first = detok.detokenize(b'\1\0\0\0\2')
+        self.assertIsNot(first, detok.detokenize(b'\1\0\0\0\2'))
+        self.assertEqual(detok.result_cache_stats(),
+                         detokenize.CacheStats(0, 0, 0, 0, 0))
+
+    def test_hits_return_same_result(self):
+        detok = detokenize.Detokenizer(self.DATABASE, result_cache_size=4)
+        first = detok.detokenize(b'\1\0\0\0\2')
+        self.assertIs(first, detok.detokenize(bytearray(b'\1\0\0\0\2')))
+        self.assertEqual(str(first), 'One 1')
+
+        stats = detok.result_cache_stats()
+        self.assertEqual((stats.hits, stats.misses, stats.size), (1, 1, 1))
+
+    def test_evicts_least_recently_used(self):
+        detok = detokenize.Detokenizer(self.DATABASE, result_cache_size=2)
+        one = detok.detokenize(b'\1\0\0\0\2')
+        detok.detokenize(b'\2\0\0\0')
+        detok.detokenize(b'\1\0\0\0\2')  # Now most recently used
+        detok.detokenize(b'\3\0\0\0\1a')  # Evicts token 2
+
+        self.assertIs(one, detok.detokenize(b'\1\0\0\0\2'))
+        detok.detokenize(b'\2\0\0\0')
+
+        self.assertEqual(
+            detok.result_cache_stats(),
+            detokenize.CacheStats(hits=2,
+                                  misses=4,
+                                  evictions=2,
+                                  size=2,
+                                  max_size=2))
+
+    def test_detokenize_many_uses_cache(self):
+        detok = detokenize.Detokenizer(self.DATABASE, result_cache_size=8)
+        single = detok.detokenize(b'\2\0\0\0')
+        results = detok.detokenize_many(
+            [b'\2\0\0\0', b'\1\0\0\0\4', b'\1\0\0\0\4'])
+
+        self.assertIs(results[0], single)
+        self.assertEqual([str(r) for r in results], ['Two', 'One 2', 'One 2'])
+        self.assertEqual(detok.result_cache_stats().hits, 1)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            detokenize.Detokenizer(self.DATABASE, result_cache_size=-1)
+
+
+class DetokenizerFormatCacheTest(unittest.TestCase):
+    """Tests the bounded caches used by Detokenizer.lookup."""
+    DATABASE = tokens.Database([
+        tokens.TokenizedStringEntry(1, 'One %d'),
+        tokens.TokenizedStringEntry(2, 'Two'),
+        tokens.TokenizedStringEntry(3, 'Three %s'),
+    ])
+
+    def test_evicts_least_recently_used(self):
+        detok = detokenize.Detokenizer(self.DATABASE, format_cache_size=2)
+        one = detok.lookup(1)
+        detok.lookup(2)
+        self.assertIs(one, detok.lookup(1))
+        detok.lookup(3)  # Evicts token 2
+
+        self.assertEqual(
+            detok.format_cache_stats(),
+            detokenize.CacheStats(hits=1,
+                                  misses=3,
+                                  evictions=1,
+                                  size=2,
+                                  max_size=2))
+        self.assertEqual(str(detok.detokenize(b'\2\0\0\0')), 'Two')
+        self.assertEqual(detok.format_cache_stats().evictions, 2)
+
+    def test_unknown_tokens_cached_separately(self):
+        detok = detokenize.Detokenizer(self.DATABASE,
+                                       format_cache_size=2,
+                                       unknown_token_cache_size=3)
+        detok.lookup(1)
+        detok.lookup(2)
+
+        for token in range(100, 110):
+            self.assertEqual(detok.lookup(token), [])
+
+        self.assertEqual(detok.lookup(109), [])
+        self.assertEqual(detok.format_cache_stats().size, 2)
+        self.assertEqual(detok.format_cache_stats().evictions, 0)
+
+        stats = detok.unknown_token_cache_stats()
+        self.assertEqual((stats.hits, stats.evictions, stats.size), (1, 7, 3))
+
+    def test_disable_caches(self):
+        detok = detokenize.Detokenizer(self.DATABASE,
+                                       format_cache_size=0,
+                                       unknown_token_cache_size=0)
+        detok.prewarm().join()
+
+        for _ in range(2):
+            self.assertEqual(str(detok.detokenize(b'\2\0\0\0')), 'Two')
+            self.assertFalse(detok.detokenize(b'\xff\0\0\0').ok())
+
+        self.assertEqual(
+            detok.format_cache_stats(),
+            detokenize.CacheStats(hits=0,
+                                  misses=4,
+                                  evictions=0,
+                                  size=0,
+                                  max_size=0))
+        self.assertEqual(detok.unknown_token_cache_stats().size, 0)
+
+    def test_negative_cache_size(self):
+        with self.assertRaises(ValueError):
+            detokenize.Detokenizer(self.DATABASE, format_cache_size=-1)
+
+        with self.assertRaises(ValueError):
+            detokenize.Detokenizer(self.DATABASE, unknown_token_cache_size=-1)
+
+    def test_unknown_tokens_not_added_to_database(self):
+        detok = detokenize.Detokenizer(self.DATABASE)
+        self.assertFalse(detok.detokenize(b'\xff\0\0\0').ok())
+        self.assertNotIn(0xff, self.DATABASE.token_to_entries)
+
+    def test_prewarm(self):
+        detok = detokenize.Detokenizer(self.DATABASE)
+        detok.prewarm().join()
+
+        self.assertEqual(detok.format_cache_stats().size, 3)
+        self.assertEqual(str(detok.detokenize(b'\3\0\0\0\2hi')), 'Three hi')
+        self.assertEqual(detok.format_cache_stats().misses, 0)
+
+    def test_prewarm_stops_when_full(self):
+        detok = detokenize.Detokenizer(self.DATABASE, format_cache_size=2)
+        first = detok.lookup(3)
+        detok.prewarm().join()
+
+        stats = detok.format_cache_stats()
+        self.assertEqual((stats.size, stats.evictions), (2, 0))
+        self.assertIs(first, detok.lookup(3))
+
+    def test_prewarm_in_constructor(self):
+        with mock.patch.object(detokenize.Detokenizer, 'prewarm') as prewarm:
+            detokenize.Detokenizer(self.DATABASE, prewarm=True)
+
+        prewarm.assert_called_once_with()
+
+    def test_lookup_while_prewarming(self):
+        entries = [
+            tokens.TokenizedStringEntry(token, 'String %d')
+            for token in range(1, 100001)
+        ]
+        detok = detokenize.Detokenizer(tokens.Database(entries), prewarm=True)
+        self.assertEqual(str(detok.detokenize(b'\x50\xc3\0\0\2')), 'String 1')
+
+        # Replace the database with one whose index has not been built.
+        detok.database = tokens.Database(entries)
+        thread = detok.prewarm()
+        self.assertEqual(str(detok.detokenize(b'\xa0\x86\1\0\4')), 'String 2')
+        thread.join()
+
 
 @mock.patch('os.path.getmtime')
 class AutoUpdatingDetokenizerTest(unittest.TestCase):
@@ -438,6 +762,96 @@ class AutoUpdatingDetokenizerTest(unittest.TestCase):
             self.assertFalse(detok.detokenize(JELLO_WORLD_TOKEN).ok())
 
 
+def _wait_for(condition, timeout_s=5.0):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+@mock.patch('os.path.getmtime')
+class AutoUpdatingDetokenizerBackgroundTest(unittest.TestCase):
+    """Tests reloading databases in a background thread."""
+    def setUp(self):
+        super().setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+        super().tearDown()
+
+    def _write_database(self):
+        with open(self.path, 'wb') as fd:
+            tokens.write_binary(
+                database.load_token_database(
+                    io.BytesIO(ELF_WITH_TOKENIZER_SECTIONS)), fd)
+
+    def test_reloads_in_background(self, mock_getmtime):
+        mock_getmtime.return_value = 100
+        detok = detokenize.AutoUpdatingDetokenizer(self.path,
+                                                   min_poll_period_s=0.001,
+                                                   background_reload=True)
+        with detok:
+            self.assertFalse(detok.detokenize(JELLO_WORLD_TOKEN).ok())
+
+            self._write_database()
+            mock_getmtime.return_value = 200
+
+            self.assertTrue(
+                _wait_for(lambda: detok.detokenize(JELLO_WORLD_TOKEN).ok()))
+
+    def test_detokenize_does_not_check_paths(self, mock_getmtime):
+        mock_getmtime.return_value = 100
+
+        detok = detokenize.AutoUpdatingDetokenizer(self.path,
+                                                   min_poll_period_s=3600,
+                                                   background_reload=True)
+        calls = mock_getmtime.call_count
+
+        with mock.patch.object(detok, '_load') as load:
+            for _ in range(10):
+                detok.detokenize(JELLO_WORLD_TOKEN)
+
+            load.assert_not_called()
+
+        self.assertEqual(mock_getmtime.call_count, calls)
+        detok.close()
+
+    def test_reload_error_keeps_previous_database(self, mock_getmtime):
+        mock_getmtime.return_value = 100
+        self._write_database()
+        detok = detokenize.AutoUpdatingDetokenizer(self.path,
+                                                   min_poll_period_s=0.001,
+                                                   background_reload=True)
+        with detok:
+            self.assertTrue(detok.detokenize(JELLO_WORLD_TOKEN).ok())
+
+            with mock.patch.object(detok,
+                                   '_load',
+                                   side_effect=ValueError('corrupt')):
+                with self.assertLogs('pw_tokenizer', 'ERROR') as logs:
+                    mock_getmtime.return_value = 200
+                    self.assertTrue(_wait_for(lambda: logs.records))
+
+                self.assertTrue(detok.detokenize(JELLO_WORLD_TOKEN).ok())
+
+    def test_close_stops_thread(self, mock_getmtime):
+        mock_getmtime.return_value = 100
+        detok = detokenize.AutoUpdatingDetokenizer(self.path,
+                                                   min_poll_period_s=0.001,
+                                                   background_reload=True)
+        detok.close()
+
+        with mock.patch.object(detok, '_load') as load:
+            mock_getmtime.return_value = 200
+            detok.detokenize(JELLO_WORLD_TOKEN)
+            time.sleep(0.01)
+            load.assert_not_called()
+
+
 def _next_char(message):
     return bytes(b + 1 for b in message)
 
@@ -512,6 +926,56 @@ class DetokenizeBase64(unittest.TestCase):
 
             self.assertEqual(expected, output.getvalue())
 
+    def test_detokenize_base64_live_chunked(self):
+        data = b'\n'.join(data for data, _ in self.TEST_CASES)
+        expected = b'\n'.join(expected for _, expected in self.TEST_CASES)
+
+        for chunk_size in 1, 2, 3, 5, 8, 13, 1000:
+            output = io.BytesIO()
+            detokenize.detokenize_base64_live(self.detok,
+                                              _ChunkedReader(data, chunk_size),
+                                              output,
+                                              chunk_size=chunk_size)
+            self.assertEqual(expected, output.getvalue())
+
+    def test_detokenize_base64_live_reads_waiting_bytes(self):
+        data = b'\n'.join(data for data, _ in self.TEST_CASES)
+        expected = b'\n'.join(expected for _, expected in self.TEST_CASES)
+
+        for chunk_size in 1, 7, 1000:
+            output = io.BytesIO()
+            detokenize.detokenize_base64_live(self.detok,
+                                              _SerialReader(data, chunk_size),
+                                              output)
+            self.assertEqual(expected, output.getvalue())
+
+    def test_detokenize_base64_live_flushes_complete_messages(self):
+        output = io.BytesIO()
+        flushed = []
+        output.flush = lambda: flushed.append(output.getvalue())
+
+        detokenize.detokenize_base64_live(
+            self.detok,
+            _ChunkedReader(b'Hi ' + self.JELLO + b'\n' + self.JELLO, 5),
+            output,
+            chunk_size=5)
+
+        # The first message is flushed before the second message is read.
+        self.assertIn(b'Hi Jello, world!\n', flushed)
+        self.assertEqual(flushed[-1], b'Hi Jello, world!\nJello, world!')
+
+    def test_detokenize_base64_live_max_message_size(self):
+        output = io.BytesIO()
+        detokenize.detokenize_base64_live(self.detok,
+                                          _ChunkedReader(
+                                              b'$' + b'B' * 100 + self.JELLO,
+                                              4),
+                                          output,
+                                          chunk_size=4,
+                                          max_message_size=10)
+        self.assertTrue(output.getvalue().startswith(b'$BBBB'))
+        self.assertTrue(output.getvalue().endswith(b'Jello, world!'))
+
     def test_detokenize_base64_to_file(self):
         for data, expected in self.TEST_CASES:
             output = io.BytesIO()
@@ -525,6 +989,521 @@ class DetokenizeBase64(unittest.TestCase):
                 expected, detokenize.detokenize_base64(self.detok, data, b'$'))
 
 
+class _ChunkedReader(io.RawIOBase):
+    """Returns at most chunk_size bytes from each read, like a serial port."""
+    def __init__(self, data, chunk_size):
+        super().__init__()
+        self._data = io.BytesIO(data)
+        self._chunk_size = chunk_size
+
+    def readable(self):
+        return True
+
+    def read1(self, size=-1):
+        return self._data.read(min(size, self._chunk_size))
+
+
+class _SerialReader:
+    """Has read and in_waiting but no read1, like pyserial's Serial."""
+    def __init__(self, data, chunk_size):
+        self._data = data
+        self._chunk_size = chunk_size
+        self._index = 0
+
+    @property
+    def in_waiting(self):
+        return min(self._chunk_size, len(self._data) - self._index)
+
+    def read(self, size=1):
+        if size > max(1, self.in_waiting):
+            raise AssertionError('read({}) would block'.format(size))
+
+        chunk = self._data[self._index:self._index + size]
+        self._index += len(chunk)
+        return chunk
+
+
+class DetokenizeBase64Parallel(unittest.TestCase):
+    """Tests detokenizing Base64 in a file with multiple processes."""
+    JELLO = DetokenizeBase64.JELLO
+
+    def setUp(self):
+        super().setUp()
+        self.db = database.load_token_database(
+            io.BytesIO(ELF_WITH_TOKENIZER_SECTIONS))
+        self.lines = [
+            b'%d: ' % i + self.JELLO + (b' $abc ' if i % 3 else b'') +
+            self.JELLO * (i % 4) for i in range(500)
+        ]
+        self.data = b'\n'.join(self.lines)
+
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as file:
+            file.write(self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+        super().tearDown()
+
+    def _expected(self):
+        return detokenize.detokenize_base64(detokenize.Detokenizer(self.db),
+                                            self.data)
+
+    def test_matches_serial(self):
+        for chunk_size in 1, 100, 4096, len(self.data) * 2:
+            output = io.BytesIO()
+            detokenize.detokenize_base64_parallel(self.db,
+                                                  self.path,
+                                                  output,
+                                                  jobs=2,
+                                                  chunk_size=chunk_size)
+            self.assertEqual(output.getvalue(), self._expected())
+
+    def test_line_chunks(self):
+        # pylint: disable=protected-access
+        chunks = list(detokenize._line_chunks(self.data, 100))
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(self.data))
+
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(self.data[end - 1:end], b'\n')
+
+        self.assertEqual(list(detokenize._line_chunks(b'', 10)), [])
+        self.assertEqual(list(detokenize._line_chunks(b'ab\n', 10)), [(0, 3)])
+
+    def test_empty_file(self):
+        with open(self.path, 'wb'):
+            pass
+
+        output = io.BytesIO()
+        detokenize.detokenize_base64_parallel(self.db, self.path, output)
+        self.assertEqual(output.getvalue(), b'')
+
+    def test_handle_base64_with_jobs(self):
+        output = io.BytesIO()
+
+        with open(self.path, 'rb') as input_file:
+            detokenize._handle_base64(  # pylint: disable=protected-access
+                [self.db],
+                input_file,
+                output,
+                b'$',
+                show_errors=False,
+                jobs=2)
+
+        self.assertEqual(output.getvalue(), self._expected())
+
+    def test_command_line_with_jobs_and_redirected_stdin(self):
+        fd, db_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as db_file:
+            tokens.write_csv(self.db, db_file)
+
+        try:
+            with open(self.path, 'rb') as stdin:
+                command = [
+                    sys.executable, detokenize.__file__, 'base64', db_path,
+                    '-j', '2'
+                ]
+                result = subprocess.run(command,
+                                        stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        check=False)
+        finally:
+            os.unlink(db_path)
+
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        self.assertEqual(result.stdout, self._expected())
+
+
+def _length_prefixed(*messages):
+    return b''.join(bytes([len(message)]) + message for message in messages)
+
+
+def _hdlc(*messages):
+    frames = []
+
+    for message in messages:
+        escaped = bytearray()
+        for byte in message:
+            if byte in (0x7e, 0x7d):
+                escaped += bytes([0x7d, byte ^ 0x20])
+            else:
+                escaped.append(byte)
+        frames.append(bytes(escaped))
+
+    return b'\x7e' + b'\x7e'.join(frames) + b'\x7e'
+
+
+class DetokenizeBinaryTest(unittest.TestCase):
+    """Tests detokenizing framed binary messages."""
+    MESSAGES = (
+        JELLO_WORLD_TOKEN,
+        b'\x7e\x7d\0\0\x02',  # Token with bytes that are escaped in HDLC
+        b'',
+        b'\xff\xff\xff\xff',
+    )
+    EXPECTED = (b'Jello, world!\n'
+                b'Escape ~} 1\n'
+                b'$\n'
+                b'$/////w==\n')
+
+    def setUp(self):
+        super().setUp()
+        self.detok = detokenize.Detokenizer(
+            io.BytesIO(ELF_WITH_TOKENIZER_SECTIONS),
+            tokens.Database(
+                [tokens.TokenizedStringEntry(0x7d7e, 'Escape ~} %d')]))
+
+    def _detokenize(self, data, framing, chunk_size=1000, **kwargs):
+        output = io.BytesIO()
+        detokenize.detokenize_binary(self.detok,
+                                     _ChunkedReader(data, chunk_size),
+                                     output,
+                                     framing,
+                                     chunk_size=chunk_size,
+                                     **kwargs)
+        return output.getvalue()
+
+    def test_reads_waiting_bytes(self):
+        data = _length_prefixed(*self.MESSAGES)
+        output = io.BytesIO()
+        detokenize.detokenize_binary(self.detok, _SerialReader(data, 5),
+                                     output, 'length')
+        self.assertEqual(output.getvalue(), self._detokenize(data, 'length'))
+
+    def test_length_prefixed(self):
+        data = _length_prefixed(*self.MESSAGES)
+
+        for chunk_size in 1, 2, 3, 7, 1000:
+            self.assertEqual(self._detokenize(data, 'length', chunk_size),
+                             self.EXPECTED)
+
+    def test_hdlc(self):
+        data = _hdlc(*self.MESSAGES)
+
+        for chunk_size in 1, 2, 3, 7, 1000:
+            self.assertEqual(self._detokenize(data, 'hdlc', chunk_size),
+                             self.EXPECTED.replace(b'$\n', b''))
+
+    def test_show_errors(self):
+        self.detok.show_errors = True
+        output = self._detokenize(_length_prefixed(b'\xff\xff\xff\xff'),
+                                  'length')
+        self.assertTrue(output.startswith(b'<[ERROR: '))
+
+    def test_length_prefixed_long_message(self):
+        message = JELLO_WORLD_TOKEN + b'\0' * 200
+        self.assertEqual(
+            list(
+                detokenize.read_length_prefixed_messages(
+                    io.BytesIO(b'\xcc\x01' + message))), [message])
+
+    def test_length_prefixed_too_large(self):
+        with self.assertRaises(ValueError):
+            self._detokenize(b'\xff\x7f' + b'\0' * 100,
+                             'length',
+                             max_message_size=100)
+
+        with self.assertRaises(ValueError):
+            self._detokenize(b'\xff' * 6, 'length')
+
+    def test_incomplete_messages_discarded(self):
+        self.assertEqual(
+            self._detokenize(
+                _length_prefixed(JELLO_WORLD_TOKEN) + b'\x09abc', 'length'),
+            b'Jello, world!\n')
+        self.assertEqual(
+            self._detokenize(_hdlc(JELLO_WORLD_TOKEN) + b'abc', 'hdlc'),
+            b'Jello, world!\n')
+
+    def test_hdlc_large_frame_discarded(self):
+        data = b'\x7e' + b'x' * 50 + _hdlc(JELLO_WORLD_TOKEN)
+
+        for chunk_size in 1, 7, 1000:
+            self.assertEqual(
+                self._detokenize(data, 'hdlc', chunk_size,
+                                 max_message_size=10), b'Jello, world!\n')
+
+    def test_hdlc_double_escape_discarded(self):
+        data = b'\x7eab\x7d\x7d\x5e\x7e' + _hdlc(JELLO_WORLD_TOKEN)
+
+        with self.assertLogs('pw_tokenizer', 'WARNING'):
+            self.assertEqual(
+                list(detokenize.read_hdlc_frames(io.BytesIO(data))),
+                [JELLO_WORLD_TOKEN])
+
+        self.assertEqual(self._detokenize(data, 'hdlc'), b'Jello, world!\n')
+
+    def test_hdlc_trailing_escape_discarded(self):
+        data = b'\x7eab\x7d\x7e' + _hdlc(JELLO_WORLD_TOKEN)
+
+        for chunk_size in 1, 3, 1000:
+            with self.assertLogs('pw_tokenizer', 'WARNING'):
+                self.assertEqual(
+                    list(
+                        detokenize.read_hdlc_frames(io.BytesIO(data),
+                                                    chunk_size)),
+                    [JELLO_WORLD_TOKEN])
+
+    def test_unknown_framing(self):
+        with self.assertRaises(ValueError):
+            self._detokenize(b'', 'cobs')
+
+    def test_handle_binary(self):
+        output = io.BytesIO()
+        detokenize._handle_binary(  # pylint: disable=protected-access
+            [self.detok.database],
+            io.BytesIO(_hdlc(*self.MESSAGES)),
+            output,
+            'hdlc',
+            output_format='text',
+            show_errors=False)
+        self.assertEqual(output.getvalue(), self.EXPECTED.replace(b'$\n', b''))
+
+
+class StructuredOutputTest(unittest.TestCase):
+    """Tests decoding messages to typed values without formatting."""
+    def setUp(self):
+        super().setUp()
+        self.detok = detokenize.Detokenizer(
+            tokens.Database([
+                tokens.TokenizedStringEntry(1, '%d%% of %s at %f (%llx %c)'),
+                tokens.TokenizedStringEntry(2, 'Collision %d'),
+                tokens.TokenizedStringEntry(2, 'Collision %s'),
+                tokens.TokenizedStringEntry(3, 'No args'),
+            ]))
+
+    def test_typed_values(self):
+        message = b'\1\0\0\0\x13\x02hi\0\0\xc0\x3f\x01\x82\x01'
+
+        with mock.patch.object(decoder.DecodedArg, 'format') as format_arg:
+            result = self.detok.decode_structured(message)
+
+        format_arg.assert_not_called()
+        self.assertEqual(
+            result,
+            detokenize.StructuredMessage(
+                token=1,
+                format_string='%d%% of %s at %f (%llx %c)',
+                args=(-10, 'hi', 1.5, 2**64 - 1, 'A'),
+                statuses=(0, 0, 0, 0, 0),
+                ok=True))
+        self.assertEqual(
+            result.args,
+            tuple(arg.value
+                  for arg in self.detok.detokenize(message).best_result().args
+                  if arg.specifier.type != '%'))
+
+    def test_collision_uses_best_match(self):
+        result = self.detok.decode_structured(b'\2\0\0\0\x02hi')
+        self.assertEqual(result.format_string, 'Collision %s')
+        self.assertEqual(result.args, ('hi', ))
+        self.assertTrue(result.ok)
+
+    def test_errors(self):
+        result = self.detok.decode_structured(b'\1\0\0\0\x13')
+        self.assertFalse(result.ok)
+        self.assertEqual(result.args, (-10, None, None, None, None))
+        self.assertEqual(result.statuses[:2], (0, decoder.DecodedArg.MISSING))
+
+        self.assertEqual(
+            self.detok.decode_structured(b'\3\0\0\0\xff'),
+            detokenize.StructuredMessage(3, 'No args', (), (), False, b'\xff'))
+        self.assertEqual(
+            self.detok.decode_structured(b'\x09\0\0\0\x01'),
+            detokenize.StructuredMessage(9, None, (), (), False, b'\x01'))
+        self.assertEqual(
+            self.detok.decode_structured(b'\1'),
+            detokenize.StructuredMessage(None, None, (), (), False, b'\1'))
+
+    def test_to_json(self):
+        self.assertEqual(
+            json.loads(
+                self.detok.decode_structured(b'\2\0\0\0\x02hi\xff').to_json()),
+            dict(token=2,
+                 format='Collision %d',
+                 args=[1],
+                 status=[0],
+                 ok=False,
+                 remaining='6869ff'))
+
+    def test_pack(self):
+        packed = self.detok.decode_structured(
+            b'\1\0\0\0\x13\x02hi\0\0\xc0\x3f\x02\x82\x01').pack()
+        fmt = b'%d%% of %s at %f (%llx %c)'
+
+        self.assertEqual(
+            packed,
+            struct.pack('<IBIBH', len(packed), 0x7, 1, 5, len(fmt)) + fmt +
+            b'\1\0' + struct.pack('<q', -10) + b'\4\0\2\0hi' + b'\3\0' +
+            struct.pack('<d', 1.5) + b'\1\0' + struct.pack('<q', 1) +
+            b'\4\0\1\0A' + b'\0\0')
+
+        unknown = detokenize.StructuredMessage(None, None, (None, ), (1, ),
+                                               False, b'?').pack()
+        self.assertEqual(unknown,
+                         struct.pack('<IBIBH', 17, 0, 0, 1, 0) + b'\0\1\1\0?')
+
+    def test_pack_integer_out_of_range(self):
+        detok = detokenize.Detokenizer(
+            tokens.Database([tokens.TokenizedStringEntry(4, 'v %d %u')]))
+        message = detok.decode_structured(b'\4\0\0\0' + b'\xff' * 9 +
+                                          b'\x7f\x02')
+        self.assertTrue(message.ok)
+        self.assertLess(message.args[0], -2**63)
+
+        self.assertEqual(
+            message.pack(),
+            struct.pack('<IBIBH', 33, 0x5, 4, 2, 7) + b'v %d %u' + b'\0\4' +
+            b'\1\0' + struct.pack('<q', 1) + b'\0\0')
+
+    def test_pack_too_many_arguments(self):
+        message = detokenize.StructuredMessage(5, '%d' * 300,
+                                               tuple(range(300)), (0, ) * 300,
+                                               True)
+        packed = message.pack()
+        header = struct.unpack_from('<IBIBH', packed)
+        self.assertEqual(header, (len(packed), 0x5, 5, 255, 600))
+        self.assertEqual(len(packed), 12 + 600 + 255 * 10 + 2)
+
+    def test_binary_packed_output_with_corrupt_integer(self):
+        detok = detokenize.Detokenizer(
+            tokens.Database([tokens.TokenizedStringEntry(4, 'v %d')]))
+        output = io.BytesIO()
+        detokenize.detokenize_binary(
+            detok,
+            io.BytesIO(
+                _length_prefixed(b'\4\0\0\0' + b'\xff' * 9 + b'\x7f',
+                                 b'\4\0\0\0\x02')),
+            output,
+            output_format='packed')
+
+        self.assertEqual(
+            output.getvalue(), b''.join(
+                detok.decode_structured(message).pack()
+                for message in (b'\4\0\0\0' + b'\xff' * 9 + b'\x7f',
+                                b'\4\0\0\0\x02')))
+
+    def test_binary_json_output(self):
+        output = io.BytesIO()
+        detokenize.detokenize_binary(
+            self.detok,
+            io.BytesIO(_length_prefixed(b'\3\0\0\0', b'\2\0\0\0\x02')),
+            output,
+            output_format='json')
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            dict(token=3, format='No args', args=[], status=[], ok=True),
+            dict(token=2, format='Collision %d', args=[1], status=[0],
+                 ok=True),
+        ])
+
+    def test_binary_packed_output(self):
+        output = io.BytesIO()
+        detokenize.detokenize_binary(self.detok,
+                                     io.BytesIO(_hdlc(b'\3\0\0\0',
+                                                      b'\3\0\0\0')),
+                                     output,
+                                     'hdlc',
+                                     output_format='packed')
+
+        record = self.detok.decode_structured(b'\3\0\0\0').pack()
+        self.assertEqual(output.getvalue(), record * 2)
+
+    def test_unknown_output_format(self):
+        with self.assertRaises(ValueError):
+            detokenize.detokenize_binary(self.detok,
+                                         io.BytesIO(),
+                                         io.BytesIO(),
+                                         output_format='xml')
+
+
+def _stream_reader(*chunks):
+    """Creates an asyncio.StreamReader that returns the chunks, then EOF.
+
+    This must be called while an event loop is running.
+    """
+    reader = asyncio.StreamReader()
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    return reader
+
+
+class DetokenizeBase64Async(unittest.TestCase):
+    """Tests detokenizing Base64 messages from asyncio streams."""
+    JELLO = DetokenizeBase64.JELLO
+
+    def setUp(self):
+        super().setUp()
+        self.detok = detokenize.Detokenizer(
+            io.BytesIO(ELF_WITH_TOKENIZER_SECTIONS))
+
+    def _lines(self, chunks, **kwargs):
+        async def read_all():
+            return [
+                line async for line in detokenize.detokenize_base64_async(
+                    self.detok, _stream_reader(*chunks), **kwargs)
+            ]
+
+        return asyncio.run(read_all())
+
+    def test_yields_lines(self):
+        data = b'1 ' + self.JELLO + b'\n2 $abc\n\n3 ' + self.JELLO
+        self.assertEqual(
+            self._lines([data], chunk_size=3),
+            [b'1 Jello, world!\n', b'2 $abc\n', b'\n', b'3 Jello, world!'])
+
+    def test_message_split_across_reads(self):
+        self.assertEqual(self._lines([self.JELLO[:5], self.JELLO[5:], b'!\n']),
+                         [b'Jello, world!!\n'])
+
+    def test_long_line_is_split(self):
+        lines = self._lines([b'x' * 100], chunk_size=10)
+        self.assertEqual(b''.join(lines), b'x' * 100)
+        self.assertTrue(all(len(line) <= 20 for line in lines))
+
+    def test_empty(self):
+        self.assertEqual(self._lines([]), [])
+
+    def test_many_streams(self):
+        async def read_all():
+            lines = [[
+                b'%d:%d ' % (i, n) + self.JELLO + b'\n' for n in range(20)
+            ] for i in range(10)]
+            readers = {i: _stream_reader(*lines[i]) for i in range(10)}
+            return [
+                item async for item in detokenize.detokenize_base64_streams(
+                    self.detok, readers, queue_size=2)
+            ]
+
+        results = asyncio.run(read_all())
+        self.assertEqual(len(results), 200)
+
+        for i in range(10):
+            self.assertEqual(
+                [line for key, line in results if key == i],
+                [b'%d:%d Jello, world!\n' % (i, n) for n in range(20)])
+
+    def test_stream_error_is_raised(self):
+        async def read_all():
+            failing = asyncio.StreamReader()
+            failing.set_exception(ValueError('disconnected'))
+            return [
+                item async for item in detokenize.detokenize_base64_streams(
+                    self.detok, {
+                        'ok': _stream_reader(self.JELLO + b'\n'),
+                        'failing': failing
+                    })
+            ]
+
+        with self.assertRaises(ValueError):
+            asyncio.run(read_all())
+
+
 class DetokenizeBase64InfiniteRecursion(unittest.TestCase):
     """Tests that infinite Bas64 token recursion resolves."""
     def setUp(self):
@@ -564,5 +1543,83 @@ class DetokenizeBase64InfiniteRecursion(unittest.TestCase):
                                          recursion=3), b'I said "$AwAAAA=="')
 
 
+def _nested_database(depth, copies=1):
+    """Creates a database in which each string contains the previous one."""
+    strings = ['innermost']
+
+    for level in range(1, depth):
+        inner = b'$' + base64.b64encode(
+            struct.pack('<I', tokens.default_hash(strings[-1])))
+        strings.append(f'{level}[' + ' '.join([inner.decode()] * copies) + ']')
+
+    outer = b'$' + base64.b64encode(
+        struct.pack('<I', tokens.default_hash(strings[-1])))
+    return tokens.Database.from_strings(strings), outer
+
+
+class DetokenizeNestedBase64(unittest.TestCase):
+    """Tests expanding deeply nested Base64 messages."""
+    def test_deeper_than_python_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        db, message = _nested_database(depth)
+        result = detokenize.detokenize_base64(detokenize.Detokenizer(db),
+                                              message,
+                                              recursion=depth)
+
+        self.assertTrue(result.startswith(b'%d[%d[' % (depth - 1, depth - 2)))
+        self.assertTrue(result.endswith(b'1[innermost' + b']' * (depth - 1)))
+
+    def test_recursion_limit(self):
+        db, message = _nested_database(5)
+        result = detokenize.detokenize_base64(detokenize.Detokenizer(db),
+                                              message,
+                                              recursion=2)
+        self.assertRegex(result, rb'^4\[3\[2\[\$[A-Za-z0-9+/]+=*\]\]\]$')
+
+    def test_repeated_messages_detokenized_once(self):
+        db, message = _nested_database(8, copies=3)
+        detok = detokenize.Detokenizer(db)
+
+        with mock.patch.object(detok, 'detokenize',
+                               wraps=detok.detokenize) as detokenize_mock:
+            result = detokenize.detokenize_base64(detok, message)
+
+        self.assertEqual(result.count(b'innermost'), 3**7)
+        self.assertEqual(detokenize_mock.call_count, 8)
+
+    def test_results_cached_between_messages(self):
+        db, message = _nested_database(3)
+        detok = detokenize.Detokenizer(db)
+        output = io.BytesIO()
+
+        with mock.patch.object(detok, 'detokenize',
+                               wraps=detok.detokenize) as detokenize_mock:
+            detokenize.detokenize_base64_live(
+                detok, io.BytesIO(message + b'\n' + message), output)
+
+        self.assertEqual(output.getvalue().count(b'2[1[innermost]]'), 2)
+        self.assertEqual(detokenize_mock.call_count, 3)
+
+    def test_auto_updating_detokenizer_not_cached(self):
+        db, message = _nested_database(3)
+
+        with tempfile.NamedTemporaryFile('wb', delete=False) as fd:
+            tokens.write_csv(db, fd)
+
+        try:
+            detok = detokenize.AutoUpdatingDetokenizer(fd.name)
+
+            with mock.patch.object(detok, 'detokenize',
+                                   wraps=detok.detokenize) as detokenize_mock:
+                self.assertEqual(
+                    detokenize.detokenize_base64(detok,
+                                                 message + b' ' + message),
+                    b'2[1[innermost]] 2[1[innermost]]')
+
+            self.assertEqual(detokenize_mock.call_count, 6)
+        finally:
+            os.unlink(fd.name)
+
+
 if __name__ == '__main__':
     unittest.main()
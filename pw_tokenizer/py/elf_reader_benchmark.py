@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Micro-benchmarks for the elf_reader module.
+
+The benchmarks read a static library (.a) archive that contains many copies of
+elf_reader_test_binary.elf. Run this script directly to print the throughput
+of each benchmark:
+
+  python elf_reader_benchmark.py --objects 5000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from typing import BinaryIO, Callable, Iterator
+
+from pw_tokenizer import elf_reader
+from pw_tokenizer.elf_reader import FILE_HEADER, SECTION_HEADER
+
+_TEST_ELF_PATH = os.path.join(os.path.dirname(__file__),
+                              'elf_reader_test_binary.elf')
+
+
+def _original_list_sections(fd: BinaryIO) -> Iterator[elf_reader.Elf.Section]:
+    """The original field-by-field section header parsing, for comparison."""
+    # pylint: disable=protected-access
+    for _ in elf_reader._elf_files_in_archive(fd):
+        reader = elf_reader.FieldReader(fd)
+        base = reader.read(FILE_HEADER.section_header_offset)
+        section_header_size = reader.offset(SECTION_HEADER.section_header_end)
+
+        names_table_base = reader.read(
+            SECTION_HEADER.section_offset, base +
+            section_header_size * reader.read(FILE_HEADER.section_names_index))
+
+        for _ in range(reader.read(FILE_HEADER.section_count)):
+            name_offset = reader.read(SECTION_HEADER.section_name_offset, base)
+
+            yield elf_reader.Elf.Section(
+                reader.read_string(names_table_base + name_offset),
+                reader.read(SECTION_HEADER.section_address, base),
+                reader.read(SECTION_HEADER.section_offset, base),
+                reader.read(SECTION_HEADER.section_size, base),
+                reader.file_offset)
+
+            base += section_header_size
+
+
+def _run(name: str,
+         count: int,
+         function: Callable[[], object],
+         units: str = 'sections',
+         repeat: int = 3) -> float:
+    """Runs the function several times and reports the best throughput."""
+    elapsed = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    print(f'{name:40} {count / elapsed:14,.0f} {units}/s')
+    return elapsed
+
+
+def write_archive(output: BinaryIO, objects: int) -> None:
+    """Writes an archive with copies of the test ELF as its object files."""
+    with open(_TEST_ELF_PATH, 'rb') as fd:
+        elf = fd.read()
+
+    output.write(elf_reader.ARCHIVE_MAGIC)
+
+    for i in range(objects):
+        # The header is the file name, timestamp, owner, group, mode, size,
+        # and ending characters. Object files are padded to an even size.
+        output.write(f'obj{i}.o/'.ljust(16).encode() + b'0'.ljust(12) +
+                     b'0'.ljust(6) + b'0'.ljust(6) + b'644'.ljust(8) +
+                     f'{len(elf):<10}'.encode() + b'`\n')
+        output.write(elf + b'\n' * (len(elf) % 2))
+
+
+def benchmark_archive(archive: BinaryIO) -> None:
+    """Compares reading sections from a file and from a memory map."""
+    def list_sections(memory_map: bool) -> int:
+        archive.seek(0)
+        with elf_reader.Elf(archive, memory_map) as elf:
+            return len(elf.sections)
+
+    def original_list_sections() -> int:
+        archive.seek(0)
+        return len(tuple(_original_list_sections(archive)))
+
+    sections = list_sections(False)
+    size = os.fstat(archive.fileno()).st_size
+    print(f'Archive: {size:,} bytes, {sections:,} sections')
+
+    archive.seek(0)
+    original = tuple(_original_list_sections(archive))
+    archive.seek(0)
+    assert original == elf_reader.Elf(archive).sections, 'Sections differ!'
+
+    _run('list sections (original)', sections, original_list_sections)
+    _run('list sections (file)', sections, lambda: list_sections(False))
+    _run('list sections (memory-mapped)', sections,
+         lambda: list_sections(True))
+
+    archive.seek(0)
+    elf = elf_reader.Elf(archive)
+    archive.seek(0)
+    mapped = elf_reader.Elf(archive, memory_map=True)
+    dumped = len(list(mapped.sections_with_name('.test_section_1'))) * 2
+
+    _run('dump_sections (file)', dumped,
+         lambda: elf.dump_sections(r'\.test_section_\d'))
+    _run('dump_sections (memory-mapped)', dumped,
+         lambda: mapped.dump_sections(r'\.test_section_\d'))
+
+    def view_sections() -> None:
+        for view in mapped.view_sections(r'\.test_section_\d'):
+            view.release()
+
+    _run('view_sections (memory-mapped)', dumped, view_sections)
+    mapped.close()
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--objects',
+        type=int,
+        default=5000,
+        help='Number of object files in the archive (default: 5000)')
+    return parser.parse_args()
+
+
+def _main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryFile() as archive:
+        write_archive(archive, args.objects)
+        benchmark_archive(archive)
+
+
+if __name__ == '__main__':
+    _main(_parse_args())
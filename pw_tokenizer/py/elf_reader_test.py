@@ -17,6 +17,7 @@
 import io
 import os
 import re
+import tempfile
 import unittest
 
 from pw_tokenizer import elf_reader
@@ -139,6 +140,16 @@ class ElfReaderTest(unittest.TestCase):
 
         self.assertIn(self._elf.dump_sections(r'.test_section_\d'), contents)
 
+    def test_view_sections(self):
+        views = self._elf.view_sections(r'\.test_section_\d')
+        self.assertCountEqual([bytes(view) for view in views],
+                              [b'You cannot pass\0', b'\xef\xbe\xed\xfe'])
+
+        for view in views:
+            view.release()
+
+        self.assertEqual(self._elf.view_sections(r'\.not_a_section'), [])
+
     def test_read_values(self):
         address = self._section('.test_section_1').address
         self.assertEqual(self._elf.read_value(address), b'You cannot pass')
@@ -147,6 +158,21 @@ class ElfReaderTest(unittest.TestCase):
         self.assertEqual(self._elf.read_value(int32_address, 4),
                          b'\xef\xbe\xed\xfe')
 
+    def test_header_struct(self):
+        self._elf_file.seek(0)
+        reader = elf_reader.FieldReader(self._elf_file)
+        fields = (elf_reader.SECTION_HEADER.section_name_offset,
+                  elf_reader.SECTION_HEADER.section_size)
+
+        header = reader.header_struct(
+            fields, elf_reader.SECTION_HEADER.section_header_end)
+        self.assertEqual(header.format, '<0xI28xQ24x')
+        self.assertEqual(header.size, 0x40)
+
+        with self.assertRaises(ValueError):
+            reader.header_struct(fields[::-1],
+                                 elf_reader.SECTION_HEADER.section_header_end)
+
     def test_read_string(self):
         bytes_io = io.BytesIO(
             b'This is a null-terminated string\0No terminator!')
@@ -168,6 +194,32 @@ class ElfReaderTest(unittest.TestCase):
         self.assertFalse(elf_reader.compatible_file(io.BytesIO(b'\x7fELVESF')))
 
 
+class MappedElfReaderTest(ElfReaderTest):
+    """Tests the elf_reader.Elf class with a memory-mapped file."""
+    def setUp(self):
+        super().setUp()
+        self._elf_file.seek(0)
+        self._elf = elf_reader.Elf(self._elf_file, memory_map=True)
+
+    def tearDown(self):
+        self._elf.close()
+        super().tearDown()
+
+    def test_sections_match_unmapped(self):
+        self._elf_file.seek(0)
+        self.assertEqual(self._elf.sections,
+                         elf_reader.Elf(self._elf_file).sections)
+
+    def test_close_with_views_fails(self):
+        view, = self._elf.view_sections(r'\.test_section_1')
+
+        with self.assertRaises(BufferError):
+            self._elf.close()
+
+        view.release()
+        self._elf.close()
+
+
 def _archive_file(data: bytes) -> bytes:
     return ('FILE ID 90123456'
             'MODIFIED 012'
@@ -260,6 +312,28 @@ class ArchiveTest(unittest.TestCase):
         int32_address = next(elf.sections_with_name('.test_section_2')).address
         self.assertEqual(elf.read_value(int32_address, 4), b'\xef\xbe\xed\xfe')
 
+    def test_memory_map_file_without_descriptor(self):
+        with elf_reader.Elf(self._archive, memory_map=True) as elf:
+            self.assertEqual(
+                elf.sections,
+                elf_reader.Elf(io.BytesIO(self._archive_data)).sections)
+            self.assertEqual(elf.dump_sections(r'\.test_section_1'),
+                             b'You cannot pass\0')
+
+    def test_memory_map_archive(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self._archive_data)
+            fd.seek(0)
+
+            with elf_reader.Elf(fd, memory_map=True) as elf:
+                self.assertEqual(elf.dump_sections(r'\.test_section_2'),
+                                 b'\xef\xbe\xed\xfe')
+
+                address = next(
+                    elf.sections_with_name('.test_section_1')).address
+                self.assertEqual(elf.read_value(address), b'You cannot pass')
+                self.assertEqual(elf.read_value(address, 3), b'You')
+
 
 if __name__ == '__main__':
     unittest.main()
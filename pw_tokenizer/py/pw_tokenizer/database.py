@@ -19,14 +19,21 @@ maintaining token databases.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import csv
 from datetime import datetime
 import glob
+import heapq
+import itertools
 import logging
 import os
 import re
 import struct
 import sys
-from typing import Dict, Iterable
+import tempfile
+from typing import BinaryIO, Deque, Dict, Iterable, Iterator, List, Tuple
+from typing import Union
 
 try:
     from pw_tokenizer import elf_reader, tokens
@@ -39,17 +46,55 @@ except ImportError:
 
 _LOG = logging.getLogger('pw_tokenizer')
 
+_NULL = re.compile(b'\0')
+
 
 def _elf_reader(elf) -> elf_reader.Elf:
     return elf if isinstance(elf, elf_reader.Elf) else elf_reader.Elf(elf)
 
 
 def _read_strings_from_elf(elf) -> Iterable[str]:
-    """Reads the tokenized strings from an elf_reader.Elf or ELF file object."""
-    sections = _elf_reader(elf).dump_sections(r'\.tokenized(\.\d+)?')
-    if sections is not None:
-        for string in sections.split(b'\0'):
-            yield string.decode()
+    """Reads the tokenized strings from an elf_reader.Elf or ELF file object.
+
+    ELF file objects are memory-mapped, and the strings are decoded directly
+    from the mapped sections.
+    """
+    if isinstance(elf, elf_reader.Elf):
+        yield from _split_strings(elf.view_sections(r'\.tokenized(\.\d+)?'))
+        return
+
+    with elf_reader.Elf(elf, memory_map=True) as mapped_elf:
+        yield from _split_strings(
+            mapped_elf.view_sections(r'\.tokenized(\.\d+)?'))
+
+
+def _split_strings(sections: List[memoryview]) -> Iterator[str]:
+    """Splits the sections into strings as if they were joined, then split.
+
+    The sections are released when done, even if decoding a string fails, so
+    a memory-mapped Elf can be closed.
+    """
+    if not sections:
+        return
+
+    partial = b''
+
+    try:
+        for section in sections:
+            start = 0
+
+            for null in _NULL.finditer(section):
+                yield (partial + section[start:null.start()]).decode()
+                partial = b''
+                start = null.end()
+
+            partial += section[start:]
+            section.release()
+    finally:
+        for section in sections:
+            section.release()
+
+    yield partial.decode()
 
 
 def read_tokenizer_metadata(elf) -> Dict[str, int]:
@@ -68,12 +113,12 @@ def read_tokenizer_metadata(elf) -> Dict[str, int]:
     return metadata
 
 
-def _load_token_database(db) -> tokens.Database:
+def _load_token_database(db) -> Union[tokens.Database, tokens.MappedDatabase]:
     """Loads a Database from a database object, ELF, CSV, or binary database."""
     if db is None:
         return tokens.Database()
 
-    if isinstance(db, tokens.Database):
+    if isinstance(db, (tokens.Database, tokens.MappedDatabase)):
         return db
 
     if isinstance(db, elf_reader.Elf):
@@ -105,12 +150,200 @@ def _load_token_database(db) -> tokens.Database:
     return tokens.Database(tokens.parse_csv(db))
 
 
-def load_token_database(*databases) -> tokens.Database:
-    """Loads a Database from database objects, ELFs, CSVs, or binary files."""
+def load_token_database(
+        *databases) -> Union[tokens.Database, tokens.MappedDatabase]:
+    """Loads a Database from database objects, ELFs, CSVs, or binary files.
+
+    A single MappedDatabase is returned as is, so its strings are still read
+    lazily. Otherwise, all databases are merged into a new Database.
+    """
+    if len(databases) == 1 and isinstance(databases[0], tokens.MappedDatabase):
+        return databases[0]
+
     return tokens.Database.merged(*(_load_token_database(db)
                                     for db in databases))
 
 
+def _load_path(path: str) -> tokens.Database:
+    """Loads a path as a Database; paths are never loaded as MappedDatabases."""
+    return tokens.Database.merged(_load_token_database(path))
+
+
+def iter_token_databases(paths: Iterable[str],
+                         jobs: int = 1) -> Iterator[tokens.Database]:
+    """Loads a Database from each path, optionally in parallel.
+
+    With more than one job, the files are read and their strings are tokenized
+    in a pool of processes. The databases are yielded in the same order as the
+    paths, so merging them produces the same output as loading them serially.
+    At most one database per job is loaded ahead of the caller.
+
+    Args:
+      paths: paths to ELFs, archives, or CSV or binary token databases
+      jobs: number of processes to use; 0 uses one per CPU
+
+    Yields:
+      the Database for each path
+    """
+    paths = list(paths)
+    jobs = min(jobs or os.cpu_count() or 1, len(paths))
+
+    if jobs <= 1:
+        yield from (_load_path(path) for path in paths)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        pending: Deque[concurrent.futures.Future] = collections.deque()
+
+        for path in paths:
+            pending.append(pool.submit(_load_path, path))
+
+            if len(pending) >= jobs:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_token_databases(paths: Iterable[str],
+                         jobs: int = 1) -> List[tokens.Database]:
+    """Loads a Database from each path; see iter_token_databases."""
+    return list(iter_token_databases(paths, jobs))
+
+
+def _entry_key(entry: tokens.TokenizedStringEntry) -> Tuple[int, str]:
+    return entry.key()
+
+
+def _write_run(entries: List[tokens.TokenizedStringEntry],
+               directory: str) -> str:
+    """Sorts entries by (token, string) and writes them to a temporary file."""
+    entries.sort(key=_entry_key)
+
+    with tempfile.NamedTemporaryFile('w',
+                                     dir=directory,
+                                     newline='',
+                                     encoding='utf-8',
+                                     delete=False) as fd:
+        csv.writer(fd).writerows(
+            ('%x' % entry.token,
+             entry.date_removed.isoformat() if entry.date_removed else '',
+             entry.string) for entry in entries)
+        return fd.name
+
+
+def _read_run(path: str) -> Iterator[tokens.TokenizedStringEntry]:
+    with open(path, newline='', encoding='utf-8') as fd:
+        for token, date_removed, string in csv.reader(fd):
+            yield tokens.TokenizedStringEntry(
+                int(token, 16), string,
+                datetime.fromisoformat(date_removed) if date_removed else None)
+
+
+def _merge_runs(paths: List[str]) -> Iterator[tokens.TokenizedStringEntry]:
+    """Merges sorted runs into unique entries in database order.
+
+    Entries with the same token and string are combined, keeping the newest
+    removal date, as in Database.merge.
+    """
+    merged = heapq.merge(*(_read_run(path) for path in paths), key=_entry_key)
+
+    for _, same_token in itertools.groupby(merged, lambda e: e.token):
+        unique: List[tokens.TokenizedStringEntry] = []
+
+        for entry in same_token:
+            if unique and unique[-1].string == entry.string:
+                unique[-1].update_date_removed(entry.date_removed)
+            else:
+                unique.append(entry)
+
+        yield from tokens.sorted_entries(unique)
+
+
+DEFAULT_STREAMING_CHUNK_SIZE = 2**18
+
+
+def write_database_streaming(paths: Iterable[str],
+                             fd: BinaryIO,
+                             output_type: str = 'csv',
+                             include: Iterable = (),
+                             exclude: Iterable = (),
+                             string_offsets: bool = False,
+                             chunk_size: int = DEFAULT_STREAMING_CHUNK_SIZE,
+                             jobs: int = 1) -> int:
+    """Creates a token database from many sources with bounded memory use.
+
+    Sources are loaded one at a time. Their entries are sorted in chunks that
+    are written to temporary files, which are then merged as the output is
+    written. At most one source and one chunk of entries are held in memory at
+    once. The output is identical to merging all of the sources into a
+    Database and writing it.
+
+    Args:
+      paths: paths to ELFs, archives, or CSV or binary token databases
+      fd: the binary file to which to write the database
+      output_type: 'csv' or 'binary'
+      include: regexes; only entries matching at least one are kept
+      exclude: regexes; entries matching any of these are removed
+      string_offsets: whether to write a string offset table in binary output
+      chunk_size: maximum number of entries to sort in memory at once
+      jobs: number of processes with which to load sources
+
+    Returns:
+      the number of entries written
+    """
+    if output_type not in ('csv', 'binary'):
+        raise ValueError('Unknown database type "{}"'.format(output_type))
+
+    with tempfile.TemporaryDirectory(prefix='pw_tokenizer_') as directory:
+        runs: List[str] = []
+        chunk: List[tokens.TokenizedStringEntry] = []
+
+        for source in iter_token_databases(paths, jobs):
+            source.filter(include, exclude)
+
+            for entry in source.entries():
+                chunk.append(entry)
+
+                if len(chunk) >= chunk_size:
+                    runs.append(_write_run(chunk, directory))
+                    chunk = []
+
+        if chunk or not runs:
+            runs.append(_write_run(chunk, directory))
+            chunk = []
+
+        if output_type == 'csv':
+            count = 0
+
+            def counted_entries():
+                nonlocal count
+                for entry in _merge_runs(runs):
+                    count += 1
+                    yield entry
+
+            tokens.write_sorted_csv(counted_entries(), fd)
+            return count
+
+        # The binary format starts with the entry count and requires two
+        # passes, so merge into a single run first. The merged run is already
+        # in database order, so write it directly rather than sorting it.
+        merged_path = os.path.join(directory, 'merged.csv')
+        count = 0
+
+        with open(merged_path, 'w', newline='', encoding='utf-8') as merged:
+            writer = csv.writer(merged)
+            for entry in _merge_runs(runs):
+                writer.writerow(
+                    ('%x' % entry.token, entry.date_removed.isoformat()
+                     if entry.date_removed else '', entry.string))
+                count += 1
+
+        tokens.write_sorted_binary(lambda: _read_run(merged_path), count, fd,
+                                   string_offsets)
+        return count
+
+
 def generate_report(db: tokens.Database) -> Dict[str, int]:
     """Returns a simple report of properties of the database."""
     present = [entry for entry in db.entries() if not entry.date_removed]
@@ -126,8 +359,8 @@ def generate_report(db: tokens.Database) -> Dict[str, int]:
     }
 
 
-def _handle_create(elf_or_token_database, database, force, output_type,
-                   include, exclude):
+def _handle_create(elf_or_token_database, jobs, database, force, output_type,
+                   include, exclude, string_offsets, stream, chunk_size):
     """Creates a token database file from one or more ELF files."""
 
     if database == '-':
@@ -140,14 +373,26 @@ def _handle_create(elf_or_token_database, database, force, output_type,
     else:
         fd = open(database, 'wb')
 
-    database = tokens.Database.merged(*elf_or_token_database)
+    if stream:
+        with fd:
+            count = write_database_streaming(elf_or_token_database, fd,
+                                             output_type, include or (),
+                                             exclude or (), string_offsets,
+                                             chunk_size, jobs)
+
+        _LOG.info('Wrote database with %d entries to %s as %s', count, fd.name,
+                  output_type)
+        return
+
+    database = tokens.Database.merged(
+        *load_token_databases(elf_or_token_database, jobs))
     database.filter(include, exclude)
 
     with fd:
         if output_type == 'csv':
             tokens.write_csv(database, fd)
         elif output_type == 'binary':
-            tokens.write_binary(database, fd)
+            tokens.write_binary(database, fd, string_offsets)
         else:
             raise ValueError('Unknown database type "{}"'.format(output_type))
 
@@ -155,10 +400,10 @@ def _handle_create(elf_or_token_database, database, force, output_type,
               fd.name, output_type)
 
 
-def _handle_add(token_database, elf_or_token_database):
+def _handle_add(token_database, elf_or_token_database, jobs):
     initial = len(token_database)
 
-    for source in elf_or_token_database:
+    for source in load_token_databases(elf_or_token_database, jobs):
         token_database.add((entry.string for entry in source.entries()))
 
     token_database.write_to_file()
@@ -167,10 +412,10 @@ def _handle_add(token_database, elf_or_token_database):
               len(token_database) - initial, token_database.path)
 
 
-def _handle_mark_removals(token_database, elf_or_token_database, date):
+def _handle_mark_removals(token_database, elf_or_token_database, jobs, date):
     marked_removed = token_database.mark_removals(
-        (entry.string
-         for entry in tokens.Database.merged(*elf_or_token_database).entries()
+        (entry.string for entry in tokens.Database.merged(
+            *load_token_databases(elf_or_token_database, jobs)).entries()
          if not entry.date_removed), date)
 
     token_database.write_to_file()
@@ -239,6 +484,12 @@ class LoadTokenDatabase(argparse.Action):
             [self._load_db(path) for path in expand_paths_or_globs(values)])
 
 
+class ExpandPathsOrGlobs(argparse.Action):
+    """Argparse action that expands paths or glob patterns into a list."""
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, list(expand_paths_or_globs(values)))
+
+
 def _parse_args():
     """Parse and return command line arguments."""
     def year_month_day(value) -> datetime:
@@ -262,10 +513,17 @@ def _parse_args():
     option_tokens.add_argument(
         'elf_or_token_database',
         nargs='+',
-        action=LoadTokenDatabase,
+        action=ExpandPathsOrGlobs,
         help=(
             'ELF files or token database files from which to read strings and '
             'tokens.'))
+    option_tokens.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help=('Number of processes to use to read and tokenize the ELF files '
+              'or token databases; 0 uses one per CPU. (default: 1)'))
 
     # Top-level argument parser.
     parser = argparse.ArgumentParser(
@@ -299,6 +557,23 @@ def _parse_args():
                            '--force',
                            action='store_true',
                            help='Overwrite the database if it exists.')
+    subparser.add_argument(
+        '--stream',
+        action='store_true',
+        help=('Sort entries in chunks in temporary files and merge them while '
+              'writing, rather than holding every entry in memory.'))
+    subparser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=DEFAULT_STREAMING_CHUNK_SIZE,
+        help=(
+            'With --stream, the number of entries to sort in memory at once. '
+            '(default: %(default)s)'))
+    subparser.add_argument(
+        '--string-offsets',
+        action='store_true',
+        help=('For binary databases, append a table of string offsets so '
+              'tokens can be looked up without reading the whole database.'))
     subparser.add_argument(
         '-i',
         '--include',
@@ -22,7 +22,14 @@ in the resulting string with an error message.
 
 import re
 import struct
-from typing import Iterable, List, NamedTuple, Match, Sequence, Tuple
+from typing import (Callable, Iterable, List, NamedTuple, Match, Optional,
+                    Sequence, Tuple, Union)
+
+# Encoded data may be provided as bytes or as a view into a larger buffer.
+Buffer = Union[bytes, bytearray, memoryview]
+
+# The longest varint that is decoded: 10 bytes holds a 64-bit value.
+_MAX_VARINT_SIZE = 10
 
 
 def zigzag_decode(value: int) -> int:
@@ -32,6 +39,48 @@ def zigzag_decode(value: int) -> int:
     return (value >> 1) ^ (~0)
 
 
+# ZigZag decoded values of one-byte varints, which are the most common.
+_ZIGZAG_BYTES = tuple(zigzag_decode(byte) for byte in range(0x80))
+
+
+def decode_varint(encoded: Buffer,
+                  offset: int = 0) -> Tuple[Optional[int], int]:
+    """Decodes a varint that starts at offset; returns (value, end offset).
+
+    The value is None if the varint is not terminated within 10 bytes or by
+    the end of the data. Most encoded integers are small, so one- and two-byte
+    varints are decoded without a loop.
+    """
+    size = len(encoded)
+    byte = encoded[offset]
+
+    if byte < 0x80:
+        return byte, offset + 1
+
+    value = byte & 0x7f
+    index = offset + 1
+
+    if index < size:
+        byte = encoded[index]
+        if byte < 0x80:
+            return value | byte << 7, index + 1
+
+    end = min(size, offset + _MAX_VARINT_SIZE)
+    shift = 7
+
+    while index < end:
+        byte = encoded[index]
+        index += 1
+
+        if byte < 0x80:
+            return value | byte << shift, index
+
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+    return None, end
+
+
 class FormatSpec:
     """Represents a format specifier parsed from a printf-style string."""
 
@@ -84,93 +133,124 @@ class FormatSpec:
                 self._REMAP_TYPE.get(self.type, self.type)
             ])
 
-    def decode(self, encoded_arg: bytes) -> 'DecodedArg':
-        """Decodes the provided data according to this format specifier."""
+        # Mask for unsigned integers, which are ZigZag encoded like signed
+        # integers and must be masked off to their original bit length.
+        self._unsigned_mask = (1 << self.size_bits()) - 1
+
+        # Select the decoding function once, rather than for every argument.
+        self.decode_at: Callable[[Buffer, int],
+                                 'DecodedArg'] = self._select_decoder()
+
+    def _select_decoder(self) -> Callable[[Buffer, int], 'DecodedArg']:
         if self.type == '%':  # literal %
-            return DecodedArg(self, (),
-                              b'')  # Use () as the value for % formatting.
+            return self._decode_percent
 
         if self.type == 's':  # string
-            return self._decode_string(encoded_arg)
+            return self._decode_string
 
         if self.type == 'c':  # character
-            return self._decode_char(encoded_arg)
+            return self._decode_char
 
         if self.type in self._SIGNED_INT:
-            return self._decode_signed_integer(encoded_arg)
+            return self._decode_signed_integer
 
         if self.type in self._UNSIGNED_INT:
-            return self._decode_unsigned_integer(encoded_arg)
+            return self._decode_unsigned_integer
 
         if self.type in self._FLOATING_POINT:
-            return self._decode_float(encoded_arg)
+            return self._decode_float
 
         # Unsupported specifier (e.g. %n)
+        return self._decode_unsupported
+
+    def decode(self, encoded_arg: Buffer) -> 'DecodedArg':
+        """Decodes the provided data according to this format specifier."""
+        return self.decode_at(encoded_arg, 0)
+
+    def _decode_percent(self, unused_encoded: Buffer,
+                        unused_offset: int) -> 'DecodedArg':
+        return DecodedArg(self, (),
+                          b'')  # Use () as the value for % formatting.
+
+    def _decode_unsupported(self, unused_encoded: Buffer,
+                            unused_offset: int) -> 'DecodedArg':
         return DecodedArg(
             self, None, b'', DecodedArg.DECODE_ERROR,
             'Unsupported conversion specifier "{}"'.format(self.type))
 
-    def _decode_signed_integer(self, encoded: bytes) -> 'DecodedArg':
+    def _decode_signed_integer(self, encoded: Buffer,
+                               offset: int) -> 'DecodedArg':
         """Decodes a signed variable-length integer."""
-        if not encoded:
+        if offset >= len(encoded):
             return DecodedArg.missing(self)
 
-        count = 0
-        result = 0
-        shift = 0
+        byte = encoded[offset]
+        if byte < 0x80:
+            return DecodedArg(self, _ZIGZAG_BYTES[byte],
+                              encoded[offset:offset + 1])
 
-        for byte in encoded:
-            count += 1
-            result |= (byte & 0x7f) << shift
+        value, end = decode_varint(encoded, offset)
 
-            if not byte & 0x80:
-                return DecodedArg(self, zigzag_decode(result), encoded[:count])
+        if value is None:
+            return self._unterminated_integer(encoded, offset, end)
 
-            shift += 7
-            if shift >= 64:
-                break
+        # ZigZag decode inline, since this is the most common argument type.
+        return DecodedArg(self, (value >> 1) ^ -(value & 1),
+                          encoded[offset:end])
 
-        return DecodedArg(self, None, encoded[:count], DecodedArg.DECODE_ERROR,
-                          'Unterminated variable-length integer')
+    def _decode_unsigned_integer(self, encoded: Buffer,
+                                 offset: int) -> 'DecodedArg':
+        if offset >= len(encoded):
+            return DecodedArg.missing(self)
 
-    def _decode_unsigned_integer(self, encoded: bytes) -> 'DecodedArg':
-        arg = self._decode_signed_integer(encoded)
+        byte = encoded[offset]
+        if byte < 0x80:
+            return DecodedArg(self, _ZIGZAG_BYTES[byte] & self._unsigned_mask,
+                              encoded[offset:offset + 1])
 
-        # Since ZigZag encoding is used, unsigned integers must be masked off to
-        # their original bit length.
-        if arg.value is not None:
-            arg.value &= (1 << self.size_bits()) - 1
+        value, end = decode_varint(encoded, offset)
 
-        return arg
+        if value is None:
+            return self._unterminated_integer(encoded, offset, end)
+
+        return DecodedArg(self,
+                          ((value >> 1) ^ -(value & 1)) & self._unsigned_mask,
+                          encoded[offset:end])
+
+    def _unterminated_integer(self, encoded: Buffer, offset: int,
+                              end: int) -> 'DecodedArg':
+        return DecodedArg(self, None, encoded[offset:end],
+                          DecodedArg.DECODE_ERROR,
+                          'Unterminated variable-length integer')
 
-    def _decode_float(self, encoded: bytes) -> 'DecodedArg':
-        if len(encoded) < 4:
+    def _decode_float(self, encoded: Buffer, offset: int) -> 'DecodedArg':
+        if len(encoded) - offset < 4:
             return DecodedArg.missing(self)
 
         return DecodedArg(self,
-                          self._PACKED_FLOAT.unpack_from(encoded)[0],
-                          encoded[:4])
+                          self._PACKED_FLOAT.unpack_from(encoded, offset)[0],
+                          encoded[offset:offset + 4])
 
-    def _decode_string(self, encoded: bytes) -> 'DecodedArg':
+    def _decode_string(self, encoded: Buffer, offset: int) -> 'DecodedArg':
         """Reads a unicode string from the encoded data."""
-        if not encoded:
+        if offset >= len(encoded):
             return DecodedArg.missing(self)
 
-        size_and_status = encoded[0]
+        size_and_status = encoded[offset]
         status = DecodedArg.OK
 
         if size_and_status & 0x80:
             status |= DecodedArg.TRUNCATED
             size_and_status &= 0x7f
 
-        raw_data = encoded[0:size_and_status + 1]
+        raw_data = encoded[offset:offset + size_and_status + 1]
         data = raw_data[1:]
 
         if len(data) < size_and_status:
             status |= DecodedArg.DECODE_ERROR
 
         try:
-            decoded = data.decode()
+            decoded = str(data, 'utf-8')
         except UnicodeDecodeError as err:
             return DecodedArg(self,
                               repr(bytes(data)).lstrip('b'), raw_data,
@@ -178,9 +258,9 @@ class FormatSpec:
 
         return DecodedArg(self, decoded, raw_data, status)
 
-    def _decode_char(self, encoded: bytes) -> 'DecodedArg':
+    def _decode_char(self, encoded: Buffer, offset: int) -> 'DecodedArg':
         """Reads an integer from the data, then converts it to a string."""
-        arg = self._decode_signed_integer(encoded)
+        arg = self._decode_signed_integer(encoded, offset)
 
         if arg.ok():
             try:
@@ -221,7 +301,7 @@ class DecodedArg:
     def __init__(self,
                  specifier: FormatSpec,
                  value,
-                 raw_data: bytes,
+                 raw_data: Buffer,
                  status: int = OK,
                  error=None):
         self.specifier = specifier  # FormatSpec (e.g. to represent "%0.2f")
@@ -290,14 +370,22 @@ class FormattedString(NamedTuple):
 
 
 class FormatString:
-    """Represents a printf-style format string."""
+    """Represents a printf-style format string.
+
+    A FormatString is not modified after it is parsed, so one FormatString may
+    be used to decode and format arguments from multiple threads at once.
+    """
     def __init__(self, format_string: str):
         """Parses format specifiers in the format string."""
         self.format_string = format_string
         self.specifiers = tuple(parse_format_specifiers(self.format_string))
 
-        # List of non-specifier string pieces with room for formatted arguments.
-        self._segments = self._parse_string_segments()
+        # Non-specifier string pieces with room for formatted arguments. This is
+        # copied for each call to format rather than modified in place.
+        self._segments = tuple(self._parse_string_segments())
+
+        # The decoding function for each argument, selected when parsing.
+        self._decode_plan = tuple(spec.decode_at for spec in self.specifiers)
 
     def _parse_string_segments(self) -> List:
         """Splits the format string by format specifiers."""
@@ -321,7 +409,7 @@ class FormatString:
 
         return segments
 
-    def decode(self, encoded: bytes) -> Tuple[Sequence[DecodedArg], bytes]:
+    def decode(self, encoded: Buffer) -> Tuple[Sequence[DecodedArg], bytes]:
         """Decodes arguments according to the format string.
 
         Args:
@@ -330,13 +418,24 @@ class FormatString:
         Returns:
           tuple with the decoded arguments and any unparsed data
         """
+        if not self._decode_plan:
+            return (), bytes(encoded)
+
+        with memoryview(encoded) as data:
+            decoded_args, index = self._decode_args(data)
+
+        return decoded_args, bytes(encoded[index:])
+
+    def _decode_args(self,
+                     data: memoryview) -> Tuple[Tuple[DecodedArg, ...], int]:
+        """Decodes arguments from a view of the data without copying it."""
         decoded_args = []
 
         fatal_error = False
         index = 0
 
-        for spec in self.specifiers:
-            arg = spec.decode(encoded[index:])
+        for decode_at in self._decode_plan:
+            arg = decode_at(data, index)
 
             if fatal_error:
                 # After an error is encountered, continue to attempt to parse
@@ -349,7 +448,7 @@ class FormatString:
             decoded_args.append(arg)
             index += len(arg.raw_data)
 
-        return tuple(decoded_args), encoded[index:]
+        return tuple(decoded_args), index
 
     def format(self,
                encoded_args: bytes,
@@ -364,17 +463,28 @@ class FormatString:
         Returns:
           tuple with the formatted string, decoded arguments, and remaining data
         """
-        # Insert formatted arguments in place of each format specifier.
         args, remaining = self.decode(encoded_args)
+        return self.format_decoded(args, remaining, show_errors)
+
+    def format_decoded(self,
+                       args: Sequence[DecodedArg],
+                       remaining: bytes,
+                       show_errors: bool = False) -> FormattedString:
+        """Formats the string with arguments previously returned by decode."""
+        # Insert formatted arguments in place of each format specifier.
+        if not args:
+            return FormattedString(self.format_string, args, remaining)
+
+        segments = list(self._segments)
 
         if show_errors:
-            self._segments[1::2] = (arg.format() for arg in args)
+            segments[1::2] = (arg.format() for arg in args)
         else:
-            self._segments[1::2] = (arg.format()
-                                    if arg.ok() else arg.specifier.specifier
-                                    for arg in args)
+            segments[1::2] = (arg.format()
+                              if arg.ok() else arg.specifier.specifier
+                              for arg in args)
 
-        return FormattedString(''.join(self._segments), args, remaining)
+        return FormattedString(''.join(segments), args, remaining)
 
 
 def decode(format_string: str,
@@ -27,6 +27,10 @@ For example,
   detok = detokenize.Detokenizer('path/to/my/image.elf')
   print(detok.detokenize(b'\x12\x34\x56\x78\x03hi!'))
 
+Prefixed Base64 messages in text may be detokenized from bytes, files, or
+asyncio streams. detokenize_base64_streams detokenizes many asyncio streams
+concurrently with one shared Detokenizer.
+
 This module also provides a command line interface for decoding and detokenizing
 messages from a file or stdin.
 """
@@ -34,18 +38,26 @@ messages from a file or stdin.
 from __future__ import division
 
 import argparse
+import asyncio
 import base64
 import binascii
+import collections
+import concurrent.futures
 from datetime import datetime
 import io
+import itertools
+import json
 import logging
+import mmap
 import os
 import re
-import string
 import struct
 import sys
+import threading
 import time
-from typing import Dict, List, Iterable, NamedTuple, Optional, Tuple
+from typing import (AsyncIterator, Callable, Deque, Dict, Hashable, Iterable,
+                    Iterator, List, Mapping, Match, NamedTuple, Optional,
+                    Sequence, Tuple, Union)
 
 try:
     from pw_tokenizer import database, decoder, tokens
@@ -60,8 +72,57 @@ ENCODED_TOKEN = struct.Struct('<I')
 _LOG = logging.getLogger('pw_tokenizer')
 
 
+def _score(entry: tokens.TokenizedStringEntry,
+           args: Sequence[decoder.DecodedArg], remaining: bytes) -> Tuple:
+    """Scores an attempt to decode a message's arguments with a string.
+
+    Competing entries are sorted by score so the most likely matches appear
+    first. Decoded strings are prioritized by whether they
+
+      1. decoded all bytes for all arguments without errors,
+      2. decoded all data,
+      3. have the fewest decoding errors,
+      4. decoded the most arguments successfully, or
+      5. have the most recent removal date, if they were removed.
+
+    This must match the collision resolution logic in detokenize.cc.
+    """
+    return (
+        all(arg.ok() for arg in args) and not remaining,
+        not remaining,  # decoded all data
+        -sum(not arg.ok() for arg in args),  # fewest errors
+        len(args),  # decoded the most arguments
+        entry.date_removed or datetime.max)  # most recently present
+
+
+class _DecodeAttempt:
+    """Arguments decoded with a format string, which are formatted on demand."""
+    __slots__ = ('format_string', 'args', 'remaining', 'success', '_result')
+
+    def __init__(self, format_string: decoder.FormatString,
+                 encoded_args: bytes):
+        self.format_string = format_string
+        self.args, self.remaining = format_string.decode(encoded_args)
+        self.success = not self.remaining and all(arg.ok()
+                                                  for arg in self.args)
+        self._result: Optional[decoder.FormattedString] = None
+
+    def result(self, show_errors: bool) -> decoder.FormattedString:
+        if self._result is None:
+            self._result = self.format_string.format_decoded(
+                self.args, self.remaining, show_errors)
+
+        return self._result
+
+
 class DetokenizedString:
-    """A detokenized string, with all results if there are collisions."""
+    """A detokenized string, with all results if there are collisions.
+
+    Arguments are decoded for each candidate string when the DetokenizedString
+    is created, which is all that is needed to rank the candidates and for ok.
+    Strings are only formatted when they are requested, and best_result and
+    str only format the most likely string.
+    """
     def __init__(self,
                  token: Optional[int],
                  format_string_entries: Iterable[tuple],
@@ -71,74 +132,82 @@ class DetokenizedString:
         self.encoded_message = encoded_message
         self._show_errors = show_errors
 
-        self.successes: List[decoder.FormattedString] = []
-        self.failures: List[decoder.FormattedString] = []
+        if not isinstance(format_string_entries, (list, tuple)):
+            format_string_entries = tuple(format_string_entries)
+
+        encoded_args = encoded_message[ENCODED_TOKEN.size:]
+
+        # Without collisions, there is nothing to rank, so skip scoring.
+        if len(format_string_entries) == 1:
+            _, fmt = format_string_entries[0]
+            self._attempts = [_DecodeAttempt(fmt, encoded_args)]
+            self._success_count = int(self._attempts[0].success)
+            return
 
-        decode_attempts: List[Tuple[Tuple, decoder.FormattedString]] = []
+        decode_attempts: List[Tuple[Tuple, _DecodeAttempt]] = []
 
         for entry, fmt in format_string_entries:
-            result = fmt.format(encoded_message[ENCODED_TOKEN.size:],
-                                show_errors)
-
-            # Sort competing entries so the most likely matches appear first.
-            # Decoded strings are prioritized by whether they
-            #
-            #   1. decoded all bytes for all arguments without errors,
-            #   2. decoded all data,
-            #   3. have the fewest decoding errors,
-            #   4. decoded the most arguments successfully, or
-            #   5. have the most recent removal date, if they were removed.
-            #
-            # This must match the collision resolution logic in detokenize.cc.
-            score: Tuple = (
-                all(arg.ok() for arg in result.args) and not result.remaining,
-                not result.remaining,  # decoded all data
-                -sum(not arg.ok() for arg in result.args),  # fewest errors
-                len(result.args),  # decoded the most arguments
-                entry.date_removed or datetime.max)  # most recently present
-
-            decode_attempts.append((score, result))
+            attempt = _DecodeAttempt(fmt, encoded_args)
+            score = _score(entry, attempt.args, attempt.remaining)
+            decode_attempts.append((score, attempt))
 
         # Sort the attempts by the score so the most likely results are first.
+        # Since successful decodes score highest, they come before failures.
         decode_attempts.sort(key=lambda value: value[0], reverse=True)
 
-        # Split out the successesful decodes from the failures.
-        for score, result in decode_attempts:
-            if score[0]:
-                self.successes.append(result)
-            else:
-                self.failures.append(result)
+        self._attempts = [attempt for _, attempt in decode_attempts]
+        self._success_count = sum(attempt.success
+                                  for attempt in self._attempts)
+
+    @property
+    def successes(self) -> List[decoder.FormattedString]:
+        """Strings that decoded all arguments without errors, best first."""
+        return [
+            attempt.result(self._show_errors)
+            for attempt in self._attempts[:self._success_count]
+        ]
+
+    @property
+    def failures(self) -> List[decoder.FormattedString]:
+        """Strings that did not decode the arguments, most likely first."""
+        return [
+            attempt.result(self._show_errors)
+            for attempt in self._attempts[self._success_count:]
+        ]
 
     def ok(self) -> bool:
         """True if exactly one string decoded the arguments successfully."""
-        return len(self.successes) == 1
+        return self._success_count == 1
 
     def matches(self) -> List[decoder.FormattedString]:
         """Returns the strings that matched the token, best matches first."""
-        return self.successes + self.failures
+        return [
+            attempt.result(self._show_errors) for attempt in self._attempts
+        ]
 
     def best_result(self) -> Optional[decoder.FormattedString]:
         """Returns the string and args for the most likely decoded string."""
-        for string_and_args in self.matches():
-            return string_and_args
+        if not self._attempts:
+            return None
 
-        return None
+        return self._attempts[0].result(self._show_errors)
 
     def error_message(self) -> str:
         """If detokenization failed, returns a descriptive message."""
         if self.ok():
             return ''
 
-        if not self.matches():
+        if not self._attempts:
             if self.token is None:
                 return 'missing token'
 
             return 'unknown token {:08x}'.format(self.token)
 
-        if len(self.matches()) == 1:
-            return 'decoding failed for {!r}'.format(self.matches()[0].value)
+        if len(self._attempts) == 1:
+            result = self._attempts[0].result(self._show_errors)
+            return 'decoding failed for {!r}'.format(result.value)
 
-        return '{} matches'.format(len(self.matches()))
+        return '{} matches'.format(len(self._attempts))
 
     def __str__(self) -> str:
         """Returns the string for the most likely result."""
@@ -166,48 +235,482 @@ class _TokenizedFormatString(NamedTuple):
     format: decoder.FormatString
 
 
+# Packed StructuredMessage records; see StructuredMessage.pack.
+_PACKED_HEADER = struct.Struct('<IBIBH')
+_PACKED_ARG = struct.Struct('<BB')
+_PACKED_SIZE = struct.Struct('<H')
+_PACKED_NONE = 0
+_PACKED_INT = 1
+_PACKED_UINT = 2
+_PACKED_FLOAT = 3
+_PACKED_STRING = 4
+_PACKED_VALUE = {
+    _PACKED_INT: struct.Struct('<q'),
+    _PACKED_UINT: struct.Struct('<Q'),
+    _PACKED_FLOAT: struct.Struct('<d'),
+}
+
+_PACKED_HAS_TOKEN = 0x1
+_PACKED_OK = 0x2
+_PACKED_HAS_FORMAT_STRING = 0x4
+
+# The argument count is a uint8, so at most this many arguments are packed.
+_PACKED_MAX_ARGS = 0xff
+
+
+def _pack_arg(value, status: int) -> bytes:
+    if value is None:
+        return _PACKED_ARG.pack(_PACKED_NONE, status)
+
+    if isinstance(value, str):
+        data = value.encode(errors='surrogatepass')
+        return (_PACKED_ARG.pack(_PACKED_STRING, status) +
+                _PACKED_SIZE.pack(len(data)) + data)
+
+    if isinstance(value, float):
+        arg_type = _PACKED_FLOAT
+    elif -2**63 <= value < 2**63:
+        arg_type = _PACKED_INT
+    elif 0 <= value < 2**64:
+        arg_type = _PACKED_UINT
+    else:
+        # Corrupt varints may decode to values that do not fit in 64 bits.
+        return _PACKED_ARG.pack(_PACKED_NONE,
+                                status | decoder.DecodedArg.DECODE_ERROR)
+
+    return (_PACKED_ARG.pack(arg_type, status) +
+            _PACKED_VALUE[arg_type].pack(value))
+
+
+class StructuredMessage(NamedTuple):
+    """A decoded message with typed argument values instead of a string.
+
+    Arguments are decoded but never formatted. args holds the decoded value of
+    each argument (int, float, or str; None if it failed to decode) and
+    statuses holds the corresponding DecodedArg status flags. %% specifiers
+    are not included.
+    """
+    token: Optional[int]
+    format_string: Optional[str]
+    args: Tuple
+    statuses: Tuple[int, ...]
+    ok: bool
+    remaining: bytes = b''
+
+    def to_json(self) -> str:
+        """Returns the message as a compact, single-line JSON object."""
+        record = {
+            'token': self.token,
+            'format': self.format_string,
+            'args': self.args,
+            'status': self.statuses,
+            'ok': self.ok,
+        }
+        if self.remaining:
+            record['remaining'] = self.remaining.hex()
+
+        return json.dumps(record, separators=(',', ':'))
+
+    def pack(self) -> bytes:
+        """Returns the message as a packed, little-endian binary record.
+
+        A record starts with a header: the record size in bytes, including the
+        header (uint32); flags (uint8; 0x1: has token, 0x2: ok, 0x4: has format
+        string); the token (uint32); the argument count (uint8); and the format
+        string size (uint16). The UTF-8 format string follows. Each argument is
+        a type (uint8; 0: none, 1: int64, 2: uint64, 3: double, 4: string),
+        its status flags (uint8), and its value, if any. Strings are a uint16
+        size followed by UTF-8. The record ends with the size (uint16) and
+        bytes of any data that was not decoded.
+
+        Integers that do not fit in 64 bits are packed as type none with the
+        decode error status. Only the first 255 arguments are packed. Records
+        with either problem are not marked ok.
+        """
+        format_string = (self.format_string or '').encode()
+        args = tuple(zip(self.args, self.statuses))[:_PACKED_MAX_ARGS]
+        packed_args = [_pack_arg(value, status) for value, status in args]
+        body = b''.join([
+            format_string,
+            *packed_args,
+            _PACKED_SIZE.pack(len(self.remaining)),
+            self.remaining,
+        ])
+
+        # Values that could not be packed are packed with type none.
+        all_packed = len(args) == len(self.args) and all(
+            value is None or packed[0] != _PACKED_NONE
+            for (value, _), packed in zip(args, packed_args))
+
+        flags = 0
+        if self.token is not None:
+            flags |= _PACKED_HAS_TOKEN
+        if self.ok and all_packed:
+            flags |= _PACKED_OK
+        if self.format_string is not None:
+            flags |= _PACKED_HAS_FORMAT_STRING
+
+        return _PACKED_HEADER.pack(_PACKED_HEADER.size + len(body), flags,
+                                   self.token or 0, len(args),
+                                   len(format_string)) + body
+
+
+def _decode_structured(token: Optional[int],
+                       format_string_entries: Sequence[_TokenizedFormatString],
+                       encoded_message: bytes) -> StructuredMessage:
+    """Decodes a message's arguments without formatting them."""
+    encoded_args = encoded_message[ENCODED_TOKEN.size:]
+
+    if not format_string_entries:
+        return StructuredMessage(token, None, (), (), False,
+                                 bytes(encoded_args))
+
+    # Without collisions, there is nothing to rank, so skip scoring.
+    if len(format_string_entries) == 1:
+        _, fmt = format_string_entries[0]
+        args, remaining = fmt.decode(encoded_args)
+        ok = not remaining and all(arg.ok() for arg in args)
+    else:
+        attempts = []
+        for entry, fmt in format_string_entries:
+            args, remaining = fmt.decode(encoded_args)
+            score = _score(entry, args, remaining)
+            attempts.append((score, fmt, args, remaining))
+
+        # Choose the most likely string as DetokenizedString does.
+        attempts.sort(key=lambda attempt: attempt[0], reverse=True)
+        _, fmt, args, remaining = attempts[0]
+        ok = sum(attempt[0][0] for attempt in attempts) == 1
+
+    values = []
+    statuses = []
+
+    for arg in args:
+        if arg.specifier.type != '%':
+            values.append(arg.value)
+            statuses.append(arg.status)
+
+    return StructuredMessage(token, fmt.format_string, tuple(values),
+                             tuple(statuses), ok, bytes(remaining))
+
+
+class CacheStats(NamedTuple):
+    """Counters for a bounded cache, for sizing it in production."""
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    max_size: int
+
+
+class _LruCache:
+    """Thread-safe, bounded, least-recently-used cache with usage counters.
+
+    A cache with a max_size of 0 stores nothing, but still counts misses.
+    """
+    def __init__(self, max_size: int):
+        if max_size < 0:
+            raise ValueError('The cache size cannot be negative')
+
+        self.max_size = max_size
+        self._items: 'collections.OrderedDict' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value for the key or None, and updates the counters."""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._items[key]
+
+    def put(self, key, value) -> None:
+        if not self.max_size:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> CacheStats:
+        return CacheStats(self.hits, self.misses, self.evictions,
+                          len(self._items), self.max_size)
+
+
+DEFAULT_FORMAT_CACHE_SIZE = 2**16
+DEFAULT_UNKNOWN_TOKEN_CACHE_SIZE = 2**10
+
+DEFAULT_CONCURRENT_BATCH_SIZE = 1024
+
+
 class Detokenizer:
-    """Main detokenization class; detokenizes strings and caches results."""
-    def __init__(self, *token_database_or_elf, show_errors: bool = False):
+    """Main detokenization class; detokenizes strings and caches results.
+
+    A Detokenizer may be shared by multiple threads. The database's token index
+    is built when the Detokenizer is created, its caches are protected by
+    locks, and FormatStrings are not modified when formatting, so detokenize,
+    detokenize_many, and lookup may be called concurrently.
+    detokenize_concurrently distributes a sequence of messages to a thread
+    pool.
+    """
+    def __init__(
+            self,
+            *token_database_or_elf,
+            show_errors: bool = False,
+            result_cache_size: int = 0,
+            format_cache_size: int = DEFAULT_FORMAT_CACHE_SIZE,
+            unknown_token_cache_size: int = DEFAULT_UNKNOWN_TOKEN_CACHE_SIZE,
+            prewarm: bool = False):
         """Decodes and detokenizes binary messages.
 
         Args:
           *token_database_or_elf: a path or file object for an ELF or CSV
-              database, a tokens.Database, or an elf_reader.Elf
+              database, a tokens.Database, a tokens.MappedDatabase, or an
+              elf_reader.Elf
           show_errors: if True, an error message is used in place of the %
               conversion specifier when an argument fails to decode
+          result_cache_size: if nonzero, the number of DetokenizedStrings to
+              cache, keyed by the full encoded message; helpful when the same
+              messages are detokenized repeatedly
+          format_cache_size: the number of tokens for which to cache parsed
+              FormatStrings; the least recently used are evicted; 0 disables
+              the cache
+          unknown_token_cache_size: the number of tokens not in the database
+              to remember, so corrupt data cannot evict known tokens; 0
+              disables the cache
+          prewarm: if True, start parsing the database's format strings in a
+              background thread (see prewarm)
         """
         self.database = database.load_token_database(*token_database_or_elf)
         self.show_errors = show_errors
 
-        # Cache FormatStrings for faster lookup & formatting.
-        self._cache: Dict[int, List[_TokenizedFormatString]] = {}
+        # Build the token index now, before any threads use it. Looking up a
+        # token in a partially built index would cache it as unknown.
+        _ = self.database.token_to_entries
+
+        # Cache FormatStrings for faster lookup & formatting. Unknown tokens
+        # are tracked separately, since they are often from corrupt data.
+        self._format_cache = _LruCache(format_cache_size)
+        self._unknown_tokens = _LruCache(unknown_token_cache_size)
+
+        # Optionally, cache results for frequently repeated messages.
+        self._result_cache: Optional[_LruCache] = (
+            _LruCache(result_cache_size) if result_cache_size else None)
+
+        if prewarm:
+            self.prewarm()
 
     def lookup(self, token: int) -> List[_TokenizedFormatString]:
         """Returns (TokenizedStringEntry, FormatString) list for matches."""
-        try:
-            return self._cache[token]
-        except KeyError:
-            format_strings = [
-                _TokenizedFormatString(entry, decoder.FormatString(str(entry)))
-                for entry in self.database.token_to_entries[token]
-            ]
-            self._cache[token] = format_strings
+        format_strings = self._format_cache.get(token)
+        if format_strings is not None:
             return format_strings
 
+        if self._unknown_tokens.get(token) is not None:
+            return []
+
+        # Check membership first; indexing Database.token_to_entries with an
+        # unknown token would add an empty list to it.
+        if token not in self.database.token_to_entries:
+            self._unknown_tokens.put(token, True)
+            return []
+
+        format_strings = self._format_strings(token)
+        self._format_cache.put(token, format_strings)
+        return format_strings
+
+    def prewarm(self) -> threading.Thread:
+        """Parses format strings in a background thread to fill the cache.
+
+        Tokens are added until the format string cache is full. Tokens that
+        were already looked up are left as they are. Returns the started
+        daemon thread, which may be joined to wait for it to finish.
+        """
+        # Build the token index before starting the thread. Otherwise, lookups
+        # could see a partially built index and cache known tokens as unknown.
+        _ = self.database.token_to_entries
+
+        thread = threading.Thread(target=self._prewarm,
+                                  name='pw_tokenizer prewarm',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _prewarm(self) -> None:
+        cache = self._format_cache
+
+        for token in self.database.token_to_entries:
+            if len(cache) >= cache.max_size:
+                break
+
+            if token not in cache:
+                cache.put(token, self._format_strings(token))
+
+    def _format_strings(self, token: int) -> List[_TokenizedFormatString]:
+        return [
+            _TokenizedFormatString(entry, decoder.FormatString(str(entry)))
+            for entry in self.database.token_to_entries[token]
+        ]
+
+    def format_cache_stats(self) -> CacheStats:
+        """Returns counters for the parsed format string cache."""
+        return self._format_cache.stats()
+
+    def unknown_token_cache_stats(self) -> CacheStats:
+        """Returns counters for the cache of tokens not in the database."""
+        return self._unknown_tokens.stats()
+
     def detokenize(self, encoded_message: bytes) -> DetokenizedString:
         """Decodes and detokenizes a message as a DetokenizedString."""
+        return self._detokenize_with_cache(encoded_message, self.lookup)
+
+    def detokenize_many(
+            self,
+            encoded_messages: Iterable[bytes]) -> List[DetokenizedString]:
+        """Detokenizes many messages; returns results in the same order.
+
+        This is equivalent to calling detokenize on each message, but each
+        distinct token is looked up only once for the whole batch, and
+        identical messages in the batch share one DetokenizedString.
+        """
+        format_strings: Dict[int, List[_TokenizedFormatString]] = {}
+
+        def lookup(token: int) -> List[_TokenizedFormatString]:
+            try:
+                return format_strings[token]
+            except KeyError:
+                candidates = format_strings[token] = self.lookup(token)
+                return candidates
+
+        decoded: Dict[bytes, DetokenizedString] = {}
+        results = []
+
+        for encoded_message in encoded_messages:
+            key = bytes(encoded_message)
+
+            try:
+                result = decoded[key]
+            except KeyError:
+                result = decoded[key] = self._detokenize_with_cache(
+                    key, lookup)
+
+            results.append(result)
+
+        return results
+
+    def detokenize_concurrently(
+        self,
+        encoded_messages: Iterable[bytes],
+        workers: Optional[int] = None,
+        batch_size: int = DEFAULT_CONCURRENT_BATCH_SIZE
+    ) -> List[DetokenizedString]:
+        """Detokenizes messages with a thread pool; returns them in order.
+
+        Messages are split into batches of batch_size, which are passed to
+        detokenize_many in worker threads. Threads only run in parallel where
+        the Python interpreter allows, but this is useful to share one
+        Detokenizer with other threads, such as a server's request handlers.
+
+        Args:
+          encoded_messages: the messages to detokenize
+          workers: the number of threads; None uses the ThreadPoolExecutor
+              default
+          batch_size: the number of messages to detokenize in each task
+        """
+        if batch_size <= 0:
+            raise ValueError('The batch size must be positive')
+
+        messages = iter(encoded_messages)
+        batches = iter(lambda: list(itertools.islice(messages, batch_size)),
+                       [])
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            return [
+                result for results in pool.map(self.detokenize_many, batches)
+                for result in results
+            ]
+
+    def decode_structured(self, encoded_message: bytes) -> StructuredMessage:
+        """Decodes a message's arguments as typed values, without formatting.
+
+        The most likely format string is chosen as in detokenize.
+        """
+        if len(encoded_message) < ENCODED_TOKEN.size:
+            return StructuredMessage(None, None, (), (), False,
+                                     bytes(encoded_message))
+
+        token, = ENCODED_TOKEN.unpack_from(encoded_message)
+        return _decode_structured(token, self.lookup(token), encoded_message)
+
+    def result_cache_stats(self) -> CacheStats:
+        """Returns counters for the result cache; all 0 if it is disabled."""
+        if self._result_cache is None:
+            return CacheStats(0, 0, 0, 0, 0)
+
+        return self._result_cache.stats()
+
+    def _detokenize_with_cache(
+        self, encoded_message: bytes,
+        lookup: Callable[[int], List[_TokenizedFormatString]]
+    ) -> DetokenizedString:
+        if self._result_cache is None:
+            return self._detokenize(encoded_message, lookup)
+
+        key = bytes(encoded_message)
+        result = self._result_cache.get(key)
+
+        if result is None:
+            result = self._detokenize(encoded_message, lookup)
+            self._result_cache.put(key, result)
+
+        return result
+
+    def _detokenize(
+        self, encoded_message: bytes,
+        lookup: Callable[[int], List[_TokenizedFormatString]]
+    ) -> DetokenizedString:
         if len(encoded_message) < ENCODED_TOKEN.size:
             return DetokenizedString(None, (), encoded_message,
                                      self.show_errors)
 
         token, = ENCODED_TOKEN.unpack_from(encoded_message)
-        return DetokenizedString(token, self.lookup(token), encoded_message,
+        return DetokenizedString(token, lookup(token), encoded_message,
                                  self.show_errors)
 
 
 class AutoUpdatingDetokenizer:
-    """Loads and updates a detokenizer from database paths."""
+    """Loads and updates a detokenizer from database paths.
+
+    By default, detokenize checks whether the databases changed, at most once
+    per min_poll_period_s, and reloads them before detokenizing. With
+    background_reload, a daemon thread checks the paths and loads changed
+    databases instead. The new Detokenizer replaces the old one once it is
+    fully loaded, so detokenize never waits for a reload. Call close (or use
+    the AutoUpdatingDetokenizer as a context manager) to stop the thread.
+    """
     class _DatabasePath:
         """Tracks the modified time of a path."""
         def __init__(self, path):
@@ -230,29 +733,77 @@ class AutoUpdatingDetokenizer:
             except FileNotFoundError:
                 return None
 
-        def load(self) -> tokens.Database:
+        def load(self) -> Union[tokens.Database, tokens.MappedDatabase]:
             try:
                 return database.load_token_database(self.path)
             except FileNotFoundError:
                 return database.load_token_database()
 
-    def __init__(self, *paths_or_files, min_poll_period_s: float = 1.0):
+    def __init__(self,
+                 *paths_or_files,
+                 min_poll_period_s: float = 1.0,
+                 background_reload: bool = False):
         self.paths = tuple(self._DatabasePath(path) for path in paths_or_files)
         self.min_poll_period_s = min_poll_period_s
         self._last_checked_time: float = time.time()
-        self._detokenizer = Detokenizer(*(path.load() for path in self.paths))
+        self._detokenizer = self._load()
+
+        self._stop = threading.Event()
+        self._reload_thread: Optional[threading.Thread] = None
+
+        if background_reload:
+            self._reload_thread = threading.Thread(
+                target=self._reload_periodically,
+                name='pw_tokenizer database reload',
+                daemon=True)
+            self._reload_thread.start()
+
+    def _load(self) -> Detokenizer:
+        return Detokenizer(*(path.load() for path in self.paths))
+
+    def _reload_if_updated(self) -> None:
+        if any(path.updated() for path in self.paths):
+            _LOG.info('Changes detected; reloading token database')
+            self._detokenizer = self._load()
+
+    def _reload_periodically(self) -> None:
+        while not self._stop.wait(self.min_poll_period_s):
+            try:
+                self._reload_if_updated()
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception('Failed to reload token database; '
+                               'continuing with the previous database')
+
+    def _current(self) -> Detokenizer:
+        """Returns the Detokenizer, after reloading it if necessary."""
+        if self._reload_thread is None and (time.time() -
+                                            self._last_checked_time
+                                            >= self.min_poll_period_s):
+            self._last_checked_time = time.time()
+            self._reload_if_updated()
+
+        return self._detokenizer
 
     def detokenize(self, data: bytes) -> DetokenizedString:
         """Updates the token database if it has changed, then detokenizes."""
-        if time.time() - self._last_checked_time >= self.min_poll_period_s:
-            self._last_checked_time = time.time()
+        return self._current().detokenize(data)
+
+    def decode_structured(self, data: bytes) -> StructuredMessage:
+        """Updates the token database if it has changed, then decodes."""
+        return self._current().decode_structured(data)
+
+    def close(self) -> None:
+        """Stops the background reload thread, if there is one."""
+        self._stop.set()
 
-            if any(path.updated() for path in self.paths):
-                _LOG.info('Changes detected; reloading token database')
-                self._detokenizer = Detokenizer(*(path.load()
-                                                  for path in self.paths))
+        if self._reload_thread is not None:
+            self._reload_thread.join()
 
-        return self._detokenizer.detokenize(data)
+    def __enter__(self) -> 'AutoUpdatingDetokenizer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
 class PrefixedMessageDecoder:
@@ -320,63 +871,365 @@ class PrefixedMessageDecoder:
             yield transform(chunk) if is_message else chunk
 
 
-def _detokenize_prefixed_base64(detokenizer, prefix, recursion):
-    """Returns a function that decodes prefixed Base64 with the detokenizer."""
-    def decode_and_detokenize(original):
-        """Decodes prefixed base64 with the provided detokenizer."""
+DEFAULT_NESTED_CACHE_SIZE = 4096
+
+
+class _ExpansionFrame:
+    """A partially expanded message in _NestedBase64Expander.expand."""
+    __slots__ = ('key', 'recursion', 'text', 'matches', 'index', 'pieces')
+
+    def __init__(self, key: Tuple[bytes, int], text: bytes,
+                 matches: Iterator[Match[bytes]]):
+        self.key = key
+        self.recursion = key[1] - 1  # recursion for nested messages
+        self.text = text
+        self.matches = matches
+        self.index = 0
+        self.pieces: List[bytes] = []
+
+    def add_text(self, end: Optional[int] = None) -> None:
+        """Adds the unexpanded text from the current index to end."""
+        self.pieces.append(self.text[self.index:end])
+
+
+class _NestedBase64Expander:
+    """Detokenizes prefixed Base64 messages that contain nested messages.
+
+    Nested messages are expanded with an explicit stack rather than recursion.
+    Within a message, expansions are cached by nested message and remaining
+    recursion depth, so repeated nested messages are only expanded once.
+    Detokenized text that does not contain the prefix is not scanned for
+    messages. Optionally, the expansions of whole messages are cached in an
+    LRU cache.
+    """
+    def __init__(self, detokenizer, prefix: bytes, cache: bool = True):
+        self._detokenizer = detokenizer
+        self._prefix = prefix
+        self._messages = _base64_message_regex(prefix)
+        self._cache: Optional[_LruCache] = (
+            _LruCache(DEFAULT_NESTED_CACHE_SIZE) if cache else None)
+
+    def expand(self, message: bytes, recursion: int) -> bytes:
+        """Detokenizes a message and up to recursion levels of nested ones."""
+        key = (bytes(message), recursion)
+
+        if self._cache is None:
+            return self._expand(key)
+
+        result = self._cache.get(key)
+        if result is None:
+            result = self._expand(key)
+            self._cache.put(key, result)
+
+        return result
+
+    def _expand(self, key: Tuple[bytes, int]) -> bytes:
+        expanded: Dict[Tuple[bytes, int], bytes] = {}
+        result, frame = self._start(key, expanded)
+
+        if frame is None:
+            return result
+
+        stack = [frame]
+
+        while stack:
+            frame = stack[-1]
+            match = next(frame.matches, None)
+
+            if match is None:  # All nested messages in this one are expanded.
+                frame.add_text()
+                result = expanded[frame.key] = b''.join(frame.pieces)
+
+                stack.pop()
+                if stack:
+                    stack[-1].pieces.append(result)
+                continue
+
+            frame.add_text(match.start())
+            frame.index = match.end()
+
+            nested, nested_frame = self._start(
+                (match.group(0), frame.recursion), expanded)
+            if nested_frame is None:
+                frame.pieces.append(nested)
+            else:
+                stack.append(nested_frame)
+
+        return result
+
+    def _start(
+        self, key: Tuple[bytes, int], expanded: Dict[Tuple[bytes, int], bytes]
+    ) -> Tuple[bytes, Optional[_ExpansionFrame]]:
+        """Returns the message's expansion, or a frame for expanding it."""
         try:
-            result = detokenizer.detokenize(
-                base64.b64decode(original[1:], validate=True))
-            if result.matches():
-                result = str(result).encode()
+            return expanded[key], None
+        except KeyError:
+            pass
+
+        message, recursion = key
+        text = self._detokenize(message)
 
-                if recursion > 0 and original != result:
-                    result = detokenize_base64(detokenizer, result, prefix,
-                                               recursion - 1)
+        if text is None:
+            text = message
+        elif recursion > 0 and text != message and self._prefix in text:
+            return b'', _ExpansionFrame(key, text,
+                                        self._messages.finditer(text))
 
-                return result
+        expanded[key] = text
+        return text, None
+
+    def _detokenize(self, message: bytes) -> Optional[bytes]:
+        """Returns the detokenized message, or None if it doesn't decode."""
+        try:
+            result = self._detokenizer.detokenize(
+                base64.b64decode(message[1:], validate=True))
         except binascii.Error:
-            pass
+            return None
+
+        best = result.best_result()
+        return None if best is None else best.value.encode()
+
 
-        return original
+def _detokenize_prefixed_base64(detokenizer, prefix, recursion):
+    """Returns a function that decodes prefixed Base64 with the detokenizer."""
+    if isinstance(prefix, str):
+        prefix = prefix.encode()
+
+    # AutoUpdatingDetokenizer may reload its database, so don't cache results.
+    expander = _NestedBase64Expander(detokenizer,
+                                     prefix,
+                                     cache=isinstance(detokenizer,
+                                                      Detokenizer))
+
+    def decode_and_detokenize(original):
+        """Decodes prefixed base64 with the provided detokenizer."""
+        return expander.expand(original, recursion)
 
     return decode_and_detokenize
 
 
 DEFAULT_RECURSION = 9
 
+# Defaults for reading Base64 messages from a stream in chunks.
+DEFAULT_STREAM_CHUNK_SIZE = 2**16
+DEFAULT_MAX_MESSAGE_SIZE = 2**16
+
+# Characters that may appear in a prefixed Base64 message.
+_BASE64_MESSAGE_CHARS = re.compile(br'[A-Za-z0-9+/\-_=]*')
+
+
+def _base64_message_regex(prefix: bytes):
+    return re.compile(
+        re.escape(prefix) +
+        (br'(?:[A-Za-z0-9+/\-_]{4})*'
+         br'(?:[A-Za-z0-9+/\-_]{3}=|[A-Za-z0-9+/\-_]{2}==)?'))
+
+
+def _incomplete_message_start(data: bytes, prefix: bytes) -> int:
+    """Returns the start of a message that may continue past the data."""
+    start = data.rfind(prefix)
+
+    if start != -1 and _BASE64_MESSAGE_CHARS.fullmatch(data, start + 1):
+        return start
+
+    return len(data)
+
+
+class _Base64StreamDecoder:
+    """Detokenizes prefixed Base64 from a stream that arrives in chunks.
+
+    Only a message that may continue in the next chunk is kept between calls
+    to feed, so memory use is bounded for streams of any length.
+    """
+    def __init__(self, detokenizer, prefix, recursion: int,
+                 max_message_size: int):
+        self._prefix = prefix.encode() if isinstance(prefix, str) else prefix
+        self._transform = _detokenize_prefixed_base64(detokenizer,
+                                                      self._prefix, recursion)
+        self._messages = _base64_message_regex(self._prefix)
+        self._max_message_size = max_message_size
+        self._pending = b''
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Returns the detokenized data that is complete after this chunk."""
+        data = self._pending + chunk
+        end = _incomplete_message_start(data, self._prefix)
+
+        if len(data) - end > self._max_message_size:
+            end = len(data)
+
+        self._pending = data[end:]
+        return self._decode(data[:end])
+
+    def finish(self) -> bytes:
+        """Returns the remaining detokenized data at the end of the stream."""
+        data, self._pending = self._pending, b''
+        return self._decode(data)
+
+    def _decode(self, data: bytes) -> bytes:
+        if not data:
+            return b''
+
+        output = io.BytesIO()
+        _detokenize_base64_matches(self._messages, self._transform, data,
+                                   output)
+        return output.getvalue()
+
+
+def _read_available(file) -> Callable[[int], bytes]:
+    """Returns a function that reads up to size bytes of the available data.
+
+    read1 is used if the file has it. Files with in_waiting but no read1, such
+    as pyserial's Serial, read the waiting bytes, or wait for one byte if none
+    are waiting. Otherwise, read is used, which may wait for all size bytes.
+    """
+    read1 = getattr(file, 'read1', None)
+    if read1 is not None:
+        return read1
+
+    if hasattr(file, 'in_waiting'):
+        return lambda size: file.read(max(1, min(size, file.in_waiting)))
+
+    return file.read
+
 
 def detokenize_base64_live(detokenizer,
                            input_file,
                            output,
                            prefix=b'$',
-                           recursion=DEFAULT_RECURSION):
-    """Reads chars one-at-a-time and decodes messages; SLOW for big files."""
-    transform = _detokenize_prefixed_base64(detokenizer, prefix, recursion)
+                           recursion=DEFAULT_RECURSION,
+                           chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+                           max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+    """Decodes prefixed Base64 messages from a stream as data arrives.
+
+    Each read returns whatever data is available, up to chunk_size bytes.
+    read1 is used if the file has it. Otherwise, files with in_waiting (such as
+    pyserial's Serial) read the waiting bytes. Messages in the data are decoded
+    with the same rules as detokenize_base64_to_file. Only a message that may
+    continue in the next read is kept between reads, so memory use is bounded
+    for streams of any length. A message longer than max_message_size is
+    decoded as is, without waiting for its end.
+
+    Output is flushed after each read to avoid delays when piping between
+    processes.
+    """
+    stream = _Base64StreamDecoder(detokenizer, prefix, recursion,
+                                  max_message_size)
+    read = _read_available(input_file)
 
-    for message in PrefixedMessageDecoder(
-            prefix, string.ascii_letters + string.digits + '+/-_=').transform(
-                input_file, transform):
-        output.write(message)
+    while True:
+        chunk = read(chunk_size)
 
-        # Flush each line to prevent delays when piping between processes.
-        if b'\n' in message:
+        if not chunk:
+            output.write(stream.finish())
             output.flush()
+            return
+
+        output.write(stream.feed(chunk))
+        output.flush()
+
+
+async def detokenize_base64_async(
+        detokenizer,
+        reader: 'asyncio.StreamReader',
+        prefix=b'$',
+        recursion: int = DEFAULT_RECURSION,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+        max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE
+) -> AsyncIterator[bytes]:
+    """Yields detokenized lines from an asyncio.StreamReader.
+
+    Data is read and decoded as in detokenize_base64_live. Each complete line
+    is yielded, including its newline, as soon as it is available. If more than
+    chunk_size bytes of output have no newline, they are yielded without
+    waiting for the end of the line. The stream is read only when the next
+    line is requested, so a slow consumer applies backpressure to the reader.
+    """
+    stream = _Base64StreamDecoder(detokenizer, prefix, recursion,
+                                  max_message_size)
+    line = b''
 
+    while True:
+        chunk = await reader.read(chunk_size)
+        data = line + (stream.feed(chunk) if chunk else stream.finish())
 
-def detokenize_base64_to_file(detokenizer,
-                              data,
-                              output,
-                              prefix=b'$',
-                              recursion=DEFAULT_RECURSION):
-    """Decodes prefixed Base64 messages in data; decodes to an output file."""
-    transform = _detokenize_prefixed_base64(detokenizer, prefix, recursion)
+        start = 0
+        newline = data.find(b'\n')
 
-    messages = re.compile(
-        re.escape(prefix.encode() if isinstance(prefix, str) else prefix) +
-        (br'(?:[A-Za-z0-9+/\-_]{4})*'
-         br'(?:[A-Za-z0-9+/\-_]{3}=|[A-Za-z0-9+/\-_]{2}==)?'))
+        while newline != -1:
+            yield data[start:newline + 1]
+            start = newline + 1
+            newline = data.find(b'\n', start)
+
+        line = data[start:]
+
+        if not chunk:
+            if line:
+                yield line
+            return
+
+        if len(line) > chunk_size:
+            yield line
+            line = b''
+
+
+DEFAULT_ASYNC_QUEUE_SIZE = 256
+
+
+async def detokenize_base64_streams(
+    detokenizer,
+    readers: Mapping[Hashable, 'asyncio.StreamReader'],
+    prefix=b'$',
+    recursion: int = DEFAULT_RECURSION,
+    queue_size: int = DEFAULT_ASYNC_QUEUE_SIZE,
+) -> AsyncIterator[Tuple[Hashable, bytes]]:
+    """Detokenizes many streams concurrently; yields (key, line) tuples.
 
+    Each stream is read by its own task with detokenize_base64_async. All
+    streams share the Detokenizer and its database. Lines from a stream are
+    yielded in order, while lines from different streams are interleaved as
+    they arrive. At most queue_size lines are buffered; when the consumer
+    falls behind, the tasks stop reading from their streams until it catches
+    up. The iteration ends when all streams reach EOF. If a stream raises an
+    exception, the other tasks are cancelled and the exception is raised.
+    """
+    queue: 'asyncio.Queue' = asyncio.Queue(queue_size)
+    done = object()
+
+    async def read_stream(key, reader) -> None:
+        try:
+            async for line in detokenize_base64_async(detokenizer, reader,
+                                                      prefix, recursion):
+                await queue.put((key, line))
+        except Exception:
+            await queue.put((key, done))
+            raise
+
+        await queue.put((key, done))
+
+    tasks = {
+        key: asyncio.ensure_future(read_stream(key, reader))
+        for key, reader in readers.items()
+    }
+    remaining = len(tasks)
+
+    try:
+        while remaining:
+            key, line = await queue.get()
+
+            if line is done:
+                remaining -= 1
+                await tasks[key]  # Raises the exception if the task failed.
+            else:
+                yield key, line
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+def _detokenize_base64_matches(messages, transform, data, output) -> None:
     index = 0
 
     for match in messages.finditer(data):
@@ -387,6 +1240,19 @@ def detokenize_base64_to_file(detokenizer,
     output.write(data[index:])
 
 
+def detokenize_base64_to_file(detokenizer,
+                              data,
+                              output,
+                              prefix=b'$',
+                              recursion=DEFAULT_RECURSION):
+    """Decodes prefixed Base64 messages in data; decodes to an output file."""
+    transform = _detokenize_prefixed_base64(detokenizer, prefix, recursion)
+    messages = _base64_message_regex(
+        prefix.encode() if isinstance(prefix, str) else prefix)
+
+    _detokenize_base64_matches(messages, transform, data, output)
+
+
 def detokenize_base64(detokenizer,
                       data,
                       prefix=b'$',
@@ -407,7 +1273,356 @@ def detokenize_base64(detokenizer,
     return output.getvalue()
 
 
-def _handle_base64(databases, input_file, output, prefix, show_errors):
+# Special bytes for HDLC-style framing of binary messages.
+HDLC_FLAG = 0x7E
+HDLC_ESCAPE = 0x7D
+_HDLC_ESCAPE_MASK = 0x20
+
+# Framing formats for binary messages.
+BINARY_FRAMING = ('length', 'hdlc')
+
+# Output formats for detokenize_binary.
+OUTPUT_FORMATS = ('text', 'json', 'packed')
+
+
+def _read_chunks(binary_fd, chunk_size: int) -> Iterator[bytes]:
+    """Yields data from a file as it is available, until EOF."""
+    read = _read_available(binary_fd)
+
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _decode_size(data: bytes, index: int) -> Optional[Tuple[int, int]]:
+    """Decodes a varint size; returns (size, end) or None if incomplete."""
+    size = 0
+
+    for i, byte in enumerate(data[index:index + 5]):
+        size |= (byte & 0x7f) << (7 * i)
+
+        if not byte & 0x80:
+            return size, index + i + 1
+
+    if len(data) - index >= 5:
+        raise ValueError('Invalid message size varint')
+
+    return None
+
+
+def _length_prefixed_batches(binary_fd, chunk_size: int,
+                             max_message_size: int) -> Iterator[List[bytes]]:
+    """Yields lists of the length-prefixed messages completed by each read."""
+    data = b''
+
+    for chunk in _read_chunks(binary_fd, chunk_size):
+        data = data + chunk if data else chunk
+        index = 0
+        messages = []
+
+        while True:
+            size_and_start = _decode_size(data, index)
+            if size_and_start is None:
+                break  # Incomplete size; wait for more data.
+
+            size, start = size_and_start
+
+            if size > max_message_size:
+                raise ValueError(
+                    'Message size {} exceeds the maximum of {} bytes'.format(
+                        size, max_message_size))
+
+            if start + size > len(data):
+                break  # Incomplete message; wait for more data.
+
+            messages.append(data[start:start + size])
+            index = start + size
+
+        data = data[index:]
+        yield messages
+
+    if data:
+        _LOG.warning('Discarding %d bytes of incomplete message data',
+                     len(data))
+
+
+def read_length_prefixed_messages(
+        binary_fd,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+        max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE) -> Iterator[bytes]:
+    """Yields messages that are each preceded by their size as a varint.
+
+    The size is an unsigned LEB128 varint, so messages shorter than 128 bytes
+    have a one-byte prefix. Data is read in chunks as it becomes available.
+    Since the stream cannot be resynchronized after a corrupt size, a size
+    larger than max_message_size raises a ValueError.
+    """
+    for messages in _length_prefixed_batches(binary_fd, chunk_size,
+                                             max_message_size):
+        yield from messages
+
+
+def _hdlc_unescape(frame: bytes) -> Optional[bytes]:
+    """Unescapes a frame; returns None if it has an invalid escape sequence.
+
+    An escape must be followed by a byte other than an escape, so an escape
+    followed by another escape or at the end of the frame is invalid.
+    """
+    if HDLC_ESCAPE not in frame:
+        return frame
+
+    pieces = frame.split(bytes([HDLC_ESCAPE]))
+    if not all(pieces[1:]):
+        return None
+
+    return pieces[0] + b''.join(
+        bytes([piece[0] ^ _HDLC_ESCAPE_MASK]) + piece[1:]
+        for piece in pieces[1:])
+
+
+def _hdlc_batches(binary_fd, chunk_size: int,
+                  max_message_size: int) -> Iterator[List[bytes]]:
+    """Yields lists of the HDLC frames completed by each read."""
+    flag = bytes([HDLC_FLAG])
+    frame = b''
+    discarding = False
+
+    for chunk in _read_chunks(binary_fd, chunk_size):
+        frames = chunk.split(flag)
+
+        # The first piece continues the frame from the previous chunk.
+        frames[0] = frame + frames[0]
+        messages = []
+
+        for complete in frames[:-1]:
+            if discarding:
+                discarding = False
+            elif len(complete) > max_message_size:
+                _LOG.warning('Discarding HDLC frame larger than %d bytes',
+                             max_message_size)
+            elif complete:
+                unescaped = _hdlc_unescape(complete)
+                if unescaped is None:
+                    _LOG.warning(
+                        'Discarding HDLC frame with an invalid escape')
+                else:
+                    messages.append(unescaped)
+
+        frame = frames[-1]
+
+        if len(frame) > max_message_size:
+            if not discarding:
+                _LOG.warning('Discarding HDLC frame larger than %d bytes',
+                             max_message_size)
+            frame = b''
+            discarding = True
+
+        yield messages
+
+    if frame and not discarding:
+        _LOG.warning('Discarding %d bytes of incomplete HDLC frame data',
+                     len(frame))
+
+
+def read_hdlc_frames(
+        binary_fd,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+        max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE) -> Iterator[bytes]:
+    """Yields the contents of HDLC-style frames from a binary stream.
+
+    Frames are delimited by 0x7E flag bytes. Within a frame, 0x7D escapes the
+    following byte, which is XORed with 0x20. Empty frames are ignored. Frames
+    do not include address, control, or frame check sequence fields. A frame
+    longer than max_message_size (before unescaping) is discarded, and
+    decoding resumes at the next flag. A frame in which an escape is followed
+    by another escape or ends the frame is also discarded.
+    """
+    for frames in _hdlc_batches(binary_fd, chunk_size, max_message_size):
+        yield from frames
+
+
+def detokenize_binary(detokenizer,
+                      input_file,
+                      output,
+                      framing: str = 'length',
+                      chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+                      max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+                      output_format: str = 'text') -> None:
+    """Detokenizes framed binary messages from a stream; writes one per line.
+
+    Messages are detokenized as they are read, and output is flushed after each
+    read, so this may be used with live streams. Messages with unknown tokens
+    are written as prefixed Base64, so they may be decoded later, unless the
+    detokenizer was created with show_errors.
+
+    With the json or packed output formats, messages are decoded with
+    decode_structured and are not formatted. Each is written as a line of JSON
+    or as a packed record (see StructuredMessage).
+
+    Args:
+      detokenizer: the detokenizer with which to decode messages
+      input_file: binary file from which to read framed messages
+      output: binary file to which to write detokenized lines
+      framing: 'length' for messages prefixed with their size as a varint
+          (see read_length_prefixed_messages) or 'hdlc' for HDLC-style frames
+          (see read_hdlc_frames)
+      chunk_size: the maximum number of bytes to read at once
+      max_message_size: the size of the largest valid message
+      output_format: 'text', 'json', or 'packed'
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            'Unknown output format {!r}; expected one of {}'.format(
+                output_format, ', '.join(OUTPUT_FORMATS)))
+
+    if framing == 'length':
+        batches = _length_prefixed_batches(input_file, chunk_size,
+                                           max_message_size)
+    elif framing == 'hdlc':
+        batches = _hdlc_batches(input_file, chunk_size, max_message_size)
+    else:
+        raise ValueError('Unknown framing {!r}; expected one of {}'.format(
+            framing, ', '.join(BINARY_FRAMING)))
+
+    if output_format == 'json':
+        for messages in batches:
+            if messages:
+                output.write(''.join(
+                    detokenizer.decode_structured(message).to_json() + '\n'
+                    for message in messages).encode())
+                output.flush()
+        return
+
+    if output_format == 'packed':
+        for messages in batches:
+            if messages:
+                output.write(b''.join(
+                    detokenizer.decode_structured(message).pack()
+                    for message in messages))
+                output.flush()
+        return
+
+    # Detokenize each read's messages together if the detokenizer supports it.
+    detokenize_many = getattr(
+        detokenizer, 'detokenize_many',
+        lambda messages: [detokenizer.detokenize(msg) for msg in messages])
+
+    for messages in batches:
+        if not messages:
+            continue
+
+        lines = []
+
+        for message, result in zip(messages, detokenize_many(messages)):
+            text = str(result)
+
+            if text or result.best_result() is not None:
+                lines.append(text.encode())
+            else:
+                lines.append(b'$' + base64.b64encode(message))
+
+        lines.append(b'')
+        output.write(b'\n'.join(lines))
+        output.flush()
+
+
+DEFAULT_PARALLEL_CHUNK_SIZE = 2**22
+
+# The Detokenizer for a process started by detokenize_base64_parallel.
+_worker_detokenizer: Optional[Detokenizer] = None
+
+
+def _init_parallel_worker(token_database: tokens.Database,
+                          show_errors: bool) -> None:
+    global _worker_detokenizer  # pylint: disable=global-statement
+    _worker_detokenizer = Detokenizer(token_database, show_errors=show_errors)
+
+
+def _detokenize_base64_chunk(path: str, start: int, end: int, prefix,
+                             recursion: int) -> bytes:
+    """Detokenizes a chunk of a file in a worker process."""
+    assert _worker_detokenizer is not None
+
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(),
+                                           0,
+                                           access=mmap.ACCESS_READ) as data:
+        return detokenize_base64(_worker_detokenizer, data[start:end], prefix,
+                                 recursion)
+
+
+def _line_chunks(data, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """Yields (start, end) offsets of chunks that end after a newline."""
+    start = 0
+
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_size - 1)
+        end = len(data) if end == -1 else end + 1
+
+        yield start, end
+        start = end
+
+
+def detokenize_base64_parallel(
+        token_database: tokens.Database,
+        path: str,
+        output,
+        prefix=b'$',
+        recursion: int = DEFAULT_RECURSION,
+        show_errors: bool = False,
+        jobs: int = 0,
+        chunk_size: int = DEFAULT_PARALLEL_CHUNK_SIZE) -> None:
+    """Detokenizes prefixed Base64 in a file with multiple processes.
+
+    The file is memory-mapped and split into chunks of about chunk_size bytes
+    that end at newlines. Messages cannot contain newlines, so each chunk can
+    be detokenized on its own. Each process creates a Detokenizer once and
+    maps the file to read its chunks. Output is written in order, and at most
+    two chunks per process are in progress at a time.
+
+    Args:
+      token_database: the database with which to detokenize
+      path: the file to detokenize
+      output: binary file to which to write the result
+      prefix: one-character byte string that signals the start of a message
+      recursion: how many levels to recursively decode
+      show_errors: whether to show errors for arguments that fail to decode
+      jobs: number of processes to use; 0 uses one per CPU
+      chunk_size: the minimum size of each chunk, except the last
+    """
+    if chunk_size <= 0:
+        raise ValueError('The chunk size must be positive')
+
+    if os.path.getsize(path) == 0:
+        return
+
+    jobs = jobs or os.cpu_count() or 1
+
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(),
+                                           0,
+                                           access=mmap.ACCESS_READ) as data:
+        chunks = list(_line_chunks(data, chunk_size))
+
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs,
+            initializer=_init_parallel_worker,
+            initargs=(token_database, show_errors)) as pool:
+        pending: Deque[concurrent.futures.Future] = collections.deque()
+
+        for start, end in chunks:
+            pending.append(
+                pool.submit(_detokenize_base64_chunk, path, start, end, prefix,
+                            recursion))
+
+            if len(pending) >= 2 * jobs:
+                output.write(pending.popleft().result())
+
+        while pending:
+            output.write(pending.popleft().result())
+
+
+def _handle_base64(databases, input_file, output, prefix, show_errors, jobs):
     """Handles the base64 command line option."""
     # argparse.FileType doesn't correctly handle - for binary files.
     if input_file is sys.stdin:
@@ -416,8 +1631,21 @@ def _handle_base64(databases, input_file, output, prefix, show_errors):
     if output is sys.stdout:
         output = sys.stdout.buffer
 
-    detokenizer = Detokenizer(tokens.Database.merged(*databases),
-                              show_errors=show_errors)
+    token_database = tokens.Database.merged(*databases)
+
+    # Split large files between multiple processes if requested. Only regular
+    # files can be reopened by path; stdin is named '<stdin>', for example.
+    name = getattr(input_file, 'name', None)
+    if jobs != 1 and isinstance(name, str) and os.path.isfile(name):
+        detokenize_base64_parallel(token_database,
+                                   input_file.name,
+                                   output,
+                                   prefix,
+                                   show_errors=show_errors,
+                                   jobs=jobs)
+        return
+
+    detokenizer = Detokenizer(token_database, show_errors=show_errors)
 
     # If the input is seekable, process it all at once, which is MUCH faster.
     if input_file.seekable():
@@ -427,6 +1655,24 @@ def _handle_base64(databases, input_file, output, prefix, show_errors):
         detokenize_base64_live(detokenizer, input_file, output, prefix)
 
 
+def _handle_binary(databases, input_file, output, framing, output_format,
+                   show_errors):
+    """Handles the binary command line option."""
+    # argparse.FileType doesn't correctly handle - for binary files.
+    if input_file is sys.stdin:
+        input_file = sys.stdin.buffer
+
+    if output is sys.stdout:
+        output = sys.stdout.buffer
+
+    detokenize_binary(Detokenizer(tokens.Database.merged(*databases),
+                                  show_errors=show_errors),
+                      input_file,
+                      output,
+                      framing,
+                      output_format=output_format)
+
+
 def _parse_args():
     """Parse and return command line arguments."""
 
@@ -472,6 +1718,60 @@ def _parse_args():
         action='store_true',
         help=('Show error messages instead of conversion specifiers when '
               'arguments cannot be decoded.'))
+    subparser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help=('Number of processes with which to detokenize a seekable input '
+              'file; 0 uses one per CPU. (default: 1)'))
+
+    binary_help = ('Detokenize framed binary messages from a file or stdin. '
+                   'Each message is written on its own line.')
+    subparser = subparsers.add_parser('binary',
+                                      description=binary_help,
+                                      help=binary_help)
+    subparser.set_defaults(handler=_handle_binary)
+    subparser.add_argument(
+        'databases',
+        nargs='+',
+        action=database.LoadTokenDatabase,
+        help='Databases (ELF, binary, or CSV) to use to lookup tokens.')
+    subparser.add_argument(
+        '-i',
+        '--input',
+        dest='input_file',
+        type=argparse.FileType('rb'),
+        default=sys.stdin.buffer,
+        help='The file from which to read; provide - or omit for stdin.')
+    subparser.add_argument('-o',
+                           '--output',
+                           type=argparse.FileType('wb'),
+                           default=sys.stdout.buffer,
+                           help=('The file to which to write the output; '
+                                 'provide - or omit for stdout.'))
+    subparser.add_argument(
+        '-f',
+        '--framing',
+        choices=BINARY_FRAMING,
+        default='length',
+        help=('How messages are framed: length for messages prefixed with '
+              'their size as a varint, or hdlc for messages delimited by 0x7E '
+              'flag bytes with 0x7D escapes. (default: length)'))
+    subparser.add_argument(
+        '--output-format',
+        choices=OUTPUT_FORMATS,
+        default='text',
+        help=('text writes detokenized strings; json and packed write the '
+              'token, format string, and typed argument values of each '
+              'message as JSON lines or packed binary records without '
+              'formatting them. (default: text)'))
+    subparser.add_argument(
+        '-s',
+        '--show_errors',
+        action='store_true',
+        help=('Show error messages for messages that cannot be decoded, '
+              'rather than writing them as prefixed Base64.'))
 
     return parser.parse_args()
 
@@ -21,13 +21,19 @@ for both of these features is provided.
 This module supports any ELF-format file, including .o and .so files. This
 module also has basic support for archive (.a) files. All ELF files in an
 archive are read as one unit.
+
+Large files and archives may be memory-mapped rather than read with many small
+seek and read calls. Memory-mapped sections can be accessed without copying
+them with Elf.view_sections.
 """
 
 import argparse
+import io
+import mmap
 import re
 import struct
 import sys
-from typing import BinaryIO, Dict, Iterable, NamedTuple, Optional
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional
 from typing import Pattern, Tuple, Union
 
 ARCHIVE_MAGIC = b'!<arch>\n'
@@ -63,9 +69,9 @@ def files_in_archive(fd: BinaryIO) -> Iterable[int]:
         #   10 B - file size in bytes (decimal)
         #    2 B - ending characters (`\n)
         #
-        # Skip the unused portions of the file header, then read the size.
-        fd.seek(16 + 12 + 6 + 6 + 8, 1)
-        size_str = fd.read(10)
+        # Read past the unused portions of the file header, then read the
+        # size. Reading rather than seeking stops at the end of an mmap.
+        size_str = fd.read(16 + 12 + 6 + 6 + 8 + 10)[16 + 12 + 6 + 6 + 8:]
         if not size_str:
             return
 
@@ -166,15 +172,23 @@ class FileDecodeError(Exception):
 
 
 class FieldReader:
-    """Reads ELF fields defined with a Field tuple from an ELF file."""
-    def __init__(self, elf: BinaryIO):
+    """Reads ELF fields defined with a Field tuple from an ELF file.
+
+    If the contents of the file are provided as data (e.g. an mmap), fields are
+    unpacked from the data rather than read from the file.
+    """
+    def __init__(self,
+                 elf: BinaryIO,
+                 data: Union[None, bytes, mmap.mmap] = None):
         self._elf = elf
+        self._data = data
         self.file_offset = self._elf.tell()
 
         _check_next_bytes(self._elf, ELF_MAGIC, 'ELF file header')
         size_field = self._elf.read(1)  # e_ident[EI_CLASS] (address size)
 
         int_unpacker = self._determine_integer_format()
+        self._int_unpacker = int_unpacker
 
         if size_field == b'\x01':
             self.offset = lambda field: field.offset_32
@@ -206,15 +220,60 @@ class FieldReader:
         }
 
     def read(self, field: Field, base: int = 0) -> int:
+        if self._data is not None:
+            return self._int_unpacker[self._size(field)].unpack_from(
+                self._data, self.file_offset + base + self.offset(field))[0]
+
         self._elf.seek(self.file_offset + base + self.offset(field))
         data = self._elf.read(self._size(field))
         return self._decode(field, data)
 
+    def read_bytes(self, offset: int, size: int) -> bytes:
+        """Reads size bytes at an offset from the start of the ELF."""
+        start = self.file_offset + offset
+
+        if self._data is not None:
+            return self._data[start:start + size]
+
+        self._elf.seek(start)
+        return self._elf.read(size)
+
+    def header_struct(self, fields: Iterable[Field],
+                      header_end: Field) -> struct.Struct:
+        """Returns a Struct that unpacks the fields from a header.
+
+        The fields must be in order of their offsets. header_end is the field
+        that records the header's size.
+        """
+        layout = [self._int_unpacker[1].format[0]]  # endianness
+        position = 0
+
+        for field in fields:
+            offset = self.offset(field)
+            if offset < position:
+                raise ValueError('Field {} is out of order'.format(field.name))
+
+            layout.append('{}x'.format(offset - position))
+            layout.append(self._int_unpacker[self._size(field)].format[-1])
+            position = offset + self._size(field)
+
+        layout.append('{}x'.format(self.offset(header_end) - position))
+        return struct.Struct(''.join(layout))
+
     def read_string(self, offset: int) -> str:
+        if self._data is not None:
+            return _c_string_at(self._data, self.file_offset + offset).decode()
+
         self._elf.seek(self.file_offset + offset)
         return read_c_string(self._elf).decode()
 
 
+def _c_string_at(data: Union[bytes, mmap.mmap], offset: int) -> bytes:
+    """Returns the null-terminated string at an offset in the data."""
+    end = data.find(b'\0', offset)
+    return data[offset:end if end != -1 else len(data)]
+
+
 class Elf:
     """Represents an ELF file and the sections in it."""
     class Section(NamedTuple):
@@ -232,38 +291,75 @@ class Elf:
         def __lt__(self, other) -> bool:
             return self.address < other.address
 
-    def __init__(self, elf: BinaryIO):
+    def __init__(self, elf: BinaryIO, memory_map: bool = False):
+        """Lists the sections in an ELF or archive file.
+
+        Args:
+          elf: the ELF or archive file, positioned at its start
+          memory_map: if True, the file is memory-mapped and sections are read
+              from the map; file objects without a file descriptor (e.g.
+              io.BytesIO) are read into memory instead
+        """
+        self._map: Optional[mmap.mmap] = None
+        self._data: Union[None, bytes, mmap.mmap] = None
+
+        if memory_map:
+            position = elf.tell()
+            self._data = self._map_file(elf)
+            elf = self._map if self._map is not None else io.BytesIO(
+                self._data)
+            elf.seek(position)
+
         self._elf = elf
         self.sections: Tuple[Elf.Section, ...] = tuple(self._list_sections())
 
+    def _map_file(self, fd: BinaryIO) -> Union[bytes, mmap.mmap]:
+        try:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+            # Read files that cannot be mapped, such as pipes or empty files.
+            fd.seek(0)
+            return fd.read()
+
+        return self._map
+
     def _list_sections(self) -> Iterable['Elf.Section']:
-        """Reads the section headers to enumerate all ELF sections."""
+        """Reads the section headers to enumerate all ELF sections.
+
+        The section header table and the section names table are each read at
+        once, and the section headers are unpacked together.
+        """
         for _ in _elf_files_in_archive(self._elf):
-            reader = FieldReader(self._elf)
-            base = reader.read(FILE_HEADER.section_header_offset)
-            section_header_size = reader.offset(
+            reader = FieldReader(self._elf, self._data)
+            section_header = reader.header_struct(
+                (SECTION_HEADER.section_name_offset,
+                 SECTION_HEADER.section_address, SECTION_HEADER.section_offset,
+                 SECTION_HEADER.section_size),
                 SECTION_HEADER.section_header_end)
 
+            headers = list(
+                section_header.iter_unpack(
+                    reader.read_bytes(
+                        reader.read(FILE_HEADER.section_header_offset),
+                        section_header.size *
+                        reader.read(FILE_HEADER.section_count))))
+            if not headers:
+                continue
+
             # Find the section with the section names in it.
-            names_section_header_base = (
-                base + section_header_size *
-                reader.read(FILE_HEADER.section_names_index))
-            names_table_base = reader.read(SECTION_HEADER.section_offset,
-                                           names_section_header_base)
+            names_index = reader.read(FILE_HEADER.section_names_index)
+            if names_index >= len(headers):
+                raise FileDecodeError(
+                    'Invalid section names index {}; there are {} '
+                    'sections'.format(names_index, len(headers)))
 
-            base = reader.read(FILE_HEADER.section_header_offset)
-            for _ in range(reader.read(FILE_HEADER.section_count)):
-                name_offset = reader.read(SECTION_HEADER.section_name_offset,
-                                          base)
+            _, _, names_offset, names_size = headers[names_index]
+            names = reader.read_bytes(names_offset, names_size)
 
+            for name_offset, address, offset, size in headers:
                 yield self.Section(
-                    reader.read_string(names_table_base + name_offset),
-                    reader.read(SECTION_HEADER.section_address, base),
-                    reader.read(SECTION_HEADER.section_offset, base),
-                    reader.read(SECTION_HEADER.section_size, base),
-                    reader.file_offset)
-
-                base += section_header_size
+                    _c_string_at(names, name_offset).decode(), address, offset,
+                    size, reader.file_offset)
 
     def section_by_address(self, address: int) -> Optional['Elf.Section']:
         """Returns the section that contains the provided address, if any."""
@@ -288,26 +384,81 @@ class Elf:
             return None
 
         assert section.address <= address
-        self._elf.seek(section.file_offset + section.offset + address -
-                       section.address)
+        offset = (section.file_offset + section.offset + address -
+                  section.address)
+
+        if self._data is not None:
+            if size is None:
+                return _c_string_at(self._data, offset)
+
+            return self._data[offset:offset + size]
+
+        self._elf.seek(offset)
 
         if size is None:
             return read_c_string(self._elf)
 
         return self._elf.read(size)
 
+    def view_sections(self, name: Union[str,
+                                        Pattern[str]]) -> List[memoryview]:
+        """Returns a memoryview of each section matching the regex.
+
+        When memory-mapped, the views refer to the mapped file without copying
+        it, and must be released before the Elf is closed.
+        """
+        name_regex = re.compile(name)
+
+        if self._data is None:
+            return [
+                memoryview(self._read_section(section))
+                for section in self.sections if name_regex.match(section.name)
+            ]
+
+        with memoryview(self._data) as data:
+            return [
+                data[section.file_offset + section.offset:section.file_offset +
+                     section.offset + section.size]
+                for section in self.sections if name_regex.match(section.name)
+            ]
+
+    def _read_section(self, section: 'Elf.Section') -> bytes:
+        self._elf.seek(section.file_offset + section.offset)
+        return self._elf.read(section.size)
+
     def dump_sections(self, name: Union[str, Pattern[str]]) -> Optional[bytes]:
         """Dumps a binary string containing the sections matching the regex."""
+        if self._data is not None:
+            views = self.view_sections(name)
+            try:
+                return b''.join(views) if views else None
+            finally:
+                for view in views:
+                    view.release()
+
         name_regex = re.compile(name)
 
         sections = []
         for section in self.sections:
             if name_regex.match(section.name):
-                self._elf.seek(section.file_offset + section.offset)
-                sections.append(self._elf.read(section.size))
+                sections.append(self._read_section(section))
 
         return b''.join(sections) if sections else None
 
+    def close(self) -> None:
+        """Unmaps the file if it was memory-mapped.
+
+        The file object passed to the Elf is not closed.
+        """
+        if self._map is not None:
+            self._map.close()
+
+    def __enter__(self) -> 'Elf':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
     def summary(self) -> str:
         return '\n'.join(
             '[{0:2}] {1.address:08x} {1.offset:08x} {1.size:08x} {1.name}'.
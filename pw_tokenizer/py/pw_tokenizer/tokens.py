@@ -13,15 +13,28 @@
 # the License.
 """Builds and manages databases of tokenized strings."""
 
+import array
 import collections
 import csv
 from datetime import datetime
+import functools
 import io
+import itertools
 import logging
+import mmap
+import operator
 import re
 import struct
-from typing import BinaryIO, Callable, Dict, Iterable, List, NamedTuple
-from typing import Optional, Tuple, Union, ValuesView
+import sys
+import threading
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List
+from typing import Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+from typing import ValuesView
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None  # type: ignore
 
 DATE_FORMAT = '%Y-%m-%d'
 
@@ -31,29 +44,220 @@ TOKENIZER_HASH_CONSTANT = 65599
 _LOG = logging.getLogger('pw_tokenizer')
 
 
-def _value(char: Union[int, str]) -> int:
-    return char if isinstance(char, int) else ord(char)
+@functools.lru_cache(maxsize=None)
+def _hash_coefficients(hash_length: int) -> Tuple[int, ...]:
+    """Returns the 65599 coefficient for each character position."""
+    coefficients = []
+    coefficient = TOKENIZER_HASH_CONSTANT
+
+    for _ in range(hash_length):
+        coefficients.append(coefficient)
+        coefficient = (coefficient * TOKENIZER_HASH_CONSTANT) % 2**32
+
+    return tuple(coefficients)
+
+
+def _hash_with_coefficients(string: Union[str, bytes],
+                            coefficients: Sequence[int]) -> int:
+    """Hashes a string with precomputed coefficients and a single modulo."""
+    values = map(ord, string) if isinstance(string, str) else string
+    return (len(string) + sum(map(operator.mul, coefficients, values))) % 2**32
+
+
+# The coefficients for the default hash length are used for nearly every hash.
+_DEFAULT_HASH_COEFFICIENTS = _hash_coefficients(DEFAULT_HASH_LENGTH)
 
 
 def pw_tokenizer_65599_fixed_length_hash(string: Union[str, bytes],
                                          hash_length: int) -> int:
     """Hashes the provided string."""
-    hash_value = len(string)
-    coefficient = TOKENIZER_HASH_CONSTANT
+    return _hash_with_coefficients(string, _hash_coefficients(hash_length))
 
-    for char in string[:hash_length]:
-        hash_value = (hash_value + coefficient * _value(char)) % 2**32
-        coefficient = (coefficient * TOKENIZER_HASH_CONSTANT) % 2**32
 
-    return hash_value
+def default_hash(string: Union[str, bytes]) -> int:
+    return _DEFAULT_HASH_MEMO.hash(string)
 
 
-def default_hash(string: Union[str, bytes]) -> int:
-    return pw_tokenizer_65599_fixed_length_hash(string, DEFAULT_HASH_LENGTH)
+# Number of strings hashed at once by the NumPy backend. This bounds the size of
+# the temporary character matrix to _NUMPY_BATCH_SIZE * hash_length values.
+_NUMPY_BATCH_SIZE = 4096
+
+
+def _hash_batch_numpy(strings: Sequence[Union[str, bytes]],
+                      coefficients: Sequence[int]) -> List[int]:
+    """Hashes a batch of strings as one matrix-vector product."""
+    hash_length = len(coefficients)
+    values = numpy.zeros((len(strings), hash_length), dtype=numpy.uint64)
+
+    for row, string in zip(values, strings):
+        chars = string[:hash_length]
+        if isinstance(chars, str):
+            encoded = chars.encode('utf-32-le', 'surrogatepass')
+            row[:len(chars)] = numpy.frombuffer(encoded, dtype='<u4')
+        else:
+            row[:len(chars)] = numpy.frombuffer(bytes(chars),
+                                                dtype=numpy.uint8)
+
+    # Characters are < 2**21 and coefficients are < 2**32, so the sum of
+    # products cannot overflow 64 bits for any reasonable hash length. Any
+    # overflow would wrap mod 2**64, which still preserves the result mod 2**32.
+    hashes = values @ numpy.array(coefficients, dtype=numpy.uint64)
+    hashes += numpy.fromiter((len(string) for string in strings),
+                             dtype=numpy.uint64,
+                             count=len(strings))
+    return (hashes & numpy.uint64(0xffffffff)).tolist()
+
+
+def hash_many(strings: Iterable[Union[str, bytes]],
+              hash_length: int = DEFAULT_HASH_LENGTH,
+              use_numpy: Optional[bool] = None) -> List[int]:
+    """Hashes many strings with the 65599 fixed length hash.
+
+    This is equivalent to calling pw_tokenizer_65599_fixed_length_hash on each
+    string, but the hash coefficients are computed once for the whole batch.
+
+    Args:
+      strings: the str or bytes strings to hash
+      hash_length: maximum number of characters to hash in each string
+      use_numpy: whether to use the NumPy backend; by default NumPy is used if
+          it is installed
+
+    Returns:
+      a list with the hash of each string, in the same order as the strings
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError('NumPy is required to hash with the NumPy backend')
+
+    strings = list(strings)
+    coefficients = _hash_coefficients(hash_length)
+
+    if not use_numpy or not strings or not coefficients:
+        return [
+            _hash_with_coefficients(string, coefficients) for string in strings
+        ]
+
+    hashes: List[int] = []
+    for start in range(0, len(strings), _NUMPY_BATCH_SIZE):
+        hashes += _hash_batch_numpy(strings[start:start + _NUMPY_BATCH_SIZE],
+                                    coefficients)
+
+    return hashes
+
+
+# The default_hash memo is off unless set_default_hash_cache_size enables it.
+DEFAULT_HASH_CACHE_SIZE = 0
+
+
+class _HashMemo:
+    """Bounded LRU memo of default hash results, keyed by string."""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._hashes: 'collections.OrderedDict[Union[str, bytes], int]' = (
+            collections.OrderedDict())
+        self._lock = threading.Lock()
+
+    def resize(self, max_size: int) -> None:
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def hash(self, string: Union[str, bytes]) -> int:
+        """Returns the default hash of a string, using the memo if possible."""
+        if not self.max_size or isinstance(string, bytearray):
+            return _hash_with_coefficients(string, _DEFAULT_HASH_COEFFICIENTS)
+
+        with self._lock:
+            try:
+                self._hashes.move_to_end(string)
+                return self._hashes[string]
+            except KeyError:
+                pass
+
+        value = _hash_with_coefficients(string, _DEFAULT_HASH_COEFFICIENTS)
+        self._store([(string, value)])
+        return value
+
+    def hash_many(self, strings: Sequence[Union[str, bytes]]) -> List[int]:
+        """Returns default hashes; only hashes strings missing from the memo."""
+        if not self.max_size:
+            return hash_many(strings, DEFAULT_HASH_LENGTH)
+
+        hashes: List[Optional[int]] = []
+        missing: List[int] = []
+
+        with self._lock:
+            for string in strings:
+                value = self._hashes.get(string)
+                if value is None:
+                    missing.append(len(hashes))
+                else:
+                    self._hashes.move_to_end(string)
+                hashes.append(value)
+
+        if missing:
+            new_hashes = hash_many([strings[i] for i in missing],
+                                   DEFAULT_HASH_LENGTH)
+            for i, value in zip(missing, new_hashes):
+                hashes[i] = value
+
+            self._store(zip((strings[i] for i in missing), new_hashes))
+
+        return hashes  # type: ignore
+
+    def clear(self) -> None:
+        with self._lock:
+            self._hashes.clear()
+
+    def _store(self, items: Iterable[Tuple[Union[str, bytes], int]]) -> None:
+        with self._lock:
+            self._hashes.update(items)
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._hashes) > self.max_size:
+            self._hashes.popitem(last=False)
+
+
+_DEFAULT_HASH_MEMO = _HashMemo(DEFAULT_HASH_CACHE_SIZE)
+
+
+def set_default_hash_cache_size(max_size: int) -> None:
+    """Sets how many default_hash results are memoized; 0 disables the memo.
+
+    The memo is disabled by default. Memoizing hashes avoids rehashing the same
+    strings when a database is repeatedly updated from similar sets of strings,
+    such as the strings in successive builds of the same firmware, at the cost
+    of keeping up to max_size strings in memory.
+    """
+    if max_size < 0:
+        raise ValueError('The hash cache size cannot be negative')
+
+    _DEFAULT_HASH_MEMO.resize(max_size)
+
+
+def clear_default_hash_cache() -> None:
+    """Discards all memoized default_hash results."""
+    _DEFAULT_HASH_MEMO.clear()
+
+
+def _tokenize_many(tokenize: Callable[[str], int],
+                   strings: Sequence[str]) -> List[int]:
+    """Tokenizes strings, using the batch hash for the default tokenizer."""
+    if tokenize is default_hash:
+        return _DEFAULT_HASH_MEMO.hash_many(strings)
+
+    return [tokenize(string) for string in strings]
 
 
 class TokenizedStringEntry:
     """A tokenized string with its metadata."""
+
+    # Databases may contain hundreds of thousands of entries, so avoid a
+    # per-instance __dict__.
+    __slots__ = 'token', 'string', 'date_removed'
+
     def __init__(self,
                  token: int,
                  string: str,
@@ -96,6 +300,10 @@ class TokenizedStringEntry:
         return '{}({!r})'.format(type(self).__name__, self.string)
 
 
+# Databases that can be merged into a Database.
+_AnyDatabase = Union['Database', 'MappedDatabase']
+
+
 class Database:
     """Database of tokenized strings stored as TokenizedStringEntry objects."""
     def __init__(self,
@@ -106,7 +314,8 @@ class Database:
         self._database: dict = {entry.key(): entry for entry in entries}
         self.tokenize = tokenize
 
-        # This is a cache for fast token lookup that is built as needed.
+        # This is a cache for fast token lookup that is built as needed. Once
+        # built, it is updated as entries are added and removed.
         self._cache: Optional[Dict[int, List[TokenizedStringEntry]]] = None
 
     @classmethod
@@ -115,11 +324,13 @@ class Database:
             strings: Iterable[str],
             tokenize: Callable[[str], int] = default_hash) -> 'Database':
         """Creates a Database from an iterable of strings."""
-        return cls((TokenizedStringEntry(tokenize(string), string)
-                    for string in strings), tokenize)
+        strings = list(strings)
+        return cls(
+            (TokenizedStringEntry(token, string) for token, string in zip(
+                _tokenize_many(tokenize, strings), strings)), tokenize)
 
     @classmethod
-    def merged(cls, *databases: 'Database') -> 'Database':
+    def merged(cls, *databases: _AnyDatabase) -> 'Database':
         """Creates a TokenDatabase from one or more other databases."""
         db = cls()
         db.merge(*databases)
@@ -129,9 +340,14 @@ class Database:
     def token_to_entries(self) -> Dict[int, List[TokenizedStringEntry]]:
         """Returns a dict that maps tokens to a list of TokenizedStringEntry."""
         if self._cache is None:  # build cache token -> entry cache
-            self._cache = collections.defaultdict(list)
+            # Build the cache before storing it, so other threads never see a
+            # partially built cache.
+            cache: Dict[int, List[TokenizedStringEntry]] = (
+                collections.defaultdict(list))
             for entry in self._database.values():
-                self._cache[entry.token].append(entry)
+                cache[entry.token].append(entry)
+
+            self._cache = cache
 
         return self._cache
 
@@ -165,8 +381,6 @@ class Database:
         Returns:
           A list of entries marked as removed.
         """
-        self._cache = None
-
         if removal_date is None:
             removal_date = datetime.now()
 
@@ -187,26 +401,23 @@ class Database:
 
     def add(self, strings: Iterable[str]) -> None:
         """Adds new strings to the database."""
-        self._cache = None
+        strings = list(strings)
 
         # Add new and update previously removed entries.
-        for string in strings:
-            key = self.tokenize(string), string
+        for key in zip(_tokenize_many(self.tokenize, strings), strings):
 
             try:
                 entry = self._database[key]
                 if entry.date_removed:
                     entry.date_removed = None
             except KeyError:
-                self._database[key] = TokenizedStringEntry(key[0], string)
+                self._insert(key, TokenizedStringEntry(*key))
 
     def purge(
         self,
         date_removed_cutoff: Optional[datetime] = None
     ) -> List[TokenizedStringEntry]:
         """Removes and returns entries removed on/before date_removed_cutoff."""
-        self._cache = None
-
         if date_removed_cutoff is None:
             date_removed_cutoff = datetime.max
 
@@ -215,15 +426,11 @@ class Database:
             if entry.date_removed and entry.date_removed <= date_removed_cutoff
         ]
 
-        for key in to_delete:
-            del self._database[key]
-
+        self._delete(to_delete)
         return to_delete
 
-    def merge(self, *databases: 'Database') -> None:
+    def merge(self, *databases: _AnyDatabase) -> None:
         """Merges two or more databases together, keeping the newest dates."""
-        self._cache = None
-
         for other_db in databases:
             for entry in other_db.entries():
                 key = entry.key()
@@ -231,7 +438,7 @@ class Database:
                 if key in self._database:
                     self._database[key].update_date_removed(entry.date_removed)
                 else:
-                    self._database[key] = entry
+                    self._insert(key, entry)
 
     def filter(self, include: Iterable = (), exclude: Iterable = ()) -> None:
         """Filters the database using regular expressions (strings or compiled).
@@ -240,8 +447,6 @@ class Database:
       include: iterable of regexes; only entries matching at least one are kept
       exclude: iterable of regexes; entries matching any of these are removed
     """
-        self._cache = None
-
         to_delete: List[Tuple] = []
 
         if include:
@@ -256,8 +461,28 @@ class Database:
                              if any(
                                  rgx.search(val.string) for rgx in exclude_re))
 
-        for key in to_delete:
-            del self._database[key]
+        self._delete(to_delete)
+
+    def _insert(self, key: Tuple[int, str],
+                entry: TokenizedStringEntry) -> None:
+        """Adds a new entry, updating the token lookup cache if it is built."""
+        self._database[key] = entry
+
+        if self._cache is not None:
+            self._cache[entry.token].append(entry)
+
+    def _delete(self, keys: Iterable[Tuple[int, str]]) -> None:
+        """Removes entries, updating the token lookup cache if it is built."""
+        for key in keys:
+            entry = self._database.pop(key, None)
+
+            if entry is None or self._cache is None:
+                continue
+
+            token_entries = self._cache[entry.token]
+            token_entries.remove(entry)
+            if not token_entries:
+                del self._cache[entry.token]
 
     def __len__(self) -> int:
         """Returns the number of entries in the database."""
@@ -270,39 +495,95 @@ class Database:
         return csv_output.getvalue().decode()
 
 
-def parse_csv(fd) -> Iterable[TokenizedStringEntry]:
-    """Parses TokenizedStringEntries from a CSV token database file."""
+@functools.lru_cache(maxsize=4096)
+def _parse_csv_date(date_str: str) -> Optional[datetime]:
+    """Parses a CSV removal date; cached since few distinct dates are used."""
+    return (datetime.strptime(date_str, DATE_FORMAT)
+            if date_str.strip() else None)
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_csv_date(date_removed: Optional[datetime]) -> str:
+    return date_removed.strftime(DATE_FORMAT) if date_removed else ''
+
+
+def parse_csv(fd) -> Iterator[TokenizedStringEntry]:
+    """Parses TokenizedStringEntries from a CSV token database file.
+
+    Entries are yielded as they are read, so the file may be processed as a
+    stream without holding all of its entries in memory.
+    """
     for line in csv.reader(fd):
         try:
             token_str, date_str, string_literal = line
 
-            token = int(token_str, 16)
-            date = (datetime.strptime(date_str, DATE_FORMAT)
-                    if date_str.strip() else None)
-
-            yield TokenizedStringEntry(token, string_literal, date)
+            yield TokenizedStringEntry(int(token_str, 16), string_literal,
+                                       _parse_csv_date(date_str))
         except (ValueError, UnicodeDecodeError) as err:
             _LOG.error('Failed to parse tokenized string entry %s: %s', line,
                        err)
 
 
+def sorted_entries(
+        entries: Iterable[TokenizedStringEntry]) -> List[TokenizedStringEntry]:
+    """Sorts entries in database order, as defined by TokenizedStringEntry.
+
+    This is equivalent to sorted(entries), but uses key functions instead of
+    calling TokenizedStringEntry.__lt__ for every comparison. Python's sort is
+    stable, so sorting by each field from least to most significant produces
+    the same order.
+    """
+    result = sorted(entries, key=lambda entry: entry.string)
+    result.sort(key=lambda entry: entry.date_removed or datetime.max,
+                reverse=True)
+    result.sort(key=lambda entry: entry.token)
+    return result
+
+
+def _csv_rows(entries: Iterable[TokenizedStringEntry]) -> bytes:
+    # Align the CSV output to 10-character columns for improved readability.
+    # Use \n instead of RFC 4180's \r\n. Escape " as "".
+    return ''.join([
+        '%08x,%-10s,"%s"\n' % (entry.token, _format_csv_date(
+            entry.date_removed), entry.string.replace('"', '""'))
+        for entry in entries
+    ]).encode()
+
+
+# Number of entries formatted per write when streaming a database to a file.
+_WRITE_BATCH_SIZE = 2**16
+
+
 def write_csv(database: Database, fd: BinaryIO) -> None:
     """Writes the database as CSV to the provided binary file."""
-    for entry in sorted(database.entries()):
-        # Align the CSV output to 10-character columns for improved readability.
-        # Use \n instead of RFC 4180's \r\n.
-        fd.write('{:08x},{:10},"{}"\n'.format(
-            entry.token,
-            entry.date_removed.strftime(DATE_FORMAT) if entry.date_removed else
-            '', entry.string.replace('"', '""')).encode())  # escape " as ""
+    # The output is written with a single write call.
+    fd.write(_csv_rows(sorted_entries(database.entries())))
+
+
+def write_sorted_csv(entries: Iterable[TokenizedStringEntry],
+                     fd: BinaryIO) -> None:
+    """Writes entries that are already in database order as CSV.
+
+    Entries are written in batches as they are read, so the entries need not
+    all be in memory at once.
+    """
+    for batch in _batches(entries):
+        fd.write(_csv_rows(batch))
 
 
 class _BinaryFileFormat(NamedTuple):
     """Attributes of the binary token database file format."""
 
     magic: bytes = b'TOKENS\0\0'
-    header: struct.Struct = struct.Struct('<8sI4x')
+    header: struct.Struct = struct.Struct('<8sII')  # magic, entries, flags
     entry: struct.Struct = struct.Struct('<IBBH')
+    string_offset: struct.Struct = struct.Struct('<I')
+
+    # Header flag that indicates that the entries are sorted by token and that
+    # a table with the offset of each entry's string, relative to the start of
+    # the string table, follows the string table. Readers that are unaware of
+    # the flag (including the C++ TokenDatabase) ignore the trailing table.
+    flag_string_offsets: int = 0x1
 
 
 BINARY_FORMAT = _BinaryFileFormat()
@@ -319,28 +600,41 @@ def file_is_binary_database(fd: BinaryIO) -> bool:
         return False
 
 
-def parse_binary(fd: BinaryIO) -> Iterable[TokenizedStringEntry]:
-    """Parses TokenizedStringEntries from a binary token database file."""
-    magic, entry_count = BINARY_FORMAT.header.unpack(
-        fd.read(BINARY_FORMAT.header.size))
-
+def _check_binary_magic(magic: bytes) -> None:
     if magic != BINARY_FORMAT.magic:
         raise ValueError(
             'Magic number mismatch (found {!r}, expected {!r})'.format(
                 magic, BINARY_FORMAT.magic))
 
+
+@functools.lru_cache(maxsize=None)
+def _binary_date_removed(day: int, month: int,
+                         year: int) -> Optional[datetime]:
+    """Converts a binary database date to a datetime; None if not removed.
+
+    Few distinct removal dates occur in a database, so the results are cached
+    and entries with the same date share one immutable datetime object.
+    """
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+
+def parse_binary(fd: BinaryIO) -> Iterable[TokenizedStringEntry]:
+    """Parses TokenizedStringEntries from a binary token database file."""
+    magic, entry_count, _ = BINARY_FORMAT.header.unpack(
+        fd.read(BINARY_FORMAT.header.size))
+
+    _check_binary_magic(magic)
+
     entries = []
 
     for _ in range(entry_count):
         token, day, month, year = BINARY_FORMAT.entry.unpack(
             fd.read(BINARY_FORMAT.entry.size))
 
-        try:
-            date_removed: Optional[datetime] = datetime(year, month, day)
-        except ValueError:
-            date_removed = None
-
-        entries.append((token, date_removed))
+        entries.append((token, _binary_date_removed(day, month, year)))
 
     # Read the entire string table and define a function for looking up strings.
     string_table = fd.read()
@@ -356,35 +650,107 @@ def parse_binary(fd: BinaryIO) -> Iterable[TokenizedStringEntry]:
         yield TokenizedStringEntry(token, string, removed)
 
 
-def write_binary(database: Database, fd: BinaryIO) -> None:
-    """Writes the database as packed binary to the provided binary file."""
-    entries = sorted(database.entries())
+def write_binary(database: Database,
+                 fd: BinaryIO,
+                 string_offsets: bool = False) -> None:
+    """Writes the database as packed binary to the provided binary file.
 
-    fd.write(BINARY_FORMAT.header.pack(BINARY_FORMAT.magic, len(entries)))
+    Args:
+      database: the database to write
+      fd: the binary file to which to write
+      string_offsets: if True, append a table of string offsets and set the
+          flag_string_offsets header flag, which allows MappedDatabase to look
+          up tokens with a binary search instead of indexing the whole file
+    """
+    entries = sorted_entries(database.entries())
+    write_sorted_binary(lambda: entries, len(entries), fd, string_offsets)
 
-    string_table = bytearray()
 
-    for entry in entries:
-        if entry.date_removed:
-            removed_day = entry.date_removed.day
-            removed_month = entry.date_removed.month
-            removed_year = entry.date_removed.year
-        else:
-            # If there is no removal date, use the special value 0xffffffff for
-            # the day/month/year. That ensures that still-present tokens appear
-            # as the newest tokens when sorted by removal date.
-            removed_day = 0xff
-            removed_month = 0xff
-            removed_year = 0xffff
+def _binary_entry(entry: TokenizedStringEntry) -> bytes:
+    if entry.date_removed:
+        removed_day = entry.date_removed.day
+        removed_month = entry.date_removed.month
+        removed_year = entry.date_removed.year
+    else:
+        # If there is no removal date, use the special value 0xffffffff for
+        # the day/month/year. That ensures that still-present tokens appear
+        # as the newest tokens when sorted by removal date.
+        removed_day = 0xff
+        removed_month = 0xff
+        removed_year = 0xffff
+
+    return BINARY_FORMAT.entry.pack(entry.token, removed_day, removed_month,
+                                    removed_year)
+
+
+def write_sorted_binary(entries: Callable[[], Iterable[TokenizedStringEntry]],
+                        entry_count: int,
+                        fd: BinaryIO,
+                        string_offsets: bool = False) -> None:
+    """Writes entries that are already in database order as packed binary.
+
+    The entries are read twice: once for the entry table and once for the
+    string table. They are written in batches, so the entries need not all be
+    in memory at once.
+
+    Args:
+      entries: function that returns a new iterator over the entries
+      entry_count: the number of entries that entries() produces
+      fd: the binary file to which to write
+      string_offsets: whether to append a table of string offsets; see
+          write_binary
+    """
+    fd.write(
+        BINARY_FORMAT.header.pack(
+            BINARY_FORMAT.magic, entry_count,
+            BINARY_FORMAT.flag_string_offsets if string_offsets else 0))
+
+    written = 0
+    for batch in _batches(entries()):
+        fd.write(b''.join([_binary_entry(entry) for entry in batch]))
+        written += len(batch)
+
+    if written != entry_count:
+        raise ValueError('Expected {} entries, but {} were written'.format(
+            entry_count, written))
+
+    offset_table = array.array('I')
+    offset = 0
+
+    for batch in _batches(entries()):
+        strings = [entry.string.encode() + b'\0' for entry in batch]
+
+        if string_offsets:
+            for string in strings:
+                offset_table.append(offset)
+                offset += len(string)
 
-        string_table += entry.string.encode()
-        string_table.append(0)
+        fd.write(b''.join(strings))
 
-        fd.write(
-            BINARY_FORMAT.entry.pack(entry.token, removed_day, removed_month,
-                                     removed_year))
+    if string_offsets:
+        if sys.byteorder != 'little':
+            offset_table.byteswap()
+        fd.write(offset_table.tobytes())
 
-    fd.write(string_table)
+
+def _batches(
+    entries: Iterable[TokenizedStringEntry]
+) -> Iterator[List[TokenizedStringEntry]]:
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, _WRITE_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def _binary_database_flags(fd: BinaryIO) -> int:
+    """Reads the flags from a binary database header."""
+    fd.seek(0)
+    _, _, flags = BINARY_FORMAT.header.unpack(
+        fd.read(BINARY_FORMAT.header.size))
+    fd.seek(0)
+    return flags
 
 
 class DatabaseFile(Database):
@@ -395,12 +761,17 @@ class DatabaseFile(Database):
   """
     def __init__(self, path: str):
         self.path = path
+        self._export: Callable[[Database, BinaryIO], None]
 
         # Read the path as a packed binary file.
         with open(self.path, 'rb') as fd:
             if file_is_binary_database(fd):
+                string_offsets = bool(
+                    _binary_database_flags(fd)
+                    & BINARY_FORMAT.flag_string_offsets)
                 super().__init__(parse_binary(fd))
-                self._export = write_binary
+                self._export = functools.partial(write_binary,
+                                                 string_offsets=string_offsets)
                 return
 
         # Read the path as a CSV file.
@@ -412,3 +783,226 @@ class DatabaseFile(Database):
         """Exports in the original format to the original or provided path."""
         with open(self.path if path is None else path, 'wb') as fd:
             self._export(self, fd)
+
+
+_ENTRY_TOKEN = struct.Struct('<I')
+
+
+class _MappedTokenToEntries(Mapping[int, List[TokenizedStringEntry]]):
+    """Read-only token to entries mapping for a MappedDatabase.
+
+    Like Database.token_to_entries, looking up an unknown token returns an empty
+    list rather than raising a KeyError.
+    """
+    def __init__(self, database: 'MappedDatabase'):
+        self._database = database
+
+    def __getitem__(self, token: int) -> List[TokenizedStringEntry]:
+        return self._database.lookup(token)
+
+    def __contains__(self, token) -> bool:
+        return bool(self._database.entry_indices(token))
+
+    def __iter__(self) -> Iterator[int]:
+        return self._database.tokens()
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._database.tokens())
+
+
+class MappedDatabase:
+    """A read-only binary token database that is read lazily from a file.
+
+    The file is memory-mapped rather than read. Strings are decoded and
+    TokenizedStringEntry objects are created only when a token is looked up.
+    MappedDatabase provides the same token_to_entries interface as Database, so
+    it may be passed directly to a Detokenizer.
+
+    If the database was written with string offsets (see write_binary), tokens
+    are found with a binary search over the sorted entries, so opening the
+    database takes constant time and lookups take O(log n) time. Otherwise, the
+    entry table and string table are indexed when the database is opened.
+    """
+    def __init__(self, path_or_file: Union[str, BinaryIO]):
+        """Maps a binary token database from a path or binary file object.
+
+        File objects without a file descriptor (e.g. io.BytesIO) are read into
+        memory instead of mapped.
+        """
+        self._file: Optional[BinaryIO] = None
+        self._map: Optional[mmap.mmap] = None
+
+        if isinstance(path_or_file, str):
+            self._file = path_or_file = open(path_or_file, 'rb')
+
+        try:
+            self._data = self._map_file(path_or_file)
+
+            magic, entry_count, flags = BINARY_FORMAT.header.unpack_from(
+                self._data)
+            _check_binary_magic(magic)
+
+            entries_end = (BINARY_FORMAT.header.size +
+                           entry_count * BINARY_FORMAT.entry.size)
+            if len(self._data) < entries_end:
+                raise ValueError(
+                    'Binary token database is truncated: {} entries require '
+                    '{} bytes, but the file is {} B'.format(
+                        entry_count, entries_end, len(self._data)))
+
+            offsets_start = (len(self._data) -
+                             entry_count * BINARY_FORMAT.string_offset.size)
+            if (flags & BINARY_FORMAT.flag_string_offsets
+                    and offsets_start < entries_end):
+                raise ValueError(
+                    'Binary token database is too small for its string '
+                    'offset table')
+        except BaseException:
+            self._close_file()
+            raise
+
+        self._entries = memoryview(
+            self._data)[BINARY_FORMAT.header.size:entries_end]
+        self._strings_start = entries_end
+
+        self._index: Optional[Dict[int, List[int]]] = None
+        self._string_offsets: Union[None, memoryview, List[int]] = None
+
+        if flags & BINARY_FORMAT.flag_string_offsets:
+            self._string_offsets = memoryview(self._data)[offsets_start:]
+        else:
+            self._index = self._index_tokens()
+
+    def _map_file(self, fd: BinaryIO) -> Union[bytes, mmap.mmap]:
+        try:
+            fileno = fd.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            fd.seek(0)
+            return fd.read()
+
+        self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _index_tokens(self) -> Dict[int, List[int]]:
+        """Maps each token to the indices of its entries."""
+        index: Dict[int, List[int]] = collections.defaultdict(list)
+        for i, (token, ) in enumerate(struct.iter_unpack(
+                '<I4x', self._entries)):
+            index[token].append(i)
+
+        return dict(index)
+
+    def _token(self, index: int) -> int:
+        return _ENTRY_TOKEN.unpack_from(self._entries,
+                                        index * BINARY_FORMAT.entry.size)[0]
+
+    def _bisect(self, token: int, low: int, high: int, right: bool) -> int:
+        """Binary searches the sorted entries for the token."""
+        while low < high:
+            middle = (low + high) // 2
+            middle_token = self._token(middle)
+
+            if middle_token < token or (right and middle_token == token):
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def entry_indices(self, token: int) -> Sequence[int]:
+        """Returns the indices of the entries with the provided token."""
+        if self._index is not None:
+            return self._index.get(token, ())
+
+        low = self._bisect(token, 0, len(self), right=False)
+        return range(low, self._bisect(token, low, len(self), right=True))
+
+    def tokens(self) -> Iterator[int]:
+        """Iterates over the unique tokens in the database."""
+        if self._index is not None:
+            return iter(self._index)
+
+        return iter(
+            dict.fromkeys(
+                token for token, in struct.iter_unpack('<I4x', self._entries)))
+
+    def _string_start(self, index: int) -> int:
+        """Finds the offset of an entry's string in the data."""
+        if isinstance(self._string_offsets, memoryview):
+            offset, = BINARY_FORMAT.string_offset.unpack_from(
+                self._string_offsets, index * BINARY_FORMAT.string_offset.size)
+            return self._strings_start + offset
+
+        if self._string_offsets is None:
+            self._string_offsets = self._find_string_offsets()
+
+        return self._string_offsets[index]
+
+    def _find_string_offsets(self) -> List[int]:
+        """Finds the start of each string in the string table."""
+        offsets = []
+        offset = self._strings_start
+        find = self._data.find
+
+        for _ in range(len(self)):
+            offsets.append(offset)
+            offset = find(b'\0', offset) + 1
+            if offset == 0:
+                raise ValueError(
+                    'Binary token database has fewer strings than entries')
+
+        return offsets
+
+    def _entry(self, index: int) -> TokenizedStringEntry:
+        token, day, month, year = BINARY_FORMAT.entry.unpack_from(
+            self._entries, index * BINARY_FORMAT.entry.size)
+
+        start = self._string_start(index)
+        end = self._data.find(b'\0', start)
+        if end == -1:
+            raise ValueError('Unterminated string in binary token database')
+
+        return TokenizedStringEntry(token, self._data[start:end].decode(),
+                                    _binary_date_removed(day, month, year))
+
+    def lookup(self, token: int) -> List[TokenizedStringEntry]:
+        """Returns the entries for a token; empty if the token is unknown."""
+        return [self._entry(i) for i in self.entry_indices(token)]
+
+    @property
+    def token_to_entries(self) -> Mapping[int, List[TokenizedStringEntry]]:
+        """Returns a read-only mapping of tokens to TokenizedStringEntries."""
+        return _MappedTokenToEntries(self)
+
+    def entries(self) -> Iterator[TokenizedStringEntry]:
+        """Reads all TokenizedStringEntries in the database."""
+        return (self._entry(i) for i in range(len(self)))
+
+    def collisions(self) -> Tuple[Tuple[int, List[TokenizedStringEntry]], ...]:
+        """Returns tuple of (token, entries_list)) for all colliding tokens."""
+        return tuple((token, self.lookup(token)) for token in self.tokens()
+                     if len(self.entry_indices(token)) > 1)
+
+    def close(self) -> None:
+        """Unmaps and closes the database file."""
+        self._entries.release()
+        if isinstance(self._string_offsets, memoryview):
+            self._string_offsets.release()
+
+        self._close_file()
+
+    def _close_file(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> 'MappedDatabase':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """Returns the number of entries in the database."""
+        return len(self._entries) // BINARY_FORMAT.entry.size
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Micro-benchmarks for the tokens module.
+
+Run this script directly to print the throughput of each benchmark:
+
+  python tokens_benchmark.py --strings 100000 --csv-rows 1000000
+"""
+
+import argparse
+import datetime
+import io
+import random
+import string
+import time
+from typing import Callable, List
+
+from pw_tokenizer import tokens
+
+
+def _original_hash(string_to_hash, hash_length: int) -> int:
+    """The original character-by-character hash, for comparison."""
+    hash_value = len(string_to_hash)
+    coefficient = tokens.TOKENIZER_HASH_CONSTANT
+
+    for char in string_to_hash[:hash_length]:
+        hash_value = (hash_value + coefficient * ord(char)) % 2**32
+        coefficient = (coefficient * tokens.TOKENIZER_HASH_CONSTANT) % 2**32
+
+    return hash_value
+
+
+def generate_strings(count: int, seed: int = 65599) -> List[str]:
+    """Generates random log-like format strings of typical lengths."""
+    rng = random.Random(seed)
+    chars = string.ascii_letters + string.digits + ' %:,.'
+    return [
+        ''.join(rng.choice(chars) for _ in range(rng.randint(8, 120)))
+        for _ in range(count)
+    ]
+
+
+def _run(name: str,
+         count: int,
+         function: Callable[[], object],
+         units: str = 'strings') -> float:
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+
+    print(f'{name:40} {count / elapsed:14,.0f} {units}/s')
+    return elapsed
+
+
+def benchmark_hashing(strings: List[str]) -> None:
+    """Compares the original hash to the table-driven and batch hashes."""
+    count = len(strings)
+    length = tokens.DEFAULT_HASH_LENGTH
+
+    tokens.set_default_hash_cache_size(0)
+
+    _run('original per-character hash', count,
+         lambda: [_original_hash(s, length) for s in strings])
+    _run('default_hash (no memo)', count,
+         lambda: [tokens.default_hash(s) for s in strings])
+    _run('hash_many (pure Python)', count,
+         lambda: tokens.hash_many(strings, length, use_numpy=False))
+
+    if tokens.numpy is not None:
+        _run('hash_many (NumPy)', count,
+             lambda: tokens.hash_many(strings, length, use_numpy=True))
+
+    tokens.set_default_hash_cache_size(count)
+    tokens.clear_default_hash_cache()
+
+    _run('Database.add (cold memo)', count,
+         lambda: tokens.Database().add(strings))
+    _run('Database.add (warm memo)', count,
+         lambda: tokens.Database().add(strings))
+
+    tokens.set_default_hash_cache_size(tokens.DEFAULT_HASH_CACHE_SIZE)
+
+
+def generate_database(rows: int, seed: int = 65599) -> tokens.Database:
+    """Generates a database in which about a quarter of entries are removed."""
+    rng = random.Random(seed)
+    dates = [
+        datetime.datetime(2019, 1, 1) + datetime.timedelta(days=day)
+        for day in range(0, 720, 7)
+    ]
+    return tokens.Database(
+        tokens.TokenizedStringEntry(
+            rng.getrandbits(32), string,
+            rng.choice(dates) if rng.random() < 0.25 else None)
+        for string in generate_strings(rows, seed))
+
+
+def benchmark_csv(database: tokens.Database) -> None:
+    """Measures writing and parsing a CSV database."""
+    rows = len(database)
+
+    output = io.BytesIO()
+    _run('write_csv', rows, lambda: tokens.write_csv(database, output), 'rows')
+
+    csv_text = output.getvalue().decode()
+    _run('parse_csv', rows,
+         lambda: tokens.Database(tokens.parse_csv(io.StringIO(csv_text))),
+         'rows')
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--strings',
+                        type=int,
+                        default=100000,
+                        help='Number of strings to hash (default: 100000)')
+    parser.add_argument(
+        '--csv-rows',
+        type=int,
+        default=1000000,
+        help='Number of rows in the CSV database (default: 1000000)')
+    return parser.parse_args()
+
+
+def _main(args: argparse.Namespace) -> None:
+    benchmark_hashing(generate_strings(args.strings))
+    benchmark_csv(generate_database(args.csv_rows))
+
+
+if __name__ == '__main__':
+    _main(_parse_args())
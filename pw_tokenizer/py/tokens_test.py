@@ -17,7 +17,10 @@
 import datetime
 import io
 import logging
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 from pw_tokenizer import tokens
 from pw_tokenizer.tokens import _LOG
@@ -87,11 +90,49 @@ INVALID_CSV = """\
 """
 
 
+def reference_hash(string, hash_length):
+    """The original character-by-character implementation of the hash."""
+    hash_value = len(string)
+    coefficient = tokens.TOKENIZER_HASH_CONSTANT
+
+    for char in string[:hash_length]:
+        hash_value = (hash_value + coefficient *
+                      (char if isinstance(char, int) else ord(char))) % 2**32
+        coefficient = (coefficient * tokens.TOKENIZER_HASH_CONSTANT) % 2**32
+
+    return hash_value
+
+
 def read_db_from_csv(csv_str):
     with io.StringIO(csv_str) as csv_db:
         return tokens.Database(tokens.parse_csv(csv_db))
 
 
+def map_invalid_file(test: unittest.TestCase, data: bytes) -> None:
+    """Checks that mapping a path to an invalid database closes the file."""
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        file.write(data)
+
+    opened = []
+    real_open = open
+
+    def open_file(*args, **kwargs):
+        # pylint: disable=consider-using-with
+        fd = real_open(*args, **kwargs)
+        opened.append(fd)
+        return fd
+
+    try:
+        with mock.patch('builtins.open', open_file):
+            with test.assertRaises(ValueError):
+                tokens.MappedDatabase(file.name)
+    finally:
+        os.unlink(file.name)
+
+    fd, = opened
+    test.assertTrue(fd.closed)
+
+
 class TokenDatabaseTest(unittest.TestCase):
     """Tests the token database class."""
     def test_csv(self):
@@ -113,6 +154,29 @@ class TokenDatabaseTest(unittest.TestCase):
         self.assertEqual(str(db), ('00000000,1990-02-01,"Commas,"",,"\n'
                                    '00000001,1990-01-01,"Quotes"""\n'))
 
+    def test_sorted_entries_matches_entry_order(self):
+        entries = [
+            tokens.TokenizedStringEntry(token, string, date)
+            for token in (3, 1, 2) for string in ('b', 'a', 'c')
+            for date in (None, datetime.datetime(2019, 6, 10),
+                         datetime.datetime(2019, 6, 10, 12, 30),
+                         datetime.datetime(2020, 1, 1))
+        ]
+        self.assertEqual([
+            e.key() + (e.date_removed, )
+            for e in tokens.sorted_entries(entries)
+        ], [e.key() + (e.date_removed, ) for e in sorted(entries)])
+
+    def test_csv_shares_dates(self):
+        db = read_db_from_csv(CSV_DATABASE)
+        self.assertIs(db.token_to_entries[0][0].date_removed,
+                      db.token_to_entries[0xe65aefef][0].date_removed)
+
+    def test_csv_single_write(self):
+        fd = mock.Mock()
+        tokens.write_csv(read_db_from_csv(CSV_DATABASE), fd)
+        fd.write.assert_called_once_with(CSV_DATABASE.encode())
+
     def test_bad_csv(self):
         with self.assertLogs(_LOG, logging.ERROR) as logs:
             db = read_db_from_csv(INVALID_CSV)
@@ -363,6 +427,343 @@ class TokenDatabaseTest(unittest.TestCase):
 
         self.assertEqual(str(db), CSV_DATABASE)
 
+    def test_binary_format_parse_shares_dates(self):
+        with io.BytesIO(BINARY_DATABASE) as binary_db:
+            entries = list(tokens.parse_binary(binary_db))
+
+        self.assertIs(entries[0].date_removed, entries[-1].date_removed)
+
+    def test_entries_have_no_dict(self):
+        entry = tokens.TokenizedStringEntry(1, 'one')
+        self.assertFalse(hasattr(entry, '__dict__'))
+
+        with self.assertRaises(AttributeError):
+            entry.unknown = True  # pylint: disable=assigning-non-slot
+
+
+class TestTokenToEntriesCache(unittest.TestCase):
+    """Tests that token lookups stay up to date as the database changes."""
+    def setUp(self):
+        super().setUp()
+        self.db = read_db_from_csv(CSV_DATABASE)
+        self.cache = self.db.token_to_entries
+
+    def _check_cache(self):
+        self.assertIs(self.db.token_to_entries, self.cache)
+
+        expected = tokens.Database(self.db.entries()).token_to_entries
+        self.assertEqual(
+            {
+                token: entries
+                for token, entries in self.cache.items() if entries
+            }, expected)
+
+    def test_add(self):
+        self.db.add(['new string', 'Jello?'])
+        self._check_cache()
+        new, = self.db.token_to_entries[tokens.default_hash('new string')]
+        self.assertEqual(new.string, 'new string')
+        self.assertIsNone(self.db.token_to_entries[0xcc6d3131][0].date_removed)
+
+    def test_mark_removals(self):
+        self.db.mark_removals(['%d', '%ld'])
+        self._check_cache()
+        self.assertIsNotNone(
+            self.db.token_to_entries[0x141c35d5][0].date_removed)
+
+    def test_purge(self):
+        self.db.purge()
+        self._check_cache()
+        self.assertEqual(self.db.token_to_entries[0x2e668cd6], [])
+
+    def test_merge(self):
+        self.db.merge(tokens.Database.from_strings(['o000', '0Q1Q', 'Jello?']))
+        self._check_cache()
+        self.assertEqual(
+            len(self.db.token_to_entries[tokens.default_hash('o000')]), 2)
+
+    def test_filter(self):
+        self.db.filter(include=['Jello'], exclude=['!'])
+        self._check_cache()
+        self.assertEqual([e.string for e in self.db.entries()], ['Jello?'])
+
+
+class TestHashMany(unittest.TestCase):
+    """Tests hashing many strings at once."""
+    STRINGS = [
+        '', 'o000', '0Q1Q', 'The answer is: %s', '\u0394\u2603\U0001f600',
+        'x' * 95, 'y' * 96, 'z' * 97, 'long ' * 100, b'', b'bytes!',
+        b'\xff\xfe' * 80
+    ]
+
+    def _expected(self, hash_length):
+        return [reference_hash(string, hash_length) for string in self.STRINGS]
+
+    def test_single_string_hash_matches_reference(self):
+        for hash_length in (0, 1, 80, 96, 128):
+            for string in self.STRINGS:
+                self.assertEqual(
+                    tokens.pw_tokenizer_65599_fixed_length_hash(
+                        string, hash_length),
+                    reference_hash(string, hash_length))
+
+    def test_matches_single_string_hash(self):
+        for hash_length in (0, 1, 80, 96, 128):
+            self.assertEqual(
+                tokens.hash_many(self.STRINGS, hash_length, use_numpy=False),
+                self._expected(hash_length))
+
+    @unittest.skipIf(tokens.numpy is None, 'NumPy is not installed')
+    def test_numpy_matches_single_string_hash(self):
+        for hash_length in (0, 1, 80, 96, 128):
+            self.assertEqual(
+                tokens.hash_many(self.STRINGS, hash_length, use_numpy=True),
+                self._expected(hash_length))
+
+    def test_empty(self):
+        self.assertEqual(tokens.hash_many([]), [])
+
+    def test_from_strings_uses_same_tokens(self):
+        db = tokens.Database.from_strings(self.STRINGS[:9])
+        for string in self.STRINGS[:9]:
+            self.assertIn(string, [
+                entry.string
+                for entry in db.token_to_entries[tokens.default_hash(string)]
+            ])
+
+
+class TestDefaultHashCache(unittest.TestCase):
+    """Tests memoization of the default hash."""
+    def setUp(self):
+        super().setUp()
+        tokens.set_default_hash_cache_size(1024)
+        tokens.clear_default_hash_cache()
+
+    def tearDown(self):
+        tokens.set_default_hash_cache_size(tokens.DEFAULT_HASH_CACHE_SIZE)
+        tokens.clear_default_hash_cache()
+        super().tearDown()
+
+    def test_cached_hash_matches_reference(self):
+        for _ in range(2):
+            for string in TestHashMany.STRINGS:
+                self.assertEqual(tokens.default_hash(string),
+                                 reference_hash(string, 96))
+
+    def test_bytearray_is_not_cached(self):
+        self.assertEqual(tokens.default_hash(bytearray(b'abc')),
+                         reference_hash(b'abc', 96))
+
+    def test_repeated_add_skips_hashing(self):
+        db = tokens.Database()
+        db.add(['apples', 'oranges'])
+
+        with mock.patch.object(tokens, 'hash_many',
+                               wraps=tokens.hash_many) as hash_many:
+            db.add(['apples', 'oranges', 'pears'])
+            hash_many.assert_called_once()
+            self.assertEqual(list(hash_many.call_args[0][0]), ['pears'])
+
+        self.assertEqual(len(db), 3)
+        self.assertEqual(
+            db.token_to_entries[reference_hash('pears', 96)][0].string,
+            'pears')
+
+    def test_cache_is_bounded(self):
+        tokens.set_default_hash_cache_size(2)
+        db = tokens.Database.from_strings(['a', 'b', 'c'])
+        self.assertEqual(len(db), 3)
+
+        with mock.patch.object(tokens, 'hash_many',
+                               wraps=tokens.hash_many) as hash_many:
+            db.add(['c', 'a'])
+            self.assertEqual(list(hash_many.call_args[0][0]), ['a'])
+
+    def test_disable_cache(self):
+        tokens.set_default_hash_cache_size(0)
+        db = tokens.Database.from_strings(['a', 'b'])
+
+        with mock.patch.object(tokens, 'hash_many',
+                               wraps=tokens.hash_many) as hash_many:
+            db.add(['a', 'b'])
+            self.assertEqual(list(hash_many.call_args[0][0]), ['a', 'b'])
+
+    def test_disabled_by_default(self):
+        tokens.set_default_hash_cache_size(tokens.DEFAULT_HASH_CACHE_SIZE)
+        db = tokens.Database.from_strings(['a', 'b'])
+
+        with mock.patch.object(tokens, 'hash_many',
+                               wraps=tokens.hash_many) as hash_many:
+            db.add(['a', 'b'])
+            self.assertEqual(list(hash_many.call_args[0][0]), ['a', 'b'])
+
+    def test_negative_size(self):
+        with self.assertRaises(ValueError):
+            tokens.set_default_hash_cache_size(-1)
+
+
+class TestMappedDatabase(unittest.TestCase):
+    """Tests reading binary databases lazily with MappedDatabase."""
+    def setUp(self):
+        super().setUp()
+        self._file = tempfile.NamedTemporaryFile(delete=False)
+        self._file.write(BINARY_DATABASE)
+        self._file.close()
+
+    def tearDown(self):
+        os.unlink(self._file.name)
+        super().tearDown()
+
+    def _check_database(self, mapped):
+        self.assertEqual(len(mapped), 16)
+        self.assertEqual(str(tokens.Database(mapped.entries())), CSV_DATABASE)
+
+        jello, = mapped.token_to_entries[0x2e668cd6]
+        self.assertEqual(jello.string, 'Jello, world!')
+        self.assertEqual(jello.date_removed, datetime.datetime(2019, 6, 11))
+
+        llu, = mapped.token_to_entries[0xe13b0f94]
+        self.assertEqual(llu.string, '%llu')
+        self.assertIsNone(llu.date_removed)
+
+        self.assertEqual(mapped.token_to_entries[0x9999], [])
+        self.assertNotIn(0x9999, mapped.token_to_entries)
+        self.assertIn(0x141c35d5, mapped.token_to_entries)
+        self.assertEqual(len(mapped.token_to_entries), 16)
+        self.assertEqual(mapped.collisions(), ())
+
+    def test_map_path(self):
+        with tokens.MappedDatabase(self._file.name) as mapped:
+            self._check_database(mapped)
+
+    def test_map_file(self):
+        with open(self._file.name, 'rb') as fd:
+            with tokens.MappedDatabase(fd) as mapped:
+                self._check_database(mapped)
+
+    def test_read_file_without_fileno(self):
+        with tokens.MappedDatabase(io.BytesIO(BINARY_DATABASE)) as mapped:
+            self._check_database(mapped)
+
+    def test_collisions(self):
+        db = tokens.Database.from_strings(['o000', '0Q1Q', 'other'])
+
+        with io.BytesIO() as fd:
+            tokens.write_binary(db, fd)
+            mapped = tokens.MappedDatabase(io.BytesIO(fd.getvalue()))
+
+        (token, entries), = mapped.collisions()
+        self.assertEqual(token, tokens.default_hash('o000'))
+        self.assertCountEqual([e.string for e in entries], ['o000', '0Q1Q'])
+
+    def test_merge_into_database(self):
+        with tokens.MappedDatabase(self._file.name) as mapped:
+            db = tokens.Database.merged(mapped)
+
+        self.assertEqual(str(db), CSV_DATABASE)
+
+    def test_bad_magic(self):
+        with self.assertRaises(ValueError):
+            tokens.MappedDatabase(io.BytesIO(b'TOKENZ\0\0' + bytes(8)))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            tokens.MappedDatabase(io.BytesIO(BINARY_DATABASE[:100]))
+
+    def test_file_closed_if_path_is_invalid(self):
+        map_invalid_file(self, b'TOKENZ\0\0' + bytes(8))
+
+    def test_missing_strings(self):
+        mapped = tokens.MappedDatabase(
+            io.BytesIO(BINARY_DATABASE[:BINARY_DATABASE.index(b'Jello')]))
+
+        with self.assertRaises(ValueError):
+            _ = mapped.token_to_entries[0x2e668cd6]
+
+
+class TestMappedDatabaseWithStringOffsets(unittest.TestCase):
+    """Tests binary databases with string offset tables."""
+    def setUp(self):
+        super().setUp()
+        with io.BytesIO() as fd:
+            tokens.write_binary(read_db_from_csv(CSV_DATABASE), fd, True)
+            self.binary = fd.getvalue()
+
+    def test_format(self):
+        self.assertEqual(self.binary[:12], BINARY_DATABASE[:12])
+        self.assertEqual(self.binary[12:16], b'\1\0\0\0')
+        self.assertEqual(self.binary[16:len(BINARY_DATABASE)],
+                         BINARY_DATABASE[16:])
+
+        offsets = self.binary[len(BINARY_DATABASE):]
+        self.assertEqual(len(offsets), 16 * 4)
+        self.assertEqual(offsets[:12], b'\0\0\0\0\1\0\0\0\x12\0\0\0')
+
+    def test_parse_binary_ignores_offsets(self):
+        db = tokens.Database(tokens.parse_binary(io.BytesIO(self.binary)))
+        self.assertEqual(str(db), CSV_DATABASE)
+
+    def test_lookup(self):
+        mapped = tokens.MappedDatabase(io.BytesIO(self.binary))
+        self.assertEqual(str(tokens.Database(mapped.entries())), CSV_DATABASE)
+
+        for entry in read_db_from_csv(CSV_DATABASE).entries():
+            found, = mapped.token_to_entries[entry.token]
+            self.assertEqual(found.string, entry.string)
+            self.assertEqual(found.date_removed, entry.date_removed)
+
+        self.assertEqual(mapped.token_to_entries[0x9999], [])
+        self.assertEqual(mapped.token_to_entries[0xffffffff], [])
+        self.assertNotIn(0x9999, mapped.token_to_entries)
+        self.assertEqual(len(mapped.token_to_entries), 16)
+
+    def test_lookup_collisions(self):
+        strings = ['o000', '0Q1Q', 'a', 'b', 'c', 'd', 'e']
+        with io.BytesIO() as fd:
+            tokens.write_binary(tokens.Database.from_strings(strings), fd,
+                                True)
+            mapped = tokens.MappedDatabase(io.BytesIO(fd.getvalue()))
+
+        for string in strings:
+            self.assertIn(string, [
+                entry.string for entry in mapped.token_to_entries[
+                    tokens.default_hash(string)]
+            ])
+
+        (token, entries), = mapped.collisions()
+        self.assertEqual(token, tokens.default_hash('o000'))
+        self.assertCountEqual([e.string for e in entries], ['o000', '0Q1Q'])
+
+    def test_file_closed_if_offset_table_is_truncated(self):
+        # The 16 entries end at byte 144, but the 64-byte offset table would
+        # have to start before them.
+        map_invalid_file(self, self.binary[:144 + 32])
+
+    def test_empty(self):
+        with io.BytesIO() as fd:
+            tokens.write_binary(tokens.Database(), fd, True)
+            mapped = tokens.MappedDatabase(io.BytesIO(fd.getvalue()))
+
+        self.assertEqual(len(mapped), 0)
+        self.assertEqual(mapped.token_to_entries[0], [])
+
+    def test_database_file_preserves_offsets(self):
+        with tempfile.NamedTemporaryFile(delete=False) as fd:
+            fd.write(self.binary)
+
+        try:
+            db = tokens.DatabaseFile(fd.name)
+            db.add(['new string'])
+            db.write_to_file()
+
+            with tokens.MappedDatabase(fd.name) as mapped:
+                new, = mapped.token_to_entries[tokens.default_hash(
+                    'new string')]
+                self.assertEqual(new.string, 'new string')
+                self.assertEqual(len(mapped), 17)
+        finally:
+            os.unlink(fd.name)
+
 
 class TestFilter(unittest.TestCase):
     """Tests the filtering functionality."""